@@ -25,7 +25,7 @@
 """ Compression and Archiving
 
 Utility functions for creating archive files (tarballs, zip files, etc)
-and compressing files (gzip, bzip2, lzop, etc)
+and compressing files (gzip, bzip2, lzop, xz, zstd, etc)
 """
 
 import os
@@ -82,59 +82,204 @@ def _call_external(cmdln_or_args):
 
     return (proc.returncode, outdata, errdata)
 
-def _do_gzip(input_name, compression=True):
-    """ Compress/decompress the file with 'gzip' utility.
+# size of the blocks compressed independently by _BlockWriter
+BLOCK_SIZE = 4 * 1024 * 1024
+# read size when streaming data into a compressor
+_STREAM_CHUNK = 1024 * 1024
 
-    @input_name: the file name to compress/decompress
-    @compress: True for compressing, False for decompressing
-    @retval: the path of the compressed/decompressed file
+def _gzip_block(data, level=6):
+    """ Compress 'data' as a complete gzip member
+
+    @data: the data to compress
+    @retval: the gzip member, gzip members can be concatenated
+    """
+    import zlib
+    import struct
+
+    # compressobj releases the GIL while deflating
+    zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = zobj.compress(data) + zobj.flush()
+    header = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    return header + body + trailer
+
+def _bzip2_block(data, level=9):
+    """ Compress 'data' as a complete bzip2 stream
+
+    @data: the data to compress
+    @retval: the bzip2 stream, bzip2 streams can be concatenated
+    """
+    import bz2
+    return bz2.compress(data, level)
+
+class _BlockWriter(object):
+    """ File-like writer compressing the data in independent blocks on a
+    pool of threads, like pigz/pbzip2 do. The output is a concatenation of
+    complete gzip/bzip2 streams, which gzip and bzip2 decompress as usual.
     """
+    def __init__(self, compress_block, output_name, workers=None):
+        from multiprocessing.pool import ThreadPool
+        import multiprocessing
+        import collections
+
+        self.compress_block = compress_block
+        self.output = open(output_name, "wb")
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        self.pending = collections.deque()
+        self.buf = []
+        self.buflen = 0
+        self.written = False
+
+    def _flush_pending(self, keep):
+        while len(self.pending) > keep:
+            self.output.write(self.pending.popleft().get())
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(self.compress_block,
+                                                  (block,)))
+        self.written = True
+        # bound the memory used by the blocks in flight
+        self._flush_pending(2 * self.workers)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen < BLOCK_SIZE:
+            return
+
+        data = "".join(self.buf)
+        pos = 0
+        while len(data) - pos >= BLOCK_SIZE:
+            self._submit(data[pos:pos + BLOCK_SIZE])
+            pos += BLOCK_SIZE
+        self.buf = [data[pos:]]
+        self.buflen = len(data) - pos
+
+    def close(self):
+        try:
+            if self.buflen or not self.written:
+                self._submit("".join(self.buf))
+            self._flush_pending(0)
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.output.close()
+
+class _PipeWriter(object):
+    """ File-like writer feeding the data to an external compressor """
+    def __init__(self, cmdln, output_name):
+        msger.info("Running command: " + " ".join(cmdln))
+        self.cmdln = cmdln
+        self.output = open(output_name, "wb")
+        self.proc = subprocess.Popen(cmdln, stdin=subprocess.PIPE,
+                                     stdout=self.output)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        self.output.close()
+        if returncode != 0:
+            raise OSError, "'%s' exited with error (%d)" \
+                           % (" ".join(self.cmdln), returncode)
+
+def _gzip_writer(output_name):
+    """ Open a streaming gzip compressor, pigz or the builtin one """
     if which("pigz") is not None:
-        compressor = "pigz"
-    else:
-        compressor = "gzip"
+        return _PipeWriter(["pigz", "-c"], output_name)
+    return _BlockWriter(_gzip_block, output_name)
 
-    if compression:
-        cmdln = [compressor, "-f", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", input_name]
+def _bzip2_writer(output_name):
+    """ Open a streaming bzip2 compressor, pbzip2 or the builtin one """
+    if which("pbzip2") is not None:
+        return _PipeWriter(["pbzip2", "-c"], output_name)
+    return _BlockWriter(_bzip2_block, output_name)
+
+def _lzop_writer(output_name):
+    """ Open a streaming lzop compressor """
+    return _PipeWriter(["lzop", "-c"], output_name)
+
+def _xz_writer(output_name):
+    """ Open a streaming xz compressor, multi-threaded """
+    return _PipeWriter(["xz", "-T0", "-c"], output_name)
+
+def _zstd_writer(output_name):
+    """ Open a streaming zstd compressor, multi-threaded """
+    return _PipeWriter(["zstd", "-T0", "-q", "-c"], output_name)
 
-    _call_external(cmdln)
+def _stream_compress(input_name, output_name, writer):
+    """ Compress a file into another through a streaming writer
 
+    @input_name: the file name to compress
+    @output_name: the compressed file to create
+    @writer: function opening the streaming compressor on output_name
+    """
+    wfile = writer(output_name)
+    try:
+        with open(input_name, "rb") as rfile:
+            while True:
+                data = rfile.read(_STREAM_CHUNK)
+                if not data:
+                    break
+                wfile.write(data)
+    finally:
+        wfile.close()
+
+def _do_compress(input_name, compression, suffix, writer, decompress_cmd):
+    """ Compress/decompress the file with the given format
+
+    @input_name: the file name to compress/decompress
+    @compression: True for compressing, False for decompressing
+    @suffix: suffix of the compressed files
+    @writer: function opening a streaming compressor
+    @decompress_cmd: the command line to decompress the file in place
+    @retval: the path of the compressed/decompressed file
+    """
     if compression:
-        output_name = input_name + ".gz"
+        output_name = input_name + suffix
+        _stream_compress(input_name, output_name, writer)
+        shutil.copystat(input_name, output_name)
+        os.unlink(input_name)
     else:
-        # suppose that file name is suffixed with ".gz"
+        _call_external(decompress_cmd + [input_name])
+        # suppose that file name is suffixed with the format suffix
         output_name = os.path.splitext(input_name)[0]
 
     return output_name
 
-def _do_bzip2(input_name, compression=True):
-    """ Compress/decompress the file with 'bzip2' utility.
+def _do_gzip(input_name, compression=True):
+    """ Compress/decompress the file with gzip
 
     @input_name: the file name to compress/decompress
     @compress: True for compressing, False for decompressing
     @retval: the path of the compressed/decompressed file
     """
-    if which("pbzip2") is not None:
-        compressor = "pbzip2"
+    if which("pigz") is not None:
+        decompressor = "pigz"
     else:
-        compressor = "bzip2"
+        decompressor = "gzip"
 
-    if compression:
-        cmdln = [compressor, "-f", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", input_name]
+    return _do_compress(input_name, compression, ".gz", _gzip_writer,
+                        [decompressor, "-d", "-f"])
 
-    _call_external(cmdln)
+def _do_bzip2(input_name, compression=True):
+    """ Compress/decompress the file with bzip2
 
-    if compression:
-        output_name = input_name + ".bz2"
+    @input_name: the file name to compress/decompress
+    @compress: True for compressing, False for decompressing
+    @retval: the path of the compressed/decompressed file
+    """
+    if which("pbzip2") is not None:
+        decompressor = "pbzip2"
     else:
-        # suppose that file name is suffixed with ".bz2"
-        output_name = os.path.splitext(input_name)[0]
+        decompressor = "bzip2"
 
-    return output_name
+    return _do_compress(input_name, compression, ".bz2", _bzip2_writer,
+                        [decompressor, "-d", "-f"])
 
 def _do_lzop(input_name, compression=True):
     """ Compress/decompress the file with 'lzop' utility.
@@ -143,36 +288,57 @@ def _do_lzop(input_name, compression=True):
     @compress: True for compressing, False for decompressing
     @retval: the path of the compressed/decompressed file
     """
-    compressor = "lzop"
+    return _do_compress(input_name, compression, ".lzo", _lzop_writer,
+                        ["lzop", "-d", "-f", "-U"])
 
-    if compression:
-        cmdln = [compressor, "-f", "-U", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", "-U", input_name]
+def _do_xz(input_name, compression=True):
+    """ Compress/decompress the file with 'xz' utility.
 
-    _call_external(cmdln)
+    @input_name: the file name to compress/decompress
+    @compress: True for compressing, False for decompressing
+    @retval: the path of the compressed/decompressed file
+    """
+    return _do_compress(input_name, compression, ".xz", _xz_writer,
+                        ["xz", "-d", "-f", "-T0"])
 
-    if compression:
-        output_name = input_name + ".lzo"
-    else:
-        # suppose that file name is suffixed with ".lzo"
-        output_name = os.path.splitext(input_name)[0]
+def _do_zstd(input_name, compression=True):
+    """ Compress/decompress the file with 'zstd' utility.
 
-    return output_name
+    @input_name: the file name to compress/decompress
+    @compress: True for compressing, False for decompressing
+    @retval: the path of the compressed/decompressed file
+    """
+    return _do_compress(input_name, compression, ".zst", _zstd_writer,
+                        ["zstd", "-d", "-f", "-q", "--rm"])
 
 _COMPRESS_SUFFIXES = {
     ".lzo"     : [".lzo"],
     ".gz"      : [".gz"],
     ".bz2"     : [".bz2", ".bz"],
+    ".xz"      : [".xz"],
+    ".zst"     : [".zst"],
     ".tar.lzo" : [".tar.lzo", ".tzo"],
     ".tar.gz"  : [".tar.gz", ".tgz", ".taz"],
     ".tar.bz2" : [".tar.bz2", ".tbz", ".tbz2", ".tar.bz"],
+    ".tar.xz"  : [".tar.xz", ".txz"],
+    ".tar.zst" : [".tar.zst", ".tzst"],
 }
 
 _COMPRESS_FORMATS = {
     "gz" :  _do_gzip,
     "bz2":  _do_bzip2,
     "lzo":  _do_lzop,
+    "xz" :  _do_xz,
+    "zst":  _do_zstd,
+}
+
+# streaming compressors of the formats above, used to build tarballs
+_COMPRESS_WRITERS = {
+    "gz" :  _gzip_writer,
+    "bz2":  _bzip2_writer,
+    "lzo":  _lzop_writer,
+    "xz" :  _xz_writer,
+    "zst":  _zstd_writer,
 }
 
 def get_compress_formats():
@@ -241,11 +407,12 @@ def decompress(file_path, decompress_format=None):
     return func(file_path, False)
 
 
-def _do_tar(archive_name, target_name):
+def _do_tar(archive_name, target_name, fileobj=None):
     """ Archive the directory or the file with 'tar' utility
 
-    @archive_name: the name of the tarball file
+    @archive_name: the name of the tarball file, "-" to stream it
     @target_name: the name of the target to tar
+    @fileobj: the file-like object the tar stream is written to
     @retval: the path of the archived file
     """
     file_list = []
@@ -260,7 +427,21 @@ def _do_tar(archive_name, target_name):
         file_list.append(target_name)
     cmdln = ["tar", "-C", target_dir, "-cf", archive_name]
     cmdln.extend(file_list)
-    _call_external(cmdln)
+
+    if fileobj is None:
+        _call_external(cmdln)
+        return archive_name
+
+    msger.info("Running command: " + " ".join(cmdln))
+    proc = subprocess.Popen(cmdln, stdout=subprocess.PIPE)
+    while True:
+        data = proc.stdout.read(_STREAM_CHUNK)
+        if not data:
+            break
+        fileobj.write(data)
+    returncode = proc.wait()
+    if returncode != 0:
+        raise OSError, "tar exited with error (%d)" % returncode
 
     return archive_name
 
@@ -278,17 +459,21 @@ def _do_untar(archive_name, target_dir=None):
     if returncode != 0:
         raise OSError, os.linesep.join([stdout, stderr])
 
-def _imp_tarfile(archive_name, target_name):
+def _imp_tarfile(archive_name, target_name, fileobj=None):
     """ Archive the directory or the file with tarfile module
 
     @archive_name: the name of the tarball file
     @target_name: the name of the target to tar
+    @fileobj: the file-like object the tar stream is written to
     @retval: the path of the archived file
     """
     import tarfile
 
     msger.info("Taring files to %s using tarfile module" % archive_name)
-    tar = tarfile.open(archive_name, 'w')
+    if fileobj is None:
+        tar = tarfile.open(archive_name, 'w')
+    else:
+        tar = tarfile.open(archive_name, 'w|', fileobj)
     if os.path.isdir(target_name):
         for child in os.listdir(target_name):
             tar.add(os.path.join(target_name, child), child)
@@ -301,21 +486,36 @@ def _imp_tarfile(archive_name, target_name):
 def _make_tarball(archive_name, target_name, compressor=None):
     """ Create a tarball from all the files under 'target_name' or itself.
 
+    The tar stream is fed to the compressor as it is produced, no
+    intermediate uncompressed tarball is written.
+
     @archive_name: the name of the archived file to create
     @target_name: the directory or the file name to archive
-    @compressor: callback function to compress the tarball
+    @compressor: the compression format of the tarball, None for no one
     @retval: indicate the compressing result
     """
     archive_dir = os.path.dirname(archive_name)
     tarball_name = tempfile.mktemp(suffix=".tar", dir=archive_dir)
 
-    if which("tar") is not None:
-        _do_tar(tarball_name, target_name)
+    if not compressor:
+        if which("tar") is not None:
+            _do_tar(tarball_name, target_name)
+        else:
+            _imp_tarfile(tarball_name, target_name)
     else:
-        _imp_tarfile(tarball_name, target_name)
-
-    if compressor:
-        tarball_name = compressor(tarball_name, True)
+        wfile = _COMPRESS_WRITERS[compressor](tarball_name)
+        try:
+            try:
+                if which("tar") is not None:
+                    _do_tar("-", target_name, wfile)
+                else:
+                    _imp_tarfile(tarball_name, target_name, wfile)
+            finally:
+                wfile.close()
+        except:
+            if os.path.exists(tarball_name):
+                os.unlink(tarball_name)
+            raise
 
     shutil.move(tarball_name, archive_name)
 
@@ -362,14 +562,18 @@ _ARCHIVE_SUFFIXES = {
     "lzotar": [".tzo", ".tar.lzo"],
     "gztar" : [".tgz", ".taz", ".tar.gz"],
     "bztar" : [".tbz", ".tbz2", ".tar.bz", ".tar.bz2"],
+    "xztar" : [".txz", ".tar.xz"],
+    "zsttar": [".tzst", ".tar.zst"],
 }
 
 _ARCHIVE_FORMATS = {
     "zip"   : ( _make_zipfile, {} ),
     "tar"   : ( _make_tarball, {"compressor" : None} ),
-    "lzotar": ( _make_tarball, {"compressor" : _do_lzop} ),
-    "gztar" : ( _make_tarball, {"compressor" : _do_gzip} ),
-    "bztar" : ( _make_tarball, {"compressor" : _do_bzip2} ),
+    "lzotar": ( _make_tarball, {"compressor" : "lzo"} ),
+    "gztar" : ( _make_tarball, {"compressor" : "gz"} ),
+    "bztar" : ( _make_tarball, {"compressor" : "bz2"} ),
+    "xztar" : ( _make_tarball, {"compressor" : "xz"} ),
+    "zsttar": ( _make_tarball, {"compressor" : "zst"} ),
 }
 
 def get_archive_formats():
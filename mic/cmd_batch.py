@@ -0,0 +1,370 @@
+#!/usr/bin/python -tt
+# vim: ai ts=4 sts=4 et sw=4
+#
+# Copyright (c) 2012 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Implementation of subcmd: batch
+
+Every kickstart of the batch is built with the same 'mic create' command
+line, in a forked child with its own tmpdir, zypp lock and log file. The
+repo metadata is fetched once by the parent before the first build
+starts and inherited by the builds, which share the cachedir.
+
+A build is only started when there is a free worker, and when the loop
+devices and the disk space it is expected to use are not reserved by the
+builds already running.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import errno
+import signal
+import tempfile
+import multiprocessing
+
+from mic import msger, kickstart
+from mic.conf import configmgr
+from mic.utils import errors, misc
+from mic.cmd_serve import run_command, exit_code, _resolve_alias
+
+LOOP_MAX_PARAM = "/sys/module/loop/parameters/max_loop"
+
+class Build(object):
+    """One kickstart of the batch"""
+    def __init__(self, ksfile, name):
+        self.ksfile = ksfile
+        self.name = name
+        self.logfile = None
+        self.loops = 1
+        self.disk = 0
+        self.pid = None
+        self.code = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+def _read_kslist(path):
+    """Return the kickstarts listed in path, one per line"""
+    try:
+        with open(path) as kslist:
+            lines = [line.strip() for line in kslist]
+    except IOError, err:
+        raise errors.Usage("Can't read kickstart list %s: %s" % (path, err))
+
+    basedir = os.path.dirname(os.path.abspath(path))
+    return [os.path.join(basedir, line) for line in lines
+            if line and not line.startswith('#')]
+
+def _free_loop_devices():
+    """Return how many more loop devices can be set up, None if the kernel
+    creates them on demand
+    """
+    try:
+        with open(LOOP_MAX_PARAM) as param:
+            max_loop = int(param.read())
+    except (IOError, ValueError):
+        return None
+
+    if not max_loop:
+        return None
+    bound = len(glob.glob("/sys/block/loop*/loop/backing_file"))
+    return max(0, max_loop - bound)
+
+def _extra_repos(repo_opts):
+    """Parse the --repo options the same way 'mic create' does"""
+    extrarepos = dict(configmgr.create['extrarepos'])
+    for optvalue in repo_opts or []:
+        repo = {}
+        for item in optvalue.split(';'):
+            try:
+                key, val = item.split('=')
+            except ValueError:
+                continue
+            repo[key.strip()] = val.strip()
+        if 'name' in repo:
+            extrarepos[repo['name']] = repo
+    return extrarepos
+
+def _prepare(builds, args, cachedir):
+    """Estimate what each build needs and fetch the repo metadata of all
+    the kickstarts once
+    """
+    extrarepos = _extra_repos(args.repo)
+    repos = {}
+    for build in builds:
+        ksfile = misc.normalize_ksfile(build.ksfile, args.release, args.arch)
+        ks = kickstart.read_kickstart(ksfile)
+
+        parts = kickstart.get_partitions(ks)
+        if args.subcommand == 'fs':
+            build.loops = 0
+        else:
+            build.loops = max(1, len(parts))
+        build.disk = sum(int(part.size or 0) for part in parts) * 1024 * 1024
+
+        for repo in kickstart.get_repos(ks, extrarepos, args.ignore_ksrepo):
+            key = (repo.name, getattr(repo.baseurl, 'full', repo.baseurl))
+            repos.setdefault(key, repo)
+
+    if repos:
+        msger.info("Retrieving repo metadata for %d repos:" % len(repos))
+        misc.get_metadata_from_repos(repos.values(), cachedir)
+        msger.raw(" DONE")
+
+def _start(parser, build, argv):
+    """Fork the child running build and return its pid"""
+    # the child must not log before what is still queued
+    msger.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    code = 1
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        logfd = os.open(build.logfile,
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        os.dup2(logfd, 1)
+        os.dup2(logfd, 2)
+        os.close(logfd)
+        code = exit_code(run_command(parser, argv))
+    except SystemExit, err:
+        # msger.error() exits
+        code = exit_code(err.code)
+    finally:
+        try:
+            msger.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+def _wait():
+    """Wait for any build to finish, return its pid and exit code"""
+    while True:
+        try:
+            pid, status = os.wait()
+            break
+        except OSError, err:
+            if err.errno != errno.EINTR:
+                raise
+
+    if os.WIFEXITED(status):
+        return pid, os.WEXITSTATUS(status)
+    return pid, 128 + os.WTERMSIG(status)
+
+def _fits(build, running, jobs, loops_free, disk_free):
+    """Whether build can start next to the running ones"""
+    if len(running) >= jobs:
+        return False
+    if not running:
+        return True
+    if loops_free is not None and \
+       sum(b.loops for b in running) + build.loops > loops_free:
+        return False
+    return sum(b.disk for b in running) + build.disk <= disk_free
+
+def run_batch(parser, builds, template, jobs, tmpdir):
+    """Run the builds, at most jobs of them at a time"""
+    loops_free = _free_loop_devices()
+    disk_free = misc.get_filesystem_avail(tmpdir)
+    if loops_free is not None:
+        msger.info("%d loop devices available" % loops_free)
+
+    pending = list(builds)
+    running = {}
+    total = len(builds)
+    try:
+        while pending or running:
+            for build in list(pending):
+                if not _fits(build, running.values(), jobs,
+                             loops_free, disk_free):
+                    continue
+                if loops_free is not None and build.loops > loops_free:
+                    msger.warning("%s needs %d loop devices, only %d are "
+                                  "available" % (build.name, build.loops,
+                                                 loops_free))
+
+                argv = template + ['--tmpdir',
+                                   os.path.join(tmpdir, build.name),
+                                   build.ksfile]
+                build.started = time.time()
+                build.pid = _start(parser, build, argv)
+                running[build.pid] = build
+                pending.remove(build)
+                msger.info("[%d/%d] started %s, log: %s"
+                           % (total - len(pending), total, build.name,
+                              build.logfile))
+
+            pid, code = _wait()
+            build = running.pop(pid, None)
+            if build is None:
+                continue
+            build.code = code
+            build.finished = time.time()
+            msger.info("%s %s in %ds" % (build.name,
+                                         code and "failed" or "finished",
+                                         build.duration))
+    finally:
+        for pid in running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while running:
+            pid, code = _wait()
+            build = running.pop(pid, None)
+            if build is not None:
+                build.code = code
+                build.finished = time.time()
+
+def write_summary(builds, start, path):
+    """Print the timing of every build and save it as JSON to path"""
+    summary = []
+    msger.raw("\n%-32s %8s %10s %10s" % ("build", "status", "queued",
+                                         "duration"))
+    for build in builds:
+        if build.code is None:
+            status = "skipped"
+        elif build.code:
+            status = "failed"
+        else:
+            status = "ok"
+        queued = build.started and build.started - start or 0
+        msger.raw("%-32s %8s %9ds %9ds" % (build.name, status, queued,
+                                           build.duration))
+        summary.append({"name": build.name,
+                        "ksfile": build.ksfile,
+                        "log": build.logfile,
+                        "exit_code": build.code,
+                        "queued": round(queued, 1),
+                        "duration": round(build.duration, 1)})
+
+    elapsed = time.time() - start
+    busy = sum(build.duration for build in builds)
+    msger.raw("%d builds in %ds, %ds of build time"
+              % (len(builds), elapsed, busy))
+
+    with open(path, 'w') as wf:
+        json.dump({"elapsed": round(elapsed, 1), "builds": summary},
+                  wf, indent=2)
+
+def main(parser, args, argv):
+    """mic batch entry point."""
+    if args is None:
+        raise errors.Usage("Invalid arguments")
+
+    if os.geteuid() != 0:
+        msger.error("Root permission is required, abort")
+
+    template = args.command
+    if template and template[0] == '--':
+        template = template[1:]
+    template = _resolve_alias(parser, template)
+    if not template or template[0] != 'create':
+        raise errors.Usage("The batch command line must be a create command")
+
+    ksfiles = list(args.ksfiles)
+    if args.kslist:
+        ksfiles.extend(_read_kslist(args.kslist))
+    if not ksfiles:
+        raise errors.Usage("No kickstart to build")
+    for ksfile in ksfiles:
+        if not os.path.exists(ksfile):
+            raise errors.CreatorError("Can't find the file: %s" % ksfile)
+
+    # the kickstart is appended to the command line of every build
+    cmdargs = parser.parse_args(template + [ksfiles[0]])
+    if cmdargs.logfile:
+        raise errors.Usage("--logfile can't be shared by the builds, "
+                           "their logs are saved in %s" % args.logdir)
+    if cmdargs.tmpdir:
+        raise errors.Usage("--tmpdir is set for every build by mic batch")
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs < 1:
+        raise errors.Usage("Invalid number of jobs: %d" % jobs)
+    jobs = min(jobs, len(ksfiles))
+    if not [arg for arg in template if arg.startswith('--image-workers')]:
+        workers = max(1, multiprocessing.cpu_count() // jobs)
+        template = template + ['--image-workers', str(workers)]
+
+    if cmdargs.config:
+        configmgr.reset()
+        configmgr._siteconf = cmdargs.config
+    abspath = lambda pth: os.path.abspath(os.path.expanduser(pth))
+    cachedir = abspath(cmdargs.cachedir or configmgr.create['cachedir'])
+    tmpdir = configmgr.create['tmpdir']
+    for cdir in (cachedir, tmpdir):
+        if not os.path.isdir(cdir):
+            os.makedirs(cdir)
+    template = template + ['--cachedir', cachedir]
+
+    logdir = abspath(args.logdir)
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    builds = []
+    names = set()
+    for ksfile in ksfiles:
+        name = base = os.path.splitext(os.path.basename(ksfile))[0]
+        count = 1
+        while name in names:
+            count += 1
+            name = "%s-%d" % (base, count)
+        names.add(name)
+        build = Build(abspath(ksfile), name)
+        build.logfile = os.path.join(logdir, name + ".log")
+        builds.append(build)
+
+    start = time.time()
+    _prepare(builds, cmdargs, cachedir)
+
+    batchdir = tempfile.mkdtemp(prefix="batch-", dir=tmpdir)
+    try:
+        run_batch(parser, builds, template, jobs, batchdir)
+    finally:
+        write_summary(builds, start, os.path.join(logdir, "summary.json"))
+        # only what the builds left empty, never follow a stale mount
+        for build in builds:
+            for path in (os.path.join(batchdir, build.name, "build"),
+                         os.path.join(batchdir, build.name)):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+        try:
+            os.rmdir(batchdir)
+        except OSError:
+            pass
+
+    failed = [build.name for build in builds if build.code]
+    if failed:
+        raise errors.CreatorError("%d of %d builds failed: %s"
+                                  % (len(failed), len(builds),
+                                     ', '.join(failed)))
@@ -25,7 +25,7 @@ import pwd
 import argparse
 
 from mic import msger
-from mic.utils import errors, rpmmisc
+from mic.utils import errors, rpmmisc, runner
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
 
@@ -93,7 +93,14 @@ def main(parser, args, argv):
         configmgr.create['outdir'] = abspath(args.outdir)
     if args.cachedir is not None:
         configmgr.create['cachedir'] = abspath(args.cachedir)
-    os.environ['ZYPP_LOCKFILE_ROOT'] = configmgr.create['cachedir']
+    if args.tmpdir is not None:
+        configmgr.create['tmpdir'] = abspath(args.tmpdir)
+        # builds with their own tmpdir only share the cachedir, whose repo
+        # caches are published by rename and whose rpms are downloaded
+        # under a lock per file, so they get their own zypp lock
+        os.environ['ZYPP_LOCKFILE_ROOT'] = configmgr.create['tmpdir']
+    else:
+        os.environ['ZYPP_LOCKFILE_ROOT'] = configmgr.create['cachedir']
 
     for cdir in ('outdir', 'cachedir'):
         if os.path.exists(configmgr.create[cdir]) \
@@ -193,9 +200,24 @@ def main(parser, args, argv):
         configmgr.create['run_script'] = args.run_script
     if args.tpk_install:
         configmgr.create['tpk_install'] = args.tpk_install
-
+    if args.image_workers:
+        configmgr.create['image_workers'] = args.image_workers
+    if args.rootfs_cache:
+        configmgr.create['rootfs_cache'] = args.rootfs_cache
+    if args.base_layer:
+        if not os.path.exists(args.base_layer):
+            raise errors.Usage("Can't find the base layer: %s" % args.base_layer)
+        configmgr.create['base_layer'] = abspath(args.base_layer)
+    if args.timeline:
+        configmgr.create['timeline'] = abspath(args.timeline)
+
+    runner.reset_timeline()
     creater = createrClass()
-    creater.do_create(args)
+    try:
+        creater.do_create(args)
+    finally:
+        if configmgr.create['timeline']:
+            runner.save_timeline(configmgr.create['timeline'])
 
 def do_auto(parser, ksfile, argv):
         """${cmd_name}: auto detect image type from magic header
@@ -0,0 +1,264 @@
+#!/usr/bin/python -tt
+# vim: ai ts=4 sts=4 et sw=4
+#
+# Copyright (c) 2012 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Implementation of subcmd: serve
+
+The server loads the plugins, the backends and their bindings once, then
+runs every build job received on its unix socket in a forked child, so
+that each job starts warm but with its own copy of the global state.
+
+A job is one line of JSON sent by 'mic submit': the mic command line, the
+working directory and the environment of the client. The output of the
+job is streamed back on the connection, followed by JOB_STATUS and the
+exit code of the job.
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import struct
+import argparse
+
+from mic import msger
+from mic.utils import errors
+from mic.plugin import pluginmgr, PLUGIN_TYPES
+
+DEFAULT_SOCKET = "/var/run/mic.sock"
+# separates the output of a job from its exit code
+JOB_STATUS = "\0MIC-EXIT "
+
+# struct ucred of SO_PEERCRED: pid, uid, gid
+_UCRED_FORMAT = "3i"
+# python 2 doesn't define it, this is the value on linux
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+def _peer_uid(conn):
+    """Return the uid of the process connected on conn"""
+    cred = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                           struct.calcsize(_UCRED_FORMAT))
+    return struct.unpack(_UCRED_FORMAT, cred)[1]
+
+def _read_job(conn):
+    """Read the job request, a single line of JSON"""
+    data = ""
+    while not data.endswith("\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+
+    try:
+        job = json.loads(data)
+        argv = [str(arg) for arg in job["argv"]]
+    except (ValueError, KeyError, TypeError):
+        raise errors.Usage("Invalid job request")
+
+    return argv, str(job.get("cwd", "/")), job.get("env", {})
+
+def _resolve_alias(parser, argv):
+    """Replace the alias of the subcommand in argv by its real name"""
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            aliases = dict((sub.get_default('alias'), name)
+                           for name, sub in action.choices.items())
+            break
+    else:
+        return argv
+
+    argv = list(argv)
+    for i, arg in enumerate(argv):
+        if not arg.startswith('-'):
+            argv[i] = aliases.get(arg, arg)
+            break
+    return argv
+
+def exit_code(code):
+    """Map the code of a SystemExit to an exit status, like the python
+    interpreter does: None is success, a message is printed and fails
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+def run_command(parser, argv):
+    """Run one mic command line in the current process, the same way the
+    mic script does, and return its exit code
+    """
+    try:
+        args = parser.parse_args(_resolve_alias(parser, argv))
+        if args.module == "cmd_serve":
+            raise errors.Usage("Nested mic server is not allowed")
+
+        msger.disable_interactive()
+        if args.verbose:
+            msger.set_loglevel('VERBOSE')
+        if args.debug:
+            msger.set_loglevel('DEBUG')
+
+        module = __import__("mic.%s" % args.module, fromlist=[args.module])
+        return module.main(parser, args, argv) or 0
+    except SystemExit, err:
+        return exit_code(err.code)
+    except KeyboardInterrupt:
+        msger.error('\n^C catched, program aborted.')
+    except OSError, err:
+        msger.error(str(err))
+    except errors.Usage, usage:
+        msger.error(str(usage))
+    except errors.Abort, msg:
+        msger.info(str(msg))
+    except errors.CreatorError, err:
+        if msger.get_loglevel() == 'DEBUG':
+            import traceback
+            msger.error(traceback.format_exc())
+        else:
+            msger.error(str(err))
+
+    return 1
+
+def _run_job(parser, conn, argv, cwd, env):
+    """Run one mic command in the current (forked) process with the output
+    sent to conn and return its exit code
+    """
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+
+    os.environ.clear()
+    os.environ.update(dict((str(k), str(v)) for k, v in env.items()))
+
+    try:
+        os.chdir(cwd)
+    except OSError, err:
+        msger.error(str(err))
+
+    return run_command(parser, argv)
+
+def _handle_connection(parser, conn):
+    """Run the job of conn in a child process and report its exit code"""
+    if _peer_uid(conn) not in (0, os.geteuid()):
+        conn.sendall("Permission denied\n%s1" % JOB_STATUS)
+        return
+
+    try:
+        argv, cwd, env = _read_job(conn)
+    except errors.Usage, err:
+        conn.sendall("%s\n%s1" % (err, JOB_STATUS))
+        return
+
+    # the child must not log before what is still queued
+    msger.flush()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = exit_code(_run_job(parser, conn, argv, cwd, env))
+        except SystemExit, err:
+            # msger.error() exits
+            code = exit_code(err.code)
+        finally:
+            msger.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+            break
+        except OSError, err:
+            if err.errno != errno.EINTR:
+                raise
+
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = 128 + os.WTERMSIG(status)
+    msger.info("job %s finished with %d: %s" % (pid, code, ' '.join(argv)))
+    conn.sendall("%s%d" % (JOB_STATUS, code))
+
+def _reap_children(signum, frame):
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            return
+        if not pid:
+            return
+
+def serve(parser, sockpath):
+    """Accept jobs on the unix socket sockpath until interrupted"""
+    # import everything a build needs before forking the first job
+    for ptype in PLUGIN_TYPES:
+        pluginmgr.get_plugins(ptype)
+
+    if os.path.exists(sockpath):
+        os.unlink(sockpath)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0077)
+    try:
+        server.bind(sockpath)
+    finally:
+        os.umask(oldmask)
+    server.listen(16)
+
+    signal.signal(signal.SIGCHLD, _reap_children)
+    msger.info("mic server listening on %s" % sockpath)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+
+            # every connection gets a handler process, which forks the job
+            # and waits for it, so that jobs run concurrently
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                try:
+                    _handle_connection(parser, conn)
+                except Exception, err:
+                    msger.warning("job connection failed: %s" % err)
+                finally:
+                    os._exit(0)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(sockpath)
+
+def main(parser, args, argv):
+    """mic serve entry point."""
+    if args is None:
+        raise errors.Usage("Invalid arguments")
+
+    if os.geteuid() != 0:
+        msger.error("Root permission is required, abort")
+
+    serve(parser, os.path.abspath(args.socket))
@@ -0,0 +1,82 @@
+#!/usr/bin/python -tt
+# vim: ai ts=4 sts=4 et sw=4
+#
+# Copyright (c) 2012 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Implementation of subcmd: submit
+"""
+
+import os
+import sys
+import json
+import socket
+
+from mic import msger
+from mic.utils import errors
+from mic.cmd_serve import JOB_STATUS
+
+def submit(sockpath, argv, out=sys.stdout):
+    """Run the mic command line argv on the server listening on sockpath,
+    copy its output to out and return its exit code
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sockpath)
+    except socket.error, err:
+        raise errors.CreatorError("Cannot connect to mic server %s: %s"
+                                  % (sockpath, err))
+
+    try:
+        conn.sendall(json.dumps({"argv": argv,
+                                 "cwd": os.getcwd(),
+                                 "env": dict(os.environ)}) + "\n")
+
+        # hold back what could be the start of the status marker
+        pending = ""
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            pending += chunk
+            pos = pending.find(JOB_STATUS)
+            if pos < 0:
+                pos = max(0, len(pending) - len(JOB_STATUS))
+            out.write(pending[:pos])
+            out.flush()
+            pending = pending[pos:]
+    finally:
+        conn.close()
+
+    if not pending.startswith(JOB_STATUS):
+        raise errors.CreatorError("Connection to mic server lost")
+
+    return int(pending[len(JOB_STATUS):])
+
+def main(parser, args, argv):
+    """mic submit entry point."""
+    if args is None:
+        raise errors.Usage("Invalid arguments")
+
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        raise errors.Usage("No mic command to submit")
+
+    code = submit(os.path.abspath(args.socket), command)
+    if code:
+        msger.debug("job failed with exit code %d" % code)
+        sys.exit(code)
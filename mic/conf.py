@@ -77,6 +77,10 @@ class ConfigMgr(object):
                     "strict_mode": False,
                     "run_script": None,
                     "tpk_install": None,
+                    "image_workers": None, # None means the cpu count
+                    "rootfs_cache": False,
+                    "base_layer": None,
+                    "timeline": None,
                 },
                 'chroot': {
                     "saveto": None,
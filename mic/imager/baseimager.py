@@ -27,6 +27,9 @@ import re
 import tarfile
 import glob
 import json
+import multiprocessing
+import fcntl
+import hashlib
 from datetime import datetime
 
 import rpm
@@ -35,11 +38,62 @@ from mic import kickstart
 from mic import msger, __version__ as VERSION
 from mic.utils.errors import CreatorError, Abort
 from mic.utils import misc, grabber, runner, fs_related as fs
+from mic.utils.rootfs_cache import RootfsCache
 from mic.chroot import kill_proc_inchroot
 from mic.archive import get_archive_suffixes
 from mic.conf import configmgr
 #post script max run time
 MAX_RUN_TIME = 120
+# bumped when the key or the content of the base layers change
+LAYER_VERSION = 2
+# number of base layers kept, the least recently used are removed
+LAYER_KEEP = 4
+# files mount() and the package manager write for the current build only,
+# left out of the base layers
+LAYER_EXCLUDES = ("etc/fstab", "etc/mtab", "__catched_stderr.buf")
+
+def post_script_batches(scripts):
+    """Group the numbered post scripts into the batches run at once:
+    consecutive --nochroot --parallel scripts run together, any other
+    script runs alone
+    """
+    parallel = lambda s: not s.inChroot and getattr(s, 'parallel', False)
+    batches = []
+    for num, s in enumerate(scripts):
+        if parallel(s) and batches and parallel(batches[-1][-1][1]):
+            batches[-1].append((num, s))
+        else:
+            batches.append([(num, s)])
+    return batches
+
+def prune_layers(layersdir, keep=LAYER_KEEP, exclude=None):
+    """Remove all but the keep most recently used base layers of layersdir,
+    skipping the ones a build is copying or installing
+    """
+    layers = []
+    for key in os.listdir(layersdir):
+        layerdir = os.path.join(layersdir, key)
+        if key != exclude and os.path.isdir(layerdir) and \
+           os.path.exists(layerdir + ".json"):
+            layers.append((os.stat(layerdir).st_mtime, key))
+    layers.sort(reverse=True)
+
+    for _, key in layers[max(0, keep - (exclude and 1 or 0)):]:
+        layerdir = os.path.join(layersdir, key)
+        # the lock file is kept, builds may be waiting on it
+        lockfd = os.open(layerdir + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(lockfd)
+            continue
+        try:
+            shutil.rmtree(layerdir, ignore_errors=True)
+            os.unlink(layerdir + ".json")
+        except OSError:
+            pass
+        finally:
+            os.close(lockfd)
 
 class BaseImageCreator(object):
     """Installs a system to a chroot directory.
@@ -95,6 +149,10 @@ class BaseImageCreator(object):
         self._need_copy_kernel = False
         # setup tmpfs tmpdir when enabletmpfs is True
         self.enabletmpfs = False
+        # how many partition images are post-processed at once
+        self.image_workers = None
+        self.rootfs_cache = False
+        self.base_layer = None
 
         if createopts:
             # Mapping table for variables that have different names.
@@ -119,11 +177,18 @@ class BaseImageCreator(object):
                 if '@NAME@' in self.pack_to:
                     self.pack_to = self.pack_to.replace('@NAME@', self.name)
                 (tar, ext) = os.path.splitext(self.pack_to)
-                if ext in (".gz", ".bz2", ".lzo", ".bz") and tar.endswith(".tar"):
+                if ext in (".gz", ".bz2", ".lzo", ".bz", ".xz", ".zst") and tar.endswith(".tar"):
                     ext = ".tar" + ext
                 if ext not in get_archive_suffixes():
                     self.pack_to += ".tar"
 
+        try:
+            self.image_workers = max(1, int(self.image_workers or
+                                            multiprocessing.cpu_count()))
+        except ValueError:
+            raise CreatorError("Invalid number of image workers: %s"
+                               % self.image_workers)
+
         self._dep_checks = ["ls", "bash", "cp", "echo", "modprobe"]
 
         # Output image file names
@@ -137,6 +202,9 @@ class BaseImageCreator(object):
 
         self._recording_pkgs = []
 
+        # duration and output size of every %post script
+        self.post_script_stats = []
+
         # available size in root fs, init to 0
         self._root_fs_avail = 0
 
@@ -331,16 +399,13 @@ class BaseImageCreator(object):
             contfile = os.path.join(destdir, self.name + '.files')
             f = open(contfile, "w")
 
-            for pkg in pkgs:
-                content = pkg + '\n'
-
-                pkgcont = self._pkgs_content[pkg]
-                content += '    '
-                content += '\n    '.join(pkgcont)
-                content += '\n'
-
-                content += '\n'
-                f.write(content)
+            if hasattr(self._pkgs_content, 'write'):
+                self._pkgs_content.write(f, pkgs)
+            else:
+                for pkg in pkgs:
+                    f.write(pkg + '\n    ')
+                    f.write('\n    '.join(self._pkgs_content[pkg]))
+                    f.write('\n\n')
             f.close()
             self.outimage.append(contfile)
 
@@ -1024,6 +1089,155 @@ class BaseImageCreator(object):
                     fpath = os.path.join(root, fname)
                     self._attachment.append(fpath)
 
+    def __setup_pkg_manager(self, repo_urls):
+        def get_ssl_verify(ssl_verify=None):
+            if ssl_verify is not None:
+                return not ssl_verify.lower().strip() == 'no'
+            else:
+                return not self.ssl_verify.lower().strip() == 'no'
+
+        pkg_manager = self.get_pkg_manager()
+        pkg_manager.setup()
+
+        if hasattr(self, 'install_pkgs') and self.install_pkgs:
+            if 'debuginfo' in self.install_pkgs:
+                pkg_manager.install_debuginfo = True
+
+        for repo in kickstart.get_repos(self.ks, repo_urls, self.ignore_ksrepo):
+            (name, baseurl, mirrorlist, inc, exc,
+             proxy, proxy_username, proxy_password, debuginfo,
+             source, gpgkey, disable, ssl_verify, nocache,
+             cost, priority) = repo
+
+            ssl_verify = get_ssl_verify(ssl_verify)
+            yr = pkg_manager.addRepository(name, baseurl, mirrorlist, proxy,
+                        proxy_username, proxy_password, inc, exc, ssl_verify,
+                        nocache, cost, priority)
+
+        return pkg_manager
+
+    def __layer_key(self, base_ks):
+        """The key of the base layer: its package selection, the repo
+        metadata and the rpm macros it is installed with"""
+        sha = hashlib.sha256("mic-layer %d\n" % LAYER_VERSION)
+        for pkg in sorted(kickstart.get_packages(base_ks,
+                                                 self._get_required_packages())):
+            sha.update("pkg %s\n" % pkg)
+        for pkg in sorted(kickstart.get_excluded(base_ks,
+                                                 self._get_excluded_packages())):
+            sha.update("exclude %s\n" % pkg)
+        for group in kickstart.get_groups(base_ks):
+            sha.update("group %s %s\n" % (group.name, group.include))
+        for repo in sorted(self.repomd or [], key=lambda r: r["name"]):
+            sha.update("repo %s %s %s\n" % (repo["name"], repo["baseurl"],
+                                            repo["primary_checksum"]))
+        sha.update("arch %s\n" % self.target_arch)
+        for macro in ("_excludedocs", "_install_langs"):
+            sha.update("macro %s=%s\n"
+                       % (macro, rpm.expandMacro("%%{?%s}" % macro)))
+        return sha.hexdigest()
+
+    def __build_base_layer(self, base_ks, repo_urls, layerdir):
+        """Install the packages of base_ks into the install root and save it
+        as layerdir. This runs in a child process, the package manager
+        state can't be reset for the install of the delta packages.
+        """
+        # the child must not log before what is still queued
+        msger.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                pkg_manager = self.__setup_pkg_manager(repo_urls)
+                self.ks = base_ks
+                self._required_pkgs = kickstart.get_packages(base_ks,
+                                            self._get_required_packages())
+                self._excluded_pkgs = kickstart.get_excluded(base_ks,
+                                            self._get_excluded_packages())
+                self._required_groups = kickstart.get_groups(base_ks)
+                try:
+                    self.__select_packages(pkg_manager)
+                    self.__select_groups(pkg_manager)
+                    self.__deselect_packages(pkg_manager)
+                    if self.target_arch:
+                        pkg_manager._add_prob_flags(
+                                            rpm.RPMPROB_FILTER_IGNOREARCH)
+                    if self.multiple_partitions:
+                        pkg_manager._add_prob_flags(
+                                            rpm.RPMPROB_FILTER_DISKSPACE)
+                    pkg_manager.runInstall()
+                    licenses = pkg_manager.getPkgsLicense()
+                finally:
+                    pkg_manager.close()
+
+                if glob.glob(self._instroot + "/tmp/.postscript/error/*_error*"):
+                    raise CreatorError("scriptlet errors occurred in the "
+                                       "base layer")
+
+                tmpdir = tempfile.mkdtemp(prefix=os.path.basename(layerdir),
+                                          dir=os.path.dirname(layerdir))
+                try:
+                    fs.copy_tree(self._instroot, tmpdir,
+                                 skip=("proc", "sys", "dev"))
+                    for path in LAYER_EXCLUDES:
+                        path = os.path.join(tmpdir, path)
+                        if os.path.lexists(path):
+                            os.unlink(path)
+                    with open(layerdir + ".json", "w") as wf:
+                        json.dump({"licenses": licenses}, wf)
+                    os.rename(tmpdir, layerdir)
+                except:
+                    shutil.rmtree(tmpdir, ignore_errors = True)
+                    raise
+                code = 0
+            except KeyboardInterrupt:
+                pass
+            except Exception, err:
+                msger.warning("Failed to install the base layer: %s" % err)
+            finally:
+                msger.flush()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise CreatorError("Failed to install the base layer %s"
+                               % self.base_layer)
+
+    def __install_base_layer(self, repo_urls):
+        """Set the install root up from the base layer, installing it first
+        if no build did it yet, and return its key and package licenses
+        """
+        base_ks = kickstart.read_kickstart(self.base_layer)
+        key = self.__layer_key(base_ks)
+        layersdir = os.path.join(self.cachedir, "layers")
+        layerdir = os.path.join(layersdir, key)
+        fs.makedirs(layersdir)
+
+        # concurrent builds install a missing layer only once
+        lockfd = os.open(layerdir + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_SH)
+            if not os.path.isdir(layerdir):
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+
+            if os.path.isdir(layerdir):
+                msger.info("Copying base layer %s ..." % key[:12])
+                # recently used layers are pruned last
+                os.utime(layerdir, None)
+                fs.copy_tree(layerdir, self._instroot)
+            else:
+                msger.info("Installing base layer %s ..." % key[:12])
+                self.__build_base_layer(base_ks, repo_urls, layerdir)
+        finally:
+            os.close(lockfd)
+
+        prune_layers(layersdir, exclude=key)
+
+        with open(layerdir + ".json") as rf:
+            return key, json.load(rf)["licenses"]
+
     def install(self, repo_urls=None):
         """Install packages into the install root.
 
@@ -1055,12 +1269,6 @@ class BaseImageCreator(object):
             else:
                 msger.info("%s is not found." % filepath)
 
-        def get_ssl_verify(ssl_verify=None):
-            if ssl_verify is not None:
-                return not ssl_verify.lower().strip() == 'no'
-            else:
-                return not self.ssl_verify.lower().strip() == 'no'
-
         # initialize pkg list to install
         if self.ks:
             self.__sanity_check()
@@ -1078,24 +1286,6 @@ class BaseImageCreator(object):
         if not repo_urls:
             repo_urls = self.extrarepos
 
-        pkg_manager = self.get_pkg_manager()
-        pkg_manager.setup()
-
-        if hasattr(self, 'install_pkgs') and self.install_pkgs:
-            if 'debuginfo' in self.install_pkgs:
-                pkg_manager.install_debuginfo = True
-
-        for repo in kickstart.get_repos(self.ks, repo_urls, self.ignore_ksrepo):
-            (name, baseurl, mirrorlist, inc, exc,
-             proxy, proxy_username, proxy_password, debuginfo,
-             source, gpgkey, disable, ssl_verify, nocache,
-             cost, priority) = repo
-
-            ssl_verify = get_ssl_verify(ssl_verify)
-            yr = pkg_manager.addRepository(name, baseurl, mirrorlist, proxy,
-                        proxy_username, proxy_password, inc, exc, ssl_verify,
-                        nocache, cost, priority)
-
         if kickstart.exclude_docs(self.ks):
             rpm.addMacro("_excludedocs", "1")
         rpm.addMacro("_dbpath", "/var/lib/rpm")
@@ -1103,6 +1293,22 @@ class BaseImageCreator(object):
         if kickstart.inst_langs(self.ks) != None:
             rpm.addMacro("_install_langs", kickstart.inst_langs(self.ks))
 
+        layer = None
+        layer_licenses = {}
+        if self.base_layer:
+            layer, layer_licenses = self.__install_base_layer(repo_urls)
+
+        pkg_manager = self.__setup_pkg_manager(repo_urls)
+
+        rootfs_cache = None
+        if self.rootfs_cache:
+            macros = {"target_arch": self.target_arch, "base_layer": layer}
+            for macro in ("_excludedocs", "_install_langs"):
+                macros[macro] = rpm.expandMacro("%%{?%s}" % macro)
+            rootfs_cache = RootfsCache(os.path.join(self.cachedir, "rootfs"),
+                                       macros)
+            pkg_manager.rootfs_cache = rootfs_cache
+
         try:
             self.__preinstall_packages(pkg_manager)
             self.__select_packages(pkg_manager)
@@ -1128,8 +1334,12 @@ class BaseImageCreator(object):
         except  KeyboardInterrupt:
             raise
         else:
-            self._pkgs_content = pkg_manager.getAllContent()
+            self._pkgs_content = pkg_manager.getAllContent(
+                                     files='content' in self._recording_pkgs)
             self._pkgs_license = pkg_manager.getPkgsLicense()
+            # the packages of the base layer are not in the transaction
+            for license, pkgs in layer_licenses.items():
+                self._pkgs_license.setdefault(license, []).extend(pkgs)
             self._pkgs_vcsinfo = pkg_manager.getVcsInfo()
             self.__attachment_packages(pkg_manager)
         finally:
@@ -1138,7 +1348,10 @@ class BaseImageCreator(object):
         if checkScriptletError(self._instroot + "/tmp/.postscript/error/", "_error"):
             showErrorInfo(self._instroot + "/tmp/.preload_install_error")
             raise CreatorError('scriptlet errors occurred')
-            
+
+        if rootfs_cache:
+            rootfs_cache.save(self._instroot)
+
         # hook post install
         self.postinstall()
 
@@ -1171,17 +1384,13 @@ class BaseImageCreator(object):
             for item in os.listdir(self._imgdir):
                 sub = os.path.splitext(item)[1]
                 if sub == ".img":
-                    shutil.move(os.path.join(self._imgdir, item),
-                                os.path.join(self._instroot + "/tmp", item))
+                    fs.sparse_move(os.path.join(self._imgdir, item),
+                                   os.path.join(self._instroot + "/tmp", item))
             oldoutdir = os.getcwd()
             os.chdir(self._instroot + "/tmp")
             try:
                 try:
-                    p = subprocess.Popen([s.interp, path],
-                                       stdout = subprocess.PIPE,
-                                       stderr = subprocess.STDOUT)
-                    while p.poll() == None:
-                        msger.info(p.stdout.readline().strip())
+                    runner.stream([runner.Streamed([s.interp, path])])
                 except OSError, (err, msg):
                     raise CreatorError("Failed to execute %%sign script "
                                        "with '%s' : %s" % (s.interp, msg))
@@ -1189,52 +1398,80 @@ class BaseImageCreator(object):
                 os.chdir(oldoutdir)
                 os.unlink(path)
                 for item in os.listdir(self._instroot + "/tmp"):
-                    shutil.move(os.path.join(self._instroot + "/tmp", item),
-                                os.path.join(self._imgdir, item))
+                    fs.sparse_move(os.path.join(self._instroot + "/tmp", item),
+                                   os.path.join(self._imgdir, item))
     def __run_post_scripts(self):
         msger.info("Running post scripts ...")
         if os.path.exists(self._instroot + "/tmp"):
             shutil.rmtree(self._instroot + "/tmp")
         os.mkdir (self._instroot + "/tmp", 0755)
-        for s in kickstart.get_post_scripts(self.ks):
-            (fd, path) = tempfile.mkstemp(prefix = "ks-postscript-",
-                                          dir = self._instroot + "/tmp")
 
-            s.script = s.script.replace("\r", "")
-            os.write(fd, s.script)
-            os.close(fd)
-            os.chmod(path, 0700)
-
-            env = self._get_post_scripts_env(s.inChroot)
-            if 'PATH' not in env:
-                env['PATH'] = '/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin'
+        for batch in post_script_batches(kickstart.get_post_scripts(self.ks)):
+            self.__run_post_script_batch(batch)
 
-            if not s.inChroot:
-                preexec = None
-                script = path
-            else:
-                preexec = self._chroot
-                script = "/tmp/" + os.path.basename(path)
+    def __run_post_script_batch(self, batch):
+        procs = []
+        paths = []
+        try:
+            for num, s in batch:
+                (fd, path) = tempfile.mkstemp(prefix = "ks-postscript-",
+                                              dir = self._instroot + "/tmp")
+                paths.append(path)
+
+                s.script = s.script.replace("\r", "")
+                os.write(fd, s.script)
+                os.close(fd)
+                os.chmod(path, 0700)
+
+                env = self._get_post_scripts_env(s.inChroot)
+                if 'PATH' not in env:
+                    env['PATH'] = '/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin'
+
+                if not s.inChroot:
+                    preexec = None
+                    script = path
+                else:
+                    preexec = self._chroot
+                    script = "/tmp/" + os.path.basename(path)
 
-            start_time = time.time()
-            try:
                 try:
-                    p = subprocess.Popen([s.interp, script],
-                                       preexec_fn = preexec,
-                                       env = env,
-                                       stdout = subprocess.PIPE,
-                                       stderr = subprocess.STDOUT)
-                    while p.poll() == None:
-                    	msger.info(p.stdout.readline().strip())
-                        end_time = time.time()
-                        if (end_time - start_time)/60 > MAX_RUN_TIME:
-                            raise CreatorError("Your post script is executed more than "+MAX_RUN_TIME+"mins, please check it!")
+                    procs.append(runner.Streamed([s.interp, script],
+                                                 label = "post %d" % num,
+                                                 preexec_fn = preexec,
+                                                 env = env))
                 except OSError, (err, msg):
                     raise CreatorError("Failed to execute %%post script "
                                        "with '%s' : %s" % (s.interp, msg))
-            finally:
+
+            if len(procs) > 1:
+                handler = lambda proc, line: \
+                          msger.info("[%s] %s" % (proc.label, line))
+            else:
+                handler = lambda proc, line: msger.info(line.strip())
+            runner.stream(procs, MAX_RUN_TIME * 60, handler)
+        except:
+            # a later script of the batch failed to start
+            for proc in procs:
+                proc.abort()
+            raise
+        finally:
+            for path in paths:
                 os.unlink(path)
 
+        for proc in procs:
+            self.post_script_stats.append({"script": proc.label,
+                                           "duration": proc.duration,
+                                           "outsize": proc.outsize,
+                                           "returncode": proc.returncode})
+            msger.verbose("%s script finished with %d in %.1fs, "
+                          "%d bytes of output"
+                          % (proc.label, proc.returncode, proc.duration,
+                             proc.outsize))
+            if proc.timedout:
+                raise CreatorError("Your post script is executed more than "
+                                   "%d mins, please check it!"
+                                   % MAX_RUN_TIME)
+
     def __save_repo_keys(self, repodata):
         if not repodata:
             return None
@@ -1338,8 +1575,8 @@ class BaseImageCreator(object):
                 tmp_cpio = self.__builddir + "/tmp-cpio"
                 msger.info("Copy cpio image from %s to %s." %(tmp_cpio, self._imgdir))
                 try:
-                    shutil.copyfile(os.path.join(tmp_cpio, item['name']),os.path.join(self._imgdir, item['name']))
-                except IOError:
+                    fs.sparse_copy(os.path.join(tmp_cpio, item['name']),os.path.join(self._imgdir, item['name']))
+                except (IOError, OSError):
                     raise errors.CreatorError("Copy cpio image error")
                 os.remove(os.path.join(tmp_cpio, item['name']))
                 if not os.listdir(tmp_cpio):
@@ -1379,11 +1616,20 @@ class BaseImageCreator(object):
         runner.quiet('sync')
 
         misc.check_space_pre_cp(self._outdir, destdir)
+        files = []
         for f in os.listdir(self._outdir):
-            shutil.move(os.path.join(self._outdir, f),
-                        os.path.join(destdir, f))
+            fs.sparse_move(os.path.join(self._outdir, f),
+                           os.path.join(destdir, f))
+            misc.move_file_hashes(os.path.join(self._outdir, f),
+                                  os.path.join(destdir, f))
             self.outimage.append(os.path.join(destdir, f))
-            self.do_genchecksum(os.path.join(destdir, f))
+            files.append(os.path.join(destdir, f))
+
+        if self._genchecksum:
+            # hash all the images in parallel, do_genchecksum hits the cache
+            misc.get_file_hashes(filter(os.path.isfile, files))
+        for f in files:
+            self.do_genchecksum(f)
 
     def print_outimage_info(self):
         msg = "The new image can be found here:\n"
@@ -1468,16 +1714,16 @@ class BaseImageCreator(object):
             outimages.append(_rpath(newf))
 
         # generate MD5SUMS SHA1SUMS SHA256SUMS
+        files = [f for f in sorted(os.listdir(destdir))
+                 if not f.endswith('SUMS') and \
+                    not os.path.isdir(os.path.join(destdir, f))]
+        # read every file once for all the three sums
+        file_hashes = misc.get_file_hashes(map(_rpath, files))
+
         def generate_hashsum(hash_name, hash_method):
             with open(_rpath(hash_name), "w") as wf:
-                for f in os.listdir(destdir):
-                    if f.endswith('SUMS'):
-                        continue
-
-                    if os.path.isdir(os.path.join(destdir, f)):
-                        continue
-
-                    hash_value = hash_method(_rpath(f))
+                for f in files:
+                    hash_value = file_hashes[_rpath(f)][hash_method]
                     # There needs to be two spaces between the sum and
                     # filepath to match the syntax with md5sum,sha1sum,
                     # sha256sum. This way also *sum -c *SUMS can be used.
@@ -1486,9 +1732,9 @@ class BaseImageCreator(object):
             outimages.append("%s/%s" % (destdir, hash_name))
 
         hash_dict = {
-                     'MD5SUMS'    : misc.get_md5sum,
-                     'SHA1SUMS'   : misc.get_sha1sum,
-                     'SHA256SUMS' : misc.get_sha256sum
+                     'MD5SUMS'    : 'md5',
+                     'SHA1SUMS'   : 'sha1',
+                     'SHA256SUMS' : 'sha256'
                     }
 
         for k, v in hash_dict.items():
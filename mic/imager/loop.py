@@ -17,7 +17,6 @@
 
 import os
 import glob
-import shutil
 
 from mic import kickstart, msger
 from mic.utils.errors import CreatorError, MountError
@@ -319,7 +318,7 @@ class LoopImageCreator(BaseImageCreator):
 
     def _base_on(self, base_on=None):
         if base_on and self._image != base_on:
-            shutil.copyfile(base_on, self._image)
+            fs.sparse_copy(base_on, self._image)
 
     def _check_imgdir(self):
         if self._imgdir is None:
@@ -399,25 +398,43 @@ class LoopImageCreator(BaseImageCreator):
             except:
                 pass
 
-    def _stage_final_image(self):
+    def _run_image_jobs(self, func, items):
+        """Run func on each item with a pool of image_workers threads
 
-        if self.pack_to or self.shrink_image:
-            self._resparse(0)
-        else:
-            self._resparse()
-
-        for item in self._instloops:
-            imgfile = os.path.join(self._imgdir, item['name'])
-
-            if item['aft_fstype'] in AFTER_MNT_FS.keys():
-                mountpoint = misc.mkdtemp()
-                ext4img = os.path.join(self._imgdir, item['name'])
-                runner.show('mount -t ext4 %s %s' % (ext4img, mountpoint))
-                runner.show('ls -al %s' % (mountpoint))
-#                item['loop'].mount(None, 'not_create')
-#                point_mnt = os.path.join(self._instroot, item['mountpoint'].lstrip('/'))
+        The results are returned in the order of items. Every job is waited
+        for before the first failure is raised, so that none of them is
+        still working on the image directory when it gets cleaned up.
+        """
+        items = list(items)
+        workers = min(self.image_workers, len(items))
+        if workers < 2:
+            return [func(item) for item in items]
 
-                fs_suffix = AFTER_MNT_FS[item['aft_fstype']]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(func, (item,)) for item in items]
+        finally:
+            pool.close()
+            pool.join()
+
+        # AsyncResult.get() re-raises the exception of a failed job
+        return [result.get() for result in results]
+
+    def _stage_loop_image(self, item):
+        """Post-process one partition image, return its output file name"""
+        imgfile = os.path.join(self._imgdir, item['name'])
+
+        if item['aft_fstype'] in AFTER_MNT_FS.keys():
+            mountpoint = misc.mkdtemp()
+            ext4img = os.path.join(self._imgdir, item['name'])
+            runner.show('mount -t ext4 %s %s' % (ext4img, mountpoint))
+            runner.show('ls -al %s' % (mountpoint))
+#            item['loop'].mount(None, 'not_create')
+#            point_mnt = os.path.join(self._instroot, item['mountpoint'].lstrip('/'))
+
+            fs_suffix = AFTER_MNT_FS[item['aft_fstype']]
+            try:
                 if item['aft_fstype'] == "squashfs":
 #                    fs.mksquashfs(mountpoint, self._outdir+"/"+item['label']+fs_suffix)
                     args = "mksquashfs " + mountpoint + " " + self._imgdir+"/"+item['label']+fs_suffix
@@ -439,25 +456,37 @@ class LoopImageCreator(BaseImageCreator):
                     runner.show("%s --help" % fullpathmkvdfs)
 #                    fs.mkvdfs(mountpoint, self._outdir+"/"+item['label']+fs_suffix, vdfsopts)
                     runner.show('%s %s -r %s %s' % (fullpathmkvdfs, vdfsopts, mountpoint, self._imgdir+"/"+item['label']+fs_suffix))
-
+            finally:
                 runner.show('umount %s' % mountpoint)
 #               os.unlink(mountpoint)
-                runner.show('mv %s %s' % (self._imgdir+"/"+item['label']+fs_suffix, self._imgdir+"/"+item['label']+".img") )
-                runner.show('ls -al %s' % self._imgdir)
-
-            if item['fstype'] == "ext4":
-                if not item['cpioopts']:
-                    runner.show('/sbin/tune2fs -O ^huge_file,extents,uninit_bg %s '
-                            % imgfile)
-                    runner.quiet(["/sbin/e2fsck", "-f", "-y", imgfile])
+            runner.show('mv %s %s' % (self._imgdir+"/"+item['label']+fs_suffix, self._imgdir+"/"+item['label']+".img") )
+            runner.show('ls -al %s' % self._imgdir)
+
+        if item['fstype'] == "ext4":
+            if not item['cpioopts']:
+                runner.show('/sbin/tune2fs -O ^huge_file,extents,uninit_bg %s '
+                        % imgfile)
+                runner.quiet(["/sbin/e2fsck", "-f", "-y", imgfile])
+        if self.compress_image:
+            compressing(imgfile, self.compress_image)
+            return '.'.join([item['name'], self.compress_image])
+
+        return item['name']
+
+    def _stage_final_image(self):
+
+        if self.pack_to or self.shrink_image:
+            self._resparse(0)
+        else:
+            self._resparse()
+
+        # the partition images are independent of each other, post-process
+        # them concurrently and merge the results back in partition order
+        results = self._run_image_jobs(self._stage_loop_image, self._instloops)
+        for item, imgname in zip(self._instloops, results):
             self.image_files.setdefault('partitions', {}).update(
                     {item['mountpoint']: item['label']})
-            if self.compress_image:
-                compressing(imgfile, self.compress_image)
-                self.image_files.setdefault('image_files', []).append(
-                                '.'.join([item['name'], self.compress_image]))
-            else:
-                self.image_files.setdefault('image_files', []).append(item['name'])
+            self.image_files.setdefault('image_files', []).append(imgname)
 
         for item in os.listdir(self._imgdir):
             imgfile = os.path.join(self._imgdir, item)
@@ -467,8 +496,10 @@ class LoopImageCreator(BaseImageCreator):
         self.run_sign_scripts()
         if not self.pack_to:
             for item in os.listdir(self._imgdir):
-                shutil.move(os.path.join(self._imgdir, item),
-                            os.path.join(self._outdir, item))
+                fs.sparse_move(os.path.join(self._imgdir, item),
+                               os.path.join(self._outdir, item))
+                misc.move_file_hashes(os.path.join(self._imgdir, item),
+                                      os.path.join(self._outdir, item))
         else:
             msger.info("Pack all loop images together to %s" % self.pack_to)
             dstfile = os.path.join(self._outdir, self.pack_to)
@@ -498,7 +529,7 @@ class LoopImageCreator(BaseImageCreator):
                 continue
             dpath = os.path.join(self._imgdir, os.path.basename(item))
             msger.verbose("Copy attachment %s to %s" % (item, dpath))
-            shutil.copy(item, dpath)
+            fs.sparse_copy(item, dpath)
 
     def create_manifest(self):
         if self.compress_image:
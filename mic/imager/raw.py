@@ -20,7 +20,7 @@ import stat
 import shutil
 
 from mic import kickstart, msger
-from mic.utils import fs_related, runner, misc
+from mic.utils import fs_related, runner, misc, bmap
 from mic.utils.partitionedfs import PartitionedMount
 from mic.utils.errors import CreatorError, MountError
 from mic.imager.baseimager import BaseImageCreator
@@ -61,7 +61,7 @@ class RawImageCreator(BaseImageCreator):
         #self.getsource = False
         #self.listpkg = False
 
-        self._dep_checks.extend(["sync", "kpartx", "parted"])
+        self._dep_checks.extend(["sync", "kpartx"])
         if self._need_extlinux:
             self._dep_checks.extend(["extlinux"])
 
@@ -485,7 +485,8 @@ class RawImageCreator(BaseImageCreator):
                 src = os.path.join(self.__imgdir, imgfile)
                 dst = os.path.join(self._outdir, imgfile)
                 msger.debug("moving %s to %s" % (src,dst))
-                shutil.move(src,dst)
+                fs_related.sparse_move(src, dst)
+                misc.move_file_hashes(src, dst)
 
         self._write_image_xml()
 
@@ -531,6 +532,10 @@ class RawImageCreator(BaseImageCreator):
         xml += "  <storage>\n"
 
         if self.checksum is True:
+            # hash all the disks in parallel, the loop below hits the cache
+            misc.get_file_hashes([self._full_path(self._outdir, name,
+                                                  self.__disk_format)
+                                  for name in self.__disks.keys()])
             for name in self.__disks.keys():
                 diskpath = self._full_path(self._outdir, name, \
                                            self.__disk_format)
@@ -541,12 +546,12 @@ class RawImageCreator(BaseImageCreator):
                 xml += "    <disk file='%s' use='system' format='%s'>\n" \
                        % (full_name, self.__disk_format)
 
-                hashes = misc.calc_hashes(diskpath, ('sha1', 'sha256'))
+                hashes = misc.get_file_hashes([diskpath])[diskpath]
 
                 xml +=  "      <checksum type='sha1'>%s</checksum>\n" \
-                        % hashes[0]
+                        % hashes['sha1']
                 xml += "      <checksum type='sha256'>%s</checksum>\n" \
-                       % hashes[1]
+                       % hashes['sha256']
                 xml += "    </disk>\n"
         else:
             for name in self.__disks.keys():
@@ -587,11 +592,23 @@ class RawImageCreator(BaseImageCreator):
                                             os.path.basename(bmap_file)})
 
             msger.debug("Generating block map file '%s'" % bmap_file)
-            
-            bmaptoolcmd = misc.find_binary_path('bmaptool')
-            rc = runner.show([bmaptoolcmd, 'create', image, '-o', bmap_file])
-            if rc != 0:
-                raise CreatorError("Failed to create bmap file: %s" % bmap_file)
+
+            # the image checksums come for free while the mapped blocks
+            # are read, the holes are hashed without reading them
+            if self.checksum or self._genchecksum or \
+               getattr(self, 'release', None) is not None:
+                hash_names = misc.HASH_NAMES
+            else:
+                hash_names = ()
+
+            try:
+                hashes = bmap.create_bmap(image, bmap_file,
+                                          hash_names = hash_names)
+            except (IOError, OSError), err:
+                raise CreatorError("Failed to create bmap file %s: %s" \
+                                   % (bmap_file, err))
+            if hashes:
+                misc.cache_file_hashes(image, hashes)
 
     def create_manifest(self):
         if self.compress_image:
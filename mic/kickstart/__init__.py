@@ -70,6 +70,29 @@ class AttachmentSection(kssections.Section):
     def handleHeader(self, lineno, args):
         kssections.Section.handleHeader(self, lineno, args)
 
+class PostScriptSection(kssections.PostScriptSection):
+    """ %post with --parallel, which marks a --nochroot script that can
+    run at the same time as the --parallel scripts next to it
+    """
+    def _getParser(self):
+        op = kssections.PostScriptSection._getParser(self)
+        op.add_option("--parallel", dest="parallel", action="store_true",
+                      default=False)
+        return op
+
+    def handleHeader(self, lineno, args):
+        kssections.PostScriptSection.handleHeader(self, lineno, args)
+        (opts, extra) = self._getParser().parse_args(args=args[1:],
+                                                     lineno=lineno)
+        self._parallel = opts.parallel
+
+    def finalize(self):
+        count = len(self.handler.scripts) if self.handler else 0
+        kssections.PostScriptSection.finalize(self)
+        if self.handler and len(self.handler.scripts) > count:
+            self.handler.scripts[-1].parallel = getattr(self, '_parallel',
+                                                        False)
+
 def apply_wrapper(func):
     def wrapper(*kargs, **kwargs):
         try:
@@ -117,6 +140,8 @@ def read_kickstart(path):
     ks = ksparser.KickstartParser(KSHandlers(), errorsAreFatal=False)
     ks.registerSection(PrepackageSection(ks.handler))
     ks.registerSection(AttachmentSection(ks.handler))
+    ks.registerSection(PostScriptSection(ks.handler,
+                                         dataObj=ksparser.Script))
 
     try:
         ks.readKickstart(path)
@@ -888,6 +913,7 @@ def resolve_groups(creatoropts, repometadata):
             get_pkglist_handler = misc.get_pkglist_in_patterns
 
         if groupfile:
+            packages = set(ks.handler.packages.packageList)
             i = 0
             while True:
                 if i >= len(ks.handler.packages.groupList):
@@ -898,7 +924,8 @@ def resolve_groups(creatoropts, repometadata):
                 if pkglist:
                     del ks.handler.packages.groupList[i]
                     for pkg in pkglist:
-                        if pkg not in ks.handler.packages.packageList:
+                        if pkg not in packages:
+                            packages.add(pkg)
                             ks.handler.packages.packageList.append(pkg)
                 else:
                     i = i + 1
@@ -32,8 +32,12 @@
 """
 import os
 import sys
+import time
+import Queue
 import logging
+import collections
 import tempfile
+import threading
 
 __ALL__ = [
     'get_loglevel',
@@ -68,6 +72,14 @@ RESET_SEQ = "\033[0m"
 RAWTEXT = 25
 VERBOSE = 15
 
+# logged records are written to the logfile after LOG_BATCH_INTERVAL
+# seconds at most, or as soon as LOG_BATCH_SIZE of them are waiting
+LOG_BATCH_INTERVAL = 0.5
+LOG_BATCH_SIZE = 1024
+# the last LOG_BUFFER_SIZE records emitted before a logfile is assigned
+# are kept for it, the older ones are dropped
+LOG_BUFFER_SIZE = 1024
+
 # define colors for log levels
 COLORS = {
     'DEBUG':    COLOR_SEQ % BLUE,
@@ -162,11 +174,15 @@ class RedirectedStderr(object):
 class MicFileHandler(logging.FileHandler):
     """ This file handler is supposed to catch the stderr output from
         all modules even 3rd party modules involed, as it redirects
-        the stderr stream to a temp file stream, if logfile assigned,
-        it will flush the record to file stream, else it's a buffer
-        handler; once logfile assigned, the buffer will be flushed
+        the stderr stream to a temp file stream.
+
+        The records are queued and written by a background thread in
+        batches, so that logging never waits for the disk. The records
+        emitted before a logfile is assigned, up to LOG_BUFFER_SIZE of
+        them, are kept and written once it is.
     """
-    def __init__(self, filename=None, mode='w', encoding=None, capacity=10):
+    def __init__(self, filename=None, mode='w', encoding=None,
+                 capacity=LOG_BATCH_SIZE):
         # we don't use FileHandler to initialize,
         # because filename might be expected to None
         logging.Handler.__init__(self)
@@ -177,9 +193,13 @@ class MicFileHandler(logging.FileHandler):
             self.baseFilename = None
         self.mode = mode
         self.encoding = None
+        # the most records written at once
         self.capacity = capacity
-        # buffering the records
-        self.buffer = []
+        # records waiting for the logfile, only used by the writer
+        self.buffer = collections.deque(maxlen=LOG_BUFFER_SIZE)
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
 
         # set formater locally
         msg_fmt = "[%(asctime)s] %(message)s"
@@ -191,8 +211,7 @@ class MicFileHandler(logging.FileHandler):
 
     def set_logfile(self, filename, mode='w'):
         """ Set logfile path to make it possible flush records not-on-fly """
-        self.baseFilename = os.path.abspath(filename)
-        self.mode = mode
+        self._put(('logfile', os.path.abspath(filename), mode))
 
     def redirect_stderr(self):
         """ Start to redirect stderr for catching all error output """
@@ -216,7 +235,7 @@ class MicFileHandler(logging.FileHandler):
         sys.stdout.flush()
 
         record = logging.makeLogRecord({'msg': self.errmsg})
-        self.buffer.append(record)
+        self._put(record)
 
         # truncate the redirector for the errors is logged
         self.stderr.truncate()
@@ -225,38 +244,122 @@ class MicFileHandler(logging.FileHandler):
     def emit(self, record):
         """ Emit the log record to Handler """
         # if there error message catched, log it first
-        self.errmsg = self.stderr.getvalue()
-        if self.errmsg:
+        if self.stderr.fderr is not None and \
+           os.fstat(self.stderr.tmpfile.fileno()).st_size:
+            self.errmsg = self.stderr.getvalue()
             self.logstderr()
 
-        # if no logfile assigned, it's a buffer handler
+        self._put(record)
+
+    def _put(self, item):
+        """ Queue a record or a request for the writer thread """
+        # a forked child doesn't inherit the thread of its parent
+        if self.writer_pid != os.getpid():
+            self.queue = Queue.Queue()
+            self.writer = threading.Thread(target=self._write_queue,
+                                           name="MicFileHandler")
+            self.writer.daemon = True
+            self.writer_pid = os.getpid()
+            self.writer.start()
+        self.queue.put(item)
+
+    def _write_queue(self):
+        """ Writer thread: write the records in batches, after at most
+            LOG_BATCH_INTERVAL seconds, and serve the requests in order
+        """
+        while True:
+            item = self.queue.get()
+            records = []
+            deadline = time.time() + LOG_BATCH_INTERVAL
+            while isinstance(item, logging.LogRecord):
+                records.append(item)
+                timeout = deadline - time.time()
+                if len(records) >= self.capacity or timeout <= 0:
+                    item = None
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    item = None
+            self.flushing(records)
+
+            if item is None:
+                continue
+            request = item[0]
+            if request == 'logfile':
+                if self.stream:
+                    self.stream.close()
+                    self.stream = None
+                self.baseFilename, self.mode = item[1:]
+                self.stream = self._open()
+                self.flushing()
+            elif request == 'flush':
+                item[1].set()
+            elif request == 'close':
+                if self.stream:
+                    self.stream.close()
+                    self.stream = None
+                item[1].set()
+                return
+
+    def _open(self):
+        """ Open the logfile for appending, so that writes go to its end
+            without seeking even if another process logs to it too
+        """
+        if self.mode == 'w':
+            open(self.baseFilename, 'w').close()
+            # truncated once, not again by a forked child
+            self.mode = 'a'
+        return open(self.baseFilename, 'a')
+
+    def flushing(self, records=()):
+        """ Write the buffered records and records to logfile """
+        # NOTE: 'flushing' can't be named 'flush' because of 'emit' calling it
         if not self.baseFilename:
-            self.buffer.append(record)
-            if len(self.buffer) >= self.capacity:
-                self.buffer = []
-        else:
-            self.flushing(record)
+            self.buffer.extend(records)
+            return
 
-    def flushing(self, record=None):
-        """ Flush buffer and record to logfile """
-        # NOTE: 'flushing' can't be named 'flush' because of 'emit' calling it
-        # set file stream position to SEEK_END(=2)
-        if self.stream:
-            self.stream.seek(0, 2)
-        # if bufferred, flush it
-        if self.buffer:
-            for arecord in self.buffer:
-                logging.FileHandler.emit(self, arecord)
-            self.buffer = []
-        # if recorded, flush it
-        if record:
-            logging.FileHandler.emit(self, record)
+        records = list(self.buffer) + list(records)
+        self.buffer.clear()
+        if not records:
+            return
+
+        lines = []
+        for record in records:
+            try:
+                line = self.format(record) + "\n"
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+                lines.append(line)
+            except Exception:
+                self.handleError(record)
+
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (IOError, OSError):
+            self.handleError(records[-1])
+
+    def _request(self, request):
+        """ Send request to the writer and wait until it is served """
+        if self.writer_pid != os.getpid() or not self.writer.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put((request, done))
+        # a timeout keeps the wait interruptible
+        while not done.wait(1):
+            if not self.writer.is_alive():
+                break
+
+    def flush(self):
+        """ Wait until the queued records are written """
+        self._request('flush')
 
     def close(self):
-        """ Close handler after flushing the buffer """
-        # if any left in buffer, flush it
-        if self.stream:
-            self.flushing()
+        """ Close handler after writing the queued records """
+        self._request('close')
         logging.FileHandler.close(self)
 
 
@@ -413,6 +516,10 @@ def set_interactive(value):
     else:
         disable_interactive()
 
+def flush():
+    """ Wait until the logged messages are written to the logfile """
+    LOGGER._allhandlers['logfile'].flush()
+
 def enable_logstderr(fpath=None):
     """ Start to log all error message on the MIC logger """
     LOGGER.enable_logstderr()
@@ -0,0 +1,232 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" Block map (bmap) creation for sparse images, without bmaptool.
+
+The mapped areas of the image are found with SEEK_DATA/SEEK_HOLE, or with
+the FIEMAP ioctl on kernels and file systems which don't support them, and
+only those areas are read from the disk.
+"""
+
+import os
+import array
+import errno
+import fcntl
+import struct
+import hashlib
+
+from mic import msger
+from mic.utils.errors import CreatorError
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# struct fiemap and struct fiemap_extent of linux/fiemap.h
+_FIEMAP_FORMAT = "=QQLLLL"
+_FIEMAP_SIZE = struct.calcsize(_FIEMAP_FORMAT)
+_FIEMAP_EXTENT_FORMAT = "=QQQQQLLLL"
+_FIEMAP_EXTENT_SIZE = struct.calcsize(_FIEMAP_EXTENT_FORMAT)
+_FIEMAP_IOCTL = 0xC020660B
+_FIEMAP_FLAG_SYNC = 0x00000001
+_FIEMAP_EXTENT_LAST = 0x00000001
+_FIEMAP_BUFFER_EXTENTS = 512
+
+_READ_SIZE = 4 * 1024 * 1024
+
+def _seek_ranges(fd, size):
+    """ Yield the (start, end) byte ranges holding data, using lseek """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, err:
+            if err.errno == errno.ENXIO:
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield (start, min(end, size))
+        offset = end
+
+def _fiemap_ranges(fd, size):
+    """ Yield the (start, end) byte ranges holding data, using FIEMAP """
+    offset = 0
+    flags = _FIEMAP_FLAG_SYNC
+    while offset < size:
+        buf = struct.pack(_FIEMAP_FORMAT, offset, size - offset, flags,
+                          0, _FIEMAP_BUFFER_EXTENTS, 0)
+        buf += "\0" * (_FIEMAP_EXTENT_SIZE * _FIEMAP_BUFFER_EXTENTS)
+        # a mutable buffer, ioctl() limits string arguments to 1024 bytes
+        arg = array.array('B', buf)
+        fcntl.ioctl(fd, _FIEMAP_IOCTL, arg, True)
+        buf = arg.tostring()
+        # only the first call needs to sync the file
+        flags = 0
+
+        mapped = struct.unpack(_FIEMAP_FORMAT, buf[:_FIEMAP_SIZE])[3]
+        if not mapped:
+            return
+
+        for i in range(mapped):
+            pos = _FIEMAP_SIZE + i * _FIEMAP_EXTENT_SIZE
+            extent = struct.unpack(_FIEMAP_EXTENT_FORMAT,
+                                   buf[pos:pos + _FIEMAP_EXTENT_SIZE])
+            start, length, ext_flags = extent[0], extent[2], extent[5]
+            yield (max(start, offset), min(start + length, size))
+            offset = start + length
+            if ext_flags & _FIEMAP_EXTENT_LAST:
+                return
+
+def get_mapped_ranges(fd, size):
+    """ Return the sorted list of (start, end) byte ranges of the file open
+    as 'fd' which hold data. The whole file is reported as mapped if the
+    holes can't be found at all.
+    """
+    for method in (_seek_ranges, _fiemap_ranges):
+        try:
+            return [r for r in method(fd, size) if r[1] > r[0]]
+        except (OSError, IOError), err:
+            if err.errno not in (errno.EINVAL, errno.ENOTSUP, errno.ENOTTY,
+                                 errno.EOPNOTSUPP):
+                raise
+            msger.debug("%s is not supported: %s" % (method.__name__, err))
+
+    return [(0, size)]
+
+def _block_ranges(ranges, block_size):
+    """ Round byte ranges to blocks and merge the adjacent ones, return a
+    list of (first, last) block numbers
+    """
+    blocks = []
+    for start, end in ranges:
+        first = start / block_size
+        last = (end - 1) / block_size
+        if blocks and first <= blocks[-1][1] + 1:
+            blocks[-1] = (blocks[-1][0], max(last, blocks[-1][1]))
+        else:
+            blocks.append((first, last))
+    return blocks
+
+def create_bmap(image, bmap_file, version = "2.0", block_size = 4096,
+                hash_names = ()):
+    """ Write the block map of 'image' to 'bmap_file'
+
+    @version: bmap format, "2.0" (sha256 checksums) or "1.4" (sha1)
+    @hash_names: digests of the whole image to compute on the way; the
+                 holes are hashed as zeroes without being read
+    @retval: dict of the 'hash_names' digests of the image
+    """
+    if version not in ("1.4", "2.0"):
+        raise CreatorError("Unsupported bmap format version: %s" % version)
+    chksum_type = version == "1.4" and "sha1" or "sha256"
+
+    image_size = os.path.getsize(image)
+    hashes = [hashlib.new(name) for name in hash_names]
+    zeroes = "\0" * _READ_SIZE
+
+    def _feed(data):
+        for hash_obj in hashes:
+            hash_obj.update(data)
+
+    def _feed_zeroes(length):
+        while length > 0 and hashes:
+            _feed(zeroes[:min(length, _READ_SIZE)])
+            length -= _READ_SIZE
+
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        ranges = get_mapped_ranges(fd, image_size)
+        blocks = _block_ranges(ranges, block_size)
+
+        entries = []
+        mapped_count = 0
+        offset = 0
+        for first, last in blocks:
+            start = first * block_size
+            end = min((last + 1) * block_size, image_size)
+            _feed_zeroes(start - offset)
+
+            chksum = hashlib.new(chksum_type)
+            os.lseek(fd, start, os.SEEK_SET)
+            pos = start
+            while pos < end:
+                data = os.read(fd, min(_READ_SIZE, end - pos))
+                if not data:
+                    break
+                chksum.update(data)
+                _feed(data)
+                pos += len(data)
+            # the image may have been shorter than its mapping
+            _feed_zeroes(end - pos)
+
+            if first == last:
+                blocks_str = "%d" % first
+            else:
+                blocks_str = "%d-%d" % (first, last)
+            entries.append((chksum.hexdigest(), blocks_str))
+            mapped_count += last - first + 1
+            offset = end
+        _feed_zeroes(image_size - offset)
+    finally:
+        os.close(fd)
+
+    blocks_count = (image_size + block_size - 1) / block_size
+    if version == "1.4":
+        file_chksum_tag = "BmapFileSHA1"
+        chksum_attr = "sha1"
+        chksum_type_xml = ""
+    else:
+        file_chksum_tag = "BmapFileChecksum"
+        chksum_attr = "chksum"
+        chksum_type_xml = "    <ChecksumType> %s </ChecksumType>\n\n" \
+                          % chksum_type
+    # the checksum of the bmap file is computed with this field zeroed
+    placeholder = "0" * hashlib.new(chksum_type).digest_size * 2
+
+    xml = "<?xml version=\"1.0\" ?>\n"
+    xml += "<!-- This file contains the block map for an image file, which " \
+           "is basically\n     a list of useful (mapped) block numbers in " \
+           "the image file. -->\n"
+    xml += "<bmap version=\"%s\">\n" % version
+    xml += "    <!-- Image size in bytes: %d -->\n" % image_size
+    xml += "    <ImageSize> %d </ImageSize>\n\n" % image_size
+    xml += "    <!-- Size of a block in bytes -->\n"
+    xml += "    <BlockSize> %d </BlockSize>\n\n" % block_size
+    xml += "    <!-- Count of blocks in the image file -->\n"
+    xml += "    <BlocksCount> %d </BlocksCount>\n\n" % blocks_count
+    xml += "    <!-- Count of mapped blocks -->\n"
+    xml += "    <MappedBlocksCount> %d </MappedBlocksCount>\n\n" \
+           % mapped_count
+    xml += chksum_type_xml
+    xml += "    <!-- The checksum of this bmap file -->\n"
+    xml += "    <%s> %s </%s>\n\n" % (file_chksum_tag, placeholder,
+                                      file_chksum_tag)
+    xml += "    <!-- The block map -->\n"
+    xml += "    <BlockMap>\n"
+    for chksum, blocks_str in entries:
+        xml += "        <Range %s=\"%s\"> %s </Range>\n" \
+               % (chksum_attr, chksum, blocks_str)
+    xml += "    </BlockMap>\n"
+    xml += "</bmap>\n"
+
+    file_chksum = hashlib.new(chksum_type, xml).hexdigest()
+    xml = xml.replace(placeholder, file_chksum, 1)
+
+    with open(bmap_file, "w") as f:
+        f.write(xml)
+
+    return dict((name, hash_obj.hexdigest())
+                for name, hash_obj in zip(hash_names, hashes))
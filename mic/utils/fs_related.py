@@ -18,6 +18,7 @@
 
 from __future__ import with_statement
 import os
+import re
 import sys
 import errno
 import stat
@@ -25,10 +26,16 @@ import random
 import string
 import time
 import uuid
+import fcntl
+import shutil
+import struct
+import ctypes
+import tempfile
 
 from mic import msger
 from mic.utils import runner
 from mic.utils.errors import *
+from mic.utils.bmap import get_mapped_ranges
 
 
 def find_binary_inchroot(binary, chroot):
@@ -69,6 +76,120 @@ def makedirs(dirname):
         if err.errno != errno.EEXIST:
             raise
 
+# ioctl to share the extents of a file on btrfs/xfs (linux/fs.h)
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+_libc = None
+
+def _copy_file_range(fdin, fdout, start, length):
+    """ Copy a range with copy_file_range(2), which lets the kernel clone
+    or copy the data without bouncing it through user space. Returns False
+    if the syscall isn't usable for these files.
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(None, use_errno = True)
+        except OSError:
+            _libc = False
+    if not _libc or not hasattr(_libc, "copy_file_range"):
+        return False
+
+    off_in = ctypes.c_longlong(start)
+    off_out = ctypes.c_longlong(start)
+    while length > 0:
+        ret = _libc.copy_file_range(fdin, ctypes.byref(off_in),
+                                    fdout, ctypes.byref(off_out),
+                                    ctypes.c_size_t(length), 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.EBADF) and \
+               off_in.value == start:
+                return False
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            break
+        length -= ret
+    return True
+
+def _copy_range(fdin, fdout, start, end):
+    if _copy_file_range(fdin, fdout, start, end - start):
+        return
+
+    os.lseek(fdin, start, os.SEEK_SET)
+    os.lseek(fdout, start, os.SEEK_SET)
+    pos = start
+    while pos < end:
+        data = os.read(fdin, min(COPY_BUFFER_SIZE, end - pos))
+        if not data:
+            break
+        os.write(fdout, data)
+        pos += len(data)
+
+def sparse_copy(src, dst):
+    """ Copy the file src to dst like shutil.copy2(), but keep the holes of
+    sparse files: the extents are cloned (reflink) when the file system
+    supports it, otherwise only the data areas of src are copied.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    size = os.path.getsize(src)
+    fdin = os.open(src, os.O_RDONLY)
+    try:
+        fdout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            try:
+                fcntl.ioctl(fdout, FICLONE, fdin)
+            except IOError:
+                os.ftruncate(fdout, size)
+                for start, end in get_mapped_ranges(fdin, size):
+                    _copy_range(fdin, fdout, start, end)
+        finally:
+            os.close(fdout)
+    finally:
+        os.close(fdin)
+
+    shutil.copystat(src, dst)
+    return dst
+
+def sparse_move(src, dst):
+    """ Move src to dst like shutil.move(), using sparse_copy() when the
+    file has to be copied to another file system
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    try:
+        os.rename(src, dst)
+    except OSError, err:
+        if err.errno != errno.EXDEV:
+            raise
+        if os.path.isdir(src) or os.path.islink(src):
+            return shutil.move(src, dst)
+        sparse_copy(src, dst)
+        os.unlink(src)
+    return dst
+
+def copy_tree(srcdir, dstdir, skip=()):
+    """ Copy the content of srcdir into dstdir, merging with the
+    directories already there and sharing the data blocks when the file
+    system supports reflinks. The top level entries listed in skip are
+    not copied.
+    """
+    entries = [os.path.join(srcdir, entry)
+               for entry in sorted(os.listdir(srcdir)) if entry not in skip]
+    if not entries:
+        return
+
+    cmdln = [find_binary_path("cp"), "-a", "--reflink=auto"] + entries
+    rc, out = runner.runtool(cmdln + [dstdir], catch=3)
+    if rc != 0:
+        raise CreatorError("Failed to copy %s to %s: %s"
+                           % (srcdir, dstdir, out.strip()))
+
 def mkvdfs(in_img, out_img, fsoptions):
      """ This function is incomplete. """
      fullpathmkvdfs = find_binary_path("mkfs.vdfs")
@@ -103,6 +224,30 @@ def resize2fs(fs, size):
     else:
         return runner.show([resize2fs, fs, "%sK" % (size / 1024,)])
 
+# room left on top of the estimated minimal size of a filesystem, so that
+# a single resize is enough: a ratio of the estimate, and a lower bound
+MIN_SIZE_MARGIN = 0.02
+MIN_SIZE_MARGIN_FLOOR = 4 * 1024 * 1024
+
+def min_size_with_margin(estimate, blocksize):
+    """ Add the safety margin to an estimated minimal size in bytes, and
+    round it up to the block size
+    """
+    size = estimate + max(int(estimate * MIN_SIZE_MARGIN), MIN_SIZE_MARGIN_FLOOR)
+    return (size + blocksize - 1) / blocksize * blocksize
+
+def resize2fs_estimate(fs):
+    """ Return the minimal size of the ext filesystem fs in blocks, as
+    estimated by 'resize2fs -P', or None if it can't tell
+    """
+    resize2fs = find_binary_path("resize2fs")
+    rc, out = runner.runtool([resize2fs, '-P', fs])
+    match = re.search(r"minimum size of the filesystem:\s*(\d+)", out or "")
+    if rc != 0 or not match:
+        msger.debug("resize2fs -P failed on %s: %s" % (fs, out))
+        return None
+    return int(match.group(1))
+
 class BindChrootMount:
     """Represents a bind mount of a directory into a chroot."""
     def __init__(self, src, chroot, dest = None, option = None):
@@ -284,6 +429,8 @@ class LoopbackDisk(Disk):
         Disk.__init__(self, size)
         self.lofile = lofile
         self.losetupcmd = find_binary_path("losetup")
+        # let the kernel create the partition devices of the loop device
+        self.partscan = False
 
     def fixed(self):
         return False
@@ -295,13 +442,17 @@ class LoopbackDisk(Disk):
         if self.device is not None:
             return
 
-        self.device = get_loop_device(self.losetupcmd, self.lofile)
+        self.device = get_loop_device(self.losetupcmd, self.lofile,
+                                      self.partscan)
 
     def cleanup(self):
         if self.device is None:
             return
         msger.debug("Losetup remove %s" % self.device)
-        rc = runner.show([self.losetupcmd, "-d", self.device])
+        try:
+            detach_loop(self.device)
+        except (OSError, IOError):
+            runner.show([self.losetupcmd, "-d", self.device])
         self.device = None
 
 class SparseLoopbackDisk(LoopbackDisk):
@@ -519,29 +670,32 @@ class ExtDiskMount(DiskMount):
         self.__fsck()
 
         #
-        # Use a binary search to find the minimal size
-        # we can resize the image to
+        # Resize once to the size estimated by resize2fs plus a margin,
+        # and let resize2fs -M find the minimum if that is refused
         #
-        bot = 0
-        top = self.__get_size_from_filesystem()
-        while top != (bot + 1):
-            t = bot + ((top - bot) / 2)
-
-            if not resize2fs(self.disk.lofile, t):
-                top = t
-            else:
-                bot = t
-        return top
+        current = self.__get_size_from_filesystem()
+        blocks = resize2fs_estimate(self.disk.lofile)
+        if blocks is None:
+            resize2fs(self.disk.lofile, 0)
+        else:
+            target = min_size_with_margin(blocks * self.blocksize,
+                                          self.blocksize)
+            if target < current and resize2fs(self.disk.lofile, target):
+                msger.warning("Failed to resize %s to %d bytes, falling "
+                              "back to resize2fs -M" % (self.disk.lofile,
+                                                        target))
+                self.__fsck()
+                resize2fs(self.disk.lofile, 0)
+
+        # the filesystem is the authority on the size it ended up with
+        return self.__get_size_from_filesystem()
 
     def resparse(self, size = None):
         self.cleanup()
-        if size == 0:
-            minsize = 0
-        else:
-            minsize = self.__resize_to_minimal()
-            self.disk.truncate(minsize)
-
-        self.__resize_filesystem(size)
+        minsize = self.__resize_to_minimal()
+        self.disk.truncate(minsize)
+        if size != 0:
+            self.__resize_filesystem(size)
         return minsize
 
 class VfatDiskMount(DiskMount):
@@ -716,11 +870,51 @@ class BtrfsDiskMount(DiskMount):
     def __resize_to_minimal(self):
         self.__fsck()
 
-        return self.__get_size_from_filesystem()
+        current = self.__get_size_from_filesystem()
+        try:
+            btrfscmd = find_binary_path("btrfs")
+        except CreatorError, err:
+            msger.debug("Can't shrink btrfs: %s" % err)
+            return current
+
+        # btrfs only resizes mounted filesystems
+        msger.info("Resizing filesystem to minimal ...")
+        mountdir = tempfile.mkdtemp(prefix = "btrfs-resize-")
+        try:
+            if runner.show(["mount", "-o", "loop", "-t", "btrfs",
+                            self.disk.lofile, mountdir]):
+                return current
+
+            try:
+                rc, out = runner.runtool([btrfscmd, "inspect-internal",
+                                          "min-dev-size", mountdir])
+                match = re.match(r"\s*(\d+) bytes", out or "")
+                if rc != 0 or not match:
+                    msger.warning("Failed to get the minimal size of %s"
+                                  % self.disk.lofile)
+                    return current
+
+                target = min_size_with_margin(int(match.group(1)),
+                                              self.blocksize)
+                if target >= current or \
+                   runner.show([btrfscmd, "filesystem", "resize",
+                                str(target), mountdir]):
+                    return current
+                return target
+            finally:
+                runner.show(["umount", mountdir])
+        finally:
+            os.rmdir(mountdir)
 
     def resparse(self, size = None):
         self.cleanup()
-        minsize = self.__resize_to_minimal()
+        if size == 0:
+            # a shrunk btrfs doesn't grow back with the file, only shrink
+            # it when the image is meant to stay minimal
+            minsize = self.__resize_to_minimal()
+        else:
+            self.__fsck()
+            minsize = self.__get_size_from_filesystem()
         self.disk.truncate(minsize)
         self.__resize_filesystem(size)
         return minsize
@@ -848,13 +1042,110 @@ def load_module(module):
         msger.info("Loading %s..." % module)
         runner.quiet(['modprobe', module])
 
+# loop ioctls and flags, from linux/loop.h and linux/fs.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_PARTSCAN = 8
+BLKRRPART = 0x125F
+LOOP_CONTROL = "/dev/loop-control"
+
+# struct loop_info64 and struct loop_config
+_LOOP_INFO64_FORMAT = "=QQQQQIIII64s64s32sQQ"
+_LOOP_CONFIG_FORMAT = "=II" + _LOOP_INFO64_FORMAT[1:] + "8Q"
+_LOOP_INFO64_SIZE = struct.calcsize(_LOOP_INFO64_FORMAT)
+
+def _loop_info64(lofile, flags):
+    return (0, 0, 0, 0, 0, 0, 0, 0, flags, lofile[-63:], "", "", 0, 0)
+
+def loop_is_bound(device):
+    """ Return True if the loop device is attached to a file """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+    except OSError, err:
+        if err.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        fcntl.ioctl(fd, LOOP_GET_STATUS64, "\0" * _LOOP_INFO64_SIZE)
+        return True
+    except IOError, err:
+        if err.errno == errno.ENXIO:
+            return False
+        raise
+    finally:
+        os.close(fd)
+
+def loop_has_holders(device):
+    """ Return True if other block devices, like the device-mapper
+    partitions of kpartx, are set up on top of the loop device
+    """
+    holders = "/sys/block/%s/holders" % os.path.basename(device)
+    return os.path.isdir(holders) and bool(os.listdir(holders))
+
+def _attach_loop(loopfd, filefd, lofile, partscan):
+    """ Attach the open file to the open loop device, with LOOP_CONFIGURE
+    where the kernel has it (linux 5.8), or LOOP_SET_FD and
+    LOOP_SET_STATUS64
+    """
+    flags = partscan and LO_FLAGS_PARTSCAN or 0
+    config = struct.pack(_LOOP_CONFIG_FORMAT, filefd, 0,
+                         *(_loop_info64(lofile, flags) + (0,) * 8))
+    try:
+        fcntl.ioctl(loopfd, LOOP_CONFIGURE, config)
+        return
+    except IOError, err:
+        if err.errno not in (errno.EINVAL, errno.ENOTTY):
+            raise
+
+    fcntl.ioctl(loopfd, LOOP_SET_FD, filefd)
+    try:
+        fcntl.ioctl(loopfd, LOOP_SET_STATUS64,
+                    struct.pack(_LOOP_INFO64_FORMAT,
+                                *_loop_info64(lofile, flags)))
+    except IOError:
+        fcntl.ioctl(loopfd, LOOP_CLR_FD, 0)
+        raise
+
+def detach_loop(device):
+    """ Detach the loop device from its file """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+    finally:
+        os.close(fd)
+
+def rescan_loop_partitions(device, numbers, timeout = 5):
+    """ Ask the kernel to re-read the partition table of a loop device set
+    up with partition scanning, and return the device nodes of the
+    partitions 'numbers', or None if they don't show up within 'timeout'
+    seconds.
+    """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except IOError, err:
+        msger.debug("Can't re-read partitions of %s: %s" % (device, err))
+        return None
+    finally:
+        os.close(fd)
+
+    parts = ["%sp%d" % (device, num) for num in numbers]
+    deadline = time.time() + timeout
+    while [part for part in parts if not os.path.exists(part)]:
+        if time.time() > deadline:
+            return None
+        time.sleep(0.1)
+    return parts
+
 class LoopDevice(object):
     def __init__(self, loopid=None):
         self.device = None
         self.loopid = loopid
         self.created = False
-        self.kpartxcmd = find_binary_path("kpartx")
-        self.losetupcmd = find_binary_path("losetup")
 
     def register(self, device):
         self.device = device
@@ -878,24 +1169,10 @@ class LoopDevice(object):
         return maxid
 
     def _kpseek(self, device):
-        rc, out = runner.runtool([self.kpartxcmd, '-l', '-v', device])
-        if rc != 0:
-            raise MountError("Can't query dm snapshot on %s" % device)
-        for line in out.splitlines():
-            if line and line.startswith("loop"):
-                return True
-        return False
+        return loop_has_holders(device)
 
     def _loseek(self, device):
-        import re
-        rc, out = runner.runtool([self.losetupcmd, '-a'])
-        if rc != 0:
-            raise MountError("Failed to run 'losetup -a'")
-        for line in out.splitlines():
-            m = re.match("([^:]+): .*", line)
-            if m and m.group(1) == device:
-                return True
-        return False
+        return loop_is_bound(device)
 
     def create(self):
         if not self.created:
@@ -931,10 +1208,12 @@ class LoopDevice(object):
 
 
         if self._kpseek(self.device):
-            runner.quiet([self.kpartxcmd, "-d", self.device])
+            runner.quiet([find_binary_path("kpartx"), "-d", self.device])
         if self._loseek(self.device):
-            runner.quiet([self.losetupcmd, "-d", self.device])
-        # FIXME: should sleep a while between two loseek
+            try:
+                detach_loop(self.device)
+            except (OSError, IOError), err:
+                msger.debug("Failed to detach %s: %s" % (self.device, err))
         if self._loseek(self.device):
             msger.warning("Can't cleanup loop device %s" % self.device)
         elif self.loopid:
@@ -943,11 +1222,63 @@ class LoopDevice(object):
 DEVICE_PIDFILE_DIR = "/var/tmp/mic/device"
 DEVICE_LOCKFILE = "/var/lock/__mic_loopdev.lock"
 
-def get_loop_device(losetupcmd, lofile):
-    global DEVICE_PIDFILE_DIR
-    global DEVICE_LOCKFILE
+def _alloc_loop_device(lofile, partscan):
+    """ Attach lofile to a free loop device found with LOOP_CTL_GET_FREE.
+    The host-wide lock, shared with older mic versions which use 'losetup
+    --find', is only held for the allocation itself; a device taken by
+    anyone else in the meantime is reported busy and the next one is tried.
+    Returns None if /dev/loop-control can't be used.
+    """
+    try:
+        ctlfd = os.open(LOOP_CONTROL, os.O_RDWR)
+    except OSError, err:
+        msger.debug("Can't open %s: %s" % (LOOP_CONTROL, err))
+        return None
+
+    try:
+        filefd = os.open(lofile, os.O_RDWR)
+    except OSError, err:
+        os.close(ctlfd)
+        raise MountError("Failed to open '%s': %s" % (lofile, err))
 
-    import fcntl
+    makedirs(os.path.dirname(DEVICE_LOCKFILE))
+    lockfd = os.open(DEVICE_LOCKFILE, os.O_CREAT | os.O_WRONLY, 0644)
+    try:
+        for retry in range(64):
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+            try:
+                try:
+                    loopid = fcntl.ioctl(ctlfd, LOOP_CTL_GET_FREE)
+                except IOError, err:
+                    msger.debug("LOOP_CTL_GET_FREE failed: %s" % err)
+                    return None
+
+                loopdev = "/dev/loop%d" % loopid
+                if not os.path.exists(loopdev):
+                    os.mknod(loopdev, stat.S_IFBLK | 0660,
+                             os.makedev(7, loopid))
+                loopfd = os.open(loopdev, os.O_RDWR)
+                try:
+                    _attach_loop(loopfd, filefd, lofile, partscan)
+                    return loopdev
+                except IOError, err:
+                    if err.errno != errno.EBUSY:
+                        raise MountError("Failed to setup loop device for "
+                                         "'%s': %s" % (lofile, err))
+                finally:
+                    os.close(loopfd)
+            finally:
+                fcntl.flock(lockfd, fcntl.LOCK_UN)
+
+        raise MountError("No free loop device for '%s'" % lofile)
+    finally:
+        os.close(lockfd)
+        os.close(filefd)
+        os.close(ctlfd)
+
+def _losetup_loop_device(losetupcmd, lofile):
+    """ Attach lofile to a loop device with losetup, holding the host-wide
+    lock for the whole setup """
     makedirs(os.path.dirname(DEVICE_LOCKFILE))
     fp = open(DEVICE_LOCKFILE, 'w')
     fcntl.flock(fp, fcntl.LOCK_EX)
@@ -955,9 +1286,6 @@ def get_loop_device(losetupcmd, lofile):
         loopdev = None
         devinst = LoopDevice()
 
-        # clean up left loop device first
-        clean_loop_devices()
-
         # provide an avaible loop device
         rc, out = runner.runtool([losetupcmd, "--find"])
         if rc == 0 and out:
@@ -971,7 +1299,26 @@ def get_loop_device(losetupcmd, lofile):
         rc = runner.show([losetupcmd, loopdev, lofile])
         if rc != 0:
             raise MountError("Failed to setup loop device for '%s'" % lofile)
+    finally:
+        fcntl.flock(fp, fcntl.LOCK_UN)
+        fp.close()
 
+    return loopdev
+
+def get_loop_device(losetupcmd, lofile, partscan = False):
+    global DEVICE_PIDFILE_DIR
+    global DEVICE_LOCKFILE
+
+    try:
+        # clean up left loop device first
+        clean_loop_devices()
+
+        devinst = LoopDevice()
+        loopdev = _alloc_loop_device(lofile, partscan)
+        if not loopdev:
+            loopdev = _losetup_loop_device(losetupcmd, lofile)
+
+        devinst.register(loopdev)
         devinst.reg_atexit()
 
         # try to save device and pid
@@ -984,15 +1331,6 @@ def get_loop_device(losetupcmd, lofile):
 
     except MountError, err:
         raise CreatorError("%s" % str(err))
-    except:
-        raise
-    finally:
-        try:
-            fcntl.flock(fp, fcntl.LOCK_UN)
-            fp.close()
-            os.unlink(DEVICE_LOCKFILE)
-        except:
-            pass
 
     return loopdev
 
@@ -16,10 +16,13 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 """ This module implements a simple GPT partitions parser which can read the
-GPT header and the GPT partition table. """
+GPT header and the GPT partition table, and a writer which creates GPT or
+msdos (MBR) partition tables from scratch. """
 
+import os
 import struct
 import uuid
+import random
 import binascii
 from mic.utils.errors import MountError
 
@@ -29,6 +32,30 @@ _GPT_ENTRY_FORMAT = "<16s16sQQQ72s"
 _GPT_ENTRY_SIZE = struct.calcsize(_GPT_ENTRY_FORMAT)
 _SUPPORTED_GPT_REVISION = '\x00\x00\x01\x00'
 
+# Number of entries in the GPT partition table, the minimum allowed by UEFI
+GPT_ENTRIES_COUNT = 128
+# GPT partition attribute bit 2, "legacy BIOS bootable"
+GPT_LEGACY_BOOT = 1 << 2
+
+# The GPT partition type UUIDs
+GPT_TYPE_LINUX = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+GPT_TYPE_SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+GPT_TYPE_BASIC_DATA = "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7"
+
+# The MBR partition system IDs
+MBR_TYPE_LINUX = 0x83
+MBR_TYPE_SWAP = 0x82
+MBR_TYPE_FAT16 = 0x0E
+MBR_TYPE_FAT32 = 0x0C
+MBR_TYPE_EXTENDED = 0x0F
+_MBR_TYPE_EBR_LINK = 0x05
+_MBR_TYPE_PROTECTIVE = 0xEE
+
+_MBR_ENTRY_FORMAT = "<B3sB3sII"
+_MBR_ENTRIES_OFFSET = 446
+_MBR_DISK_SIGNATURE_OFFSET = 440
+_MBR_SIGNATURE = '\x55\xaa'
+
 def _stringify_uuid(binary_uuid):
     """ A small helper function to transform a binary UUID into a string
     format. """
@@ -329,3 +356,190 @@ class GptParser:
         # Change the backup partition table
         header = self.read_header(False)
         self._change_partition(header, entry)
+
+def _chs(lba):
+    """ Convert an LBA to the CHS address of an MBR entry, using the usual
+    255 heads and 63 sectors per track geometry. """
+
+    cylinder = lba / (255 * 63)
+    if cylinder > 1023:
+        # Not addressable with CHS, the LBA fields are used instead
+        return '\xfe\xff\xff'
+
+    head = (lba / 63) % 255
+    sector = lba % 63 + 1
+    return struct.pack("<BBB", head, sector | ((cylinder >> 2) & 0xC0),
+                       cylinder & 0xFF)
+
+def _mbr_entry(system_id, start, size, boot = False):
+    """ Pack an MBR partition entry. """
+
+    # the protective entry of a larger GPT disk is capped, not an error
+    if start + size > 0xFFFFFFFF and system_id != _MBR_TYPE_PROTECTIVE:
+        raise MountError("Partition at sector %d does not fit in an msdos " \
+                         "partition table, use GPT instead" % start)
+
+    return struct.pack(_MBR_ENTRY_FORMAT, boot and 0x80 or 0, _chs(start),
+                       system_id, _chs(start + size - 1), start, size)
+
+def _mbr_sector(bootcode, disk_signature, entries, sector_size):
+    """ Build an MBR (or EBR) sector with the given entries. """
+
+    sector = bootcode[:_MBR_DISK_SIGNATURE_OFFSET]
+    sector = sector.ljust(_MBR_DISK_SIGNATURE_OFFSET, '\0')
+    sector += struct.pack("<I", disk_signature) + '\0\0'
+    sector += ''.join(entries).ljust(4 * 16, '\0') + _MBR_SIGNATURE
+    return sector.ljust(sector_size, '\0')
+
+def _msdos_sectors(disk_sectors, partitions, bootcode, sector_size):
+    """ Return the (LBA, sector data) list of an msdos partition table: the
+    MBR and one EBR per logical partition. The EBR of a logical partition is
+    the sector right before it. """
+
+    primary = [p for p in partitions if not p.get('logical')]
+    logical = [p for p in partitions if p.get('logical')]
+    if len(primary) > 4 or (logical and len(primary) > 3):
+        raise MountError("Too many primary partitions for msdos")
+
+    entries = [_mbr_entry(p['system_id'], p['start'], p['size'], p['boot'])
+               for p in primary]
+    sectors = []
+
+    if logical:
+        ext_start = logical[0]['start'] - 1
+        ext_end = logical[-1]['start'] + logical[-1]['size']
+        entries.append(_mbr_entry(MBR_TYPE_EXTENDED, ext_start,
+                                  ext_end - ext_start))
+
+        for i, p in enumerate(logical):
+            ebr_lba = p['start'] - 1
+            ebr = [_mbr_entry(p['system_id'], 1, p['size'], p['boot'])]
+            # the link to the next EBR is relative to the extended partition
+            if i + 1 < len(logical):
+                nxt = logical[i + 1]
+                ebr.append(_mbr_entry(_MBR_TYPE_EBR_LINK,
+                                      nxt['start'] - 1 - ext_start,
+                                      nxt['size'] + 1))
+            sectors.append((ebr_lba, _mbr_sector('', 0, ebr, sector_size)))
+
+    disk_signature = random.randint(1, 0xFFFFFFFF)
+    sectors.insert(0, (0, _mbr_sector(bootcode, disk_signature, entries,
+                                      sector_size)))
+    return sectors
+
+def _gpt_header(disk_uuid, hdr_lba, backup_lba, first_lba, last_lba,
+                ptable_lba, raw_ptable):
+    """ Pack a GPT header with its CRCs. """
+
+    raw_hdr = ['EFI PART', _SUPPORTED_GPT_REVISION, _GPT_HEADER_SIZE, 0, 0,
+               hdr_lba, backup_lba, first_lba, last_lba,
+               uuid.UUID(disk_uuid).bytes_le, ptable_lba, GPT_ENTRIES_COUNT,
+               _GPT_ENTRY_SIZE, binascii.crc32(raw_ptable) & 0xFFFFFFFF]
+    raw_hdr[3] = _calc_header_crc(raw_hdr)
+    return struct.pack(_GPT_HEADER_FORMAT, *raw_hdr)
+
+def _gpt_sectors(disk_sectors, partitions, bootcode, sector_size, disk_uuid):
+    """ Return the (LBA, data) list of a GPT partition table: the protective
+    MBR with the primary GPT, and the backup GPT at the end of the disk. """
+
+    ptable_sectors = (GPT_ENTRIES_COUNT * _GPT_ENTRY_SIZE + sector_size - 1) \
+                     / sector_size
+    first_lba = 2 + ptable_sectors
+    last_lba = disk_sectors - 2 - ptable_sectors
+    backup_lba = disk_sectors - 1
+
+    if len(partitions) > GPT_ENTRIES_COUNT:
+        raise MountError("Too many GPT partitions: %d" % len(partitions))
+
+    raw_ptable = ''
+    for p in partitions:
+        if p['start'] < first_lba or p['start'] + p['size'] - 1 > last_lba:
+            raise MountError("Partition at sectors %d-%d is out of the " \
+                             "usable GPT area %d-%d" % \
+                             (p['start'], p['start'] + p['size'] - 1,
+                              first_lba, last_lba))
+        raw_ptable += struct.pack(_GPT_ENTRY_FORMAT,
+                                  uuid.UUID(p['type_uuid']).bytes_le,
+                                  uuid.UUID(p['part_uuid']).bytes_le,
+                                  p['start'], p['start'] + p['size'] - 1,
+                                  p['flags'],
+                                  p['name'].encode('UTF-16LE')[:72])
+    raw_ptable = raw_ptable.ljust(ptable_sectors * sector_size, '\0')
+    raw_entries = raw_ptable[:GPT_ENTRIES_COUNT * _GPT_ENTRY_SIZE]
+
+    pmbr = _mbr_sector(bootcode, 0,
+                       [_mbr_entry(_MBR_TYPE_PROTECTIVE, 1,
+                                   min(disk_sectors - 1, 0xFFFFFFFF))],
+                       sector_size)
+    primary = _gpt_header(disk_uuid, 1, backup_lba, first_lba, last_lba,
+                          2, raw_entries)
+    backup = _gpt_header(disk_uuid, backup_lba, 1, first_lba, last_lba,
+                         last_lba + 1, raw_entries)
+
+    return [(0, pmbr + primary.ljust(sector_size, '\0') + raw_ptable),
+            (last_lba + 1, raw_ptable + backup.ljust(sector_size, '\0'))]
+
+def write_partition_table(disk_path, ptable_format, partitions,
+                          sector_size = 512, disk_uuid = None):
+    """ Write a new "gpt" or "msdos" partition table to the disk image or
+    device 'disk_path', replacing any existing one but keeping the boot code
+    of the MBR. The 'partitions' argument is a list of dictionaries, in the
+    order of the partition numbers, with the following elements:
+
+    'start'     : the first sector of the partition
+    'size'      : the size of the partition in sectors
+    'boot'      : a boolean, if 'True', the partition is bootable
+
+    and for msdos partition tables:
+
+    'system_id' : the MBR partition type (MBR_TYPE_*)
+    'logical'   : a boolean, if 'True', this is a logical partition in the
+                  extended partition, the sector before it is used for its
+                  EBR
+
+    or for GPT partition tables:
+
+    'type_uuid' : the GPT partition type UUID (GPT_TYPE_*)
+    'part_uuid' : the partition UUID
+    'name'      : the partition name
+    'flags'     : the attribute flags, 'boot' adds GPT_LEGACY_BOOT
+
+    The whole table is built in memory and written with one write per
+    disk area. """
+
+    try:
+        fd = os.open(disk_path, os.O_RDWR)
+    except OSError, err:
+        raise MountError("Cannot open '%s' for writing the partition " \
+                         "table: %s" % (disk_path, err))
+
+    try:
+        disk_sectors = os.lseek(fd, 0, os.SEEK_END) / sector_size
+        os.lseek(fd, 0, os.SEEK_SET)
+        bootcode = os.read(fd, _MBR_DISK_SIGNATURE_OFFSET)
+
+        if ptable_format == "gpt":
+            for p in partitions:
+                p.setdefault('flags', 0)
+                if p['boot']:
+                    p['flags'] |= GPT_LEGACY_BOOT
+            sectors = _gpt_sectors(disk_sectors, partitions, bootcode,
+                                   sector_size,
+                                   disk_uuid or str(uuid.uuid4()))
+        elif ptable_format == "msdos":
+            sectors = _msdos_sectors(disk_sectors, partitions, bootcode,
+                                     sector_size)
+        else:
+            raise MountError("Unknown partition table format '%s'" % \
+                             ptable_format)
+
+        for lba, data in sectors:
+            os.lseek(fd, lba * sector_size, os.SEEK_SET)
+            if os.write(fd, data) != len(data):
+                raise MountError("Short write to '%s'" % disk_path)
+        os.fsync(fd)
+    except (OSError, IOError), err:
+        raise MountError("Cannot write the partition table of '%s': %s" % \
+                         (disk_path, err))
+    finally:
+        os.close(fd)
@@ -20,6 +20,10 @@ import sys
 import fcntl
 import struct
 import termios
+import threading
+import urlparse
+import tempfile
+import pycurl
 
 from mic import msger
 from mic.utils import runner
@@ -29,8 +33,20 @@ from mic.utils.safeurl import SafeURL
 from urlgrabber import grabber
 from urlgrabber import __version__ as grabber_version
 
-def myurlgrab(url, filename, proxies, progress_obj = None):
-    g = grabber.URLGrabber()
+# default limits of the concurrent download engine
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_HOST_LIMIT = 4
+
+def new_grabber():
+    """ Return a URLGrabber with a curl handle of its own
+
+    urlgrabber shares one module-level curl handle between all grabbers,
+    so a grabber used from another thread needs its own.
+    """
+    return grabber.URLGrabber(curl_obj = pycurl.Curl())
+
+def myurlgrab(url, filename, proxies, progress_obj = None, grabber_obj = None):
+    g = grabber_obj or grabber.URLGrabber()
     if progress_obj is None:
         progress_obj = TextProgress()
 
@@ -40,35 +56,179 @@ def myurlgrab(url, filename, proxies, progress_obj = None):
             raise CreatorError("URLGrabber error: can't find file %s" % url)
         if url.endswith('.rpm'):
             return filepath
-        else:
+
+    # written to a temporary file renamed into place once complete, the
+    # builds sharing the cachedir never see a partial file
+    fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                   suffix=".part",
+                                   dir=os.path.dirname(filename) or ".")
+    os.close(fd)
+    try:
+        if url.startswith("file:/"):
             # untouch repometadata in source path
-            runner.show(['cp', '-f', filepath, filename])
+            runner.show(['cp', '-f', filepath, tmpfile])
+        else:
+            try:
+                # cast url to str here, sometimes it can be unicode,
+                # but pycurl only accept str
+                g.urlgrab(url=str(url),
+                          filename=tmpfile,
+                          ssl_verify_host=False,
+                          ssl_verify_peer=False,
+                          proxies=proxies,
+                          http_headers=(('Pragma', 'no-cache'),),
+                          quote=0,
+                          progress_obj=progress_obj)
+            except grabber.URLGrabError, err:
+                tmp = SafeURL(url)
+                msg = str(err)
 
-    else:
-        try:
-            # cast url to str here, sometimes it can be unicode,
-            # but pycurl only accept str
-            filename = g.urlgrab(url=str(url),
-                                 filename=filename,
-                                 ssl_verify_host=False,
-                                 ssl_verify_peer=False,
-                                 proxies=proxies,
-                                 http_headers=(('Pragma', 'no-cache'),),
-                                 quote=0,
-                                 progress_obj=progress_obj)
-        except grabber.URLGrabError, err:
-            tmp = SafeURL(url)
-            msg = str(err)
-
-            if msg.find(url) < 0:
-                msg += ' on %s' % tmp
-            else:
-                msg = msg.replace(url, tmp)
+                if msg.find(url) < 0:
+                    msg += ' on %s' % tmp
+                else:
+                    msg = msg.replace(url, tmp)
 
-            raise CreatorError(msg)
+                raise CreatorError(msg)
+        os.chmod(tmpfile, 0644)
+        os.rename(tmpfile, filename)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
 
     return filename
 
+def myurlopen(url, proxies, grabber_obj = None):
+    """ Open url for reading, like myurlgrab() without the local copy """
+    if url.startswith("file:/"):
+        filepath = "/%s" % url.replace("file:", "").lstrip('/')
+        try:
+            return open(filepath, 'rb')
+        except IOError, err:
+            raise CreatorError("URLGrabber error: can't open file %s: %s"
+                               % (url, err.strerror))
+
+    # the file object stays open, keep its handle out of other transfers
+    g = grabber_obj or new_grabber()
+    try:
+        return g.urlopen(url=str(url),
+                         ssl_verify_host=False,
+                         ssl_verify_peer=False,
+                         proxies=proxies,
+                         http_headers=(('Pragma', 'no-cache'),),
+                         quote=0)
+    except grabber.URLGrabError, err:
+        msg = str(err)
+        if msg.find(url) < 0:
+            msg += ' on %s' % SafeURL(url)
+        else:
+            msg = msg.replace(url, SafeURL(url))
+        raise CreatorError(msg)
+
+def _grab_locked(url, filename, proxies, progress_obj, g, check):
+    """ Download url to filename under a lock on filename, unless
+        check(filename) finds it already fetched by someone else
+    """
+    lockfd = os.open(filename + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX)
+        if os.path.exists(filename) and check(filename):
+            return filename
+        return myurlgrab(url, filename, proxies, progress_obj, g)
+    finally:
+        os.close(lockfd)
+
+def urlgrab_many(jobs, progress_obj = None, workers = DOWNLOAD_WORKERS,
+                 host_limit = DOWNLOAD_HOST_LIMIT, check = None):
+    """ Download a batch of files concurrently
+
+    @jobs: list of (url, filename, proxies, size) tuples
+    @progress_obj: progress meter shared by all downloads
+    @workers: maximum number of downloads running at the same time
+    @host_limit: maximum number of connections opened to a single host
+    @check: when set, each download holds a lock on its file and is
+            skipped if check(filename) is true once the lock is taken,
+            for files shared with other processes
+
+    Largest files are started first, so that a big package does not end up
+    as the last one in flight. Once a download fails, no new download is
+    started; the ones in flight are let to finish and the first error is
+    raised. Returns the local filenames, in the order of jobs.
+    """
+    if progress_obj is None:
+        progress_obj = TextProgress(len(jobs))
+
+    pending = sorted(enumerate(jobs),
+                     key = lambda item: int(item[1][3] or 0),
+                     reverse = True)
+    results = [None] * len(jobs)
+    errors = []
+    busy = {}
+    cond = threading.Condition()
+
+    def _host(url):
+        return urlparse.urlsplit(str(url))[1]
+
+    def _next_job():
+        with cond:
+            while pending and not errors:
+                for i, (idx, job) in enumerate(pending):
+                    host = _host(job[0])
+                    if busy.get(host, 0) < host_limit:
+                        busy[host] = busy.get(host, 0) + 1
+                        return pending.pop(i)
+                cond.wait()
+            return None
+
+    def _release(url):
+        with cond:
+            busy[_host(url)] -= 1
+            cond.notify_all()
+
+    def _worker():
+        g = new_grabber()
+        while True:
+            item = _next_job()
+            if item is None:
+                return
+
+            idx, (url, filename, proxies, size) = item
+            try:
+                if check:
+                    results[idx] = _grab_locked(url, filename, proxies,
+                                                progress_obj, g, check)
+                else:
+                    results[idx] = myurlgrab(url, filename, proxies,
+                                             progress_obj, g)
+            except Exception, err:
+                with cond:
+                    errors.append(err)
+            finally:
+                _release(url)
+
+    threads = []
+    for i in range(min(workers, len(pending))):
+        thread = threading.Thread(target = _worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            # join with a timeout, so that KeyboardInterrupt gets through
+            while thread.isAlive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        with cond:
+            errors.append(CreatorError("Download interrupted by user"))
+            cond.notify_all()
+        raise
+
+    if errors:
+        raise errors[0]
+
+    return results
+
 def terminal_width(fd=1):
     """ Get the real terminal width """
     try:
@@ -84,6 +244,8 @@ def truncate_url(url, width):
 class TextProgress(object):
     # make the class as singleton
     _instance = None
+    # downloads may report progress from several threads
+    _lock = threading.Lock()
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(TextProgress, cls).__new__(cls, *args, **kwargs)
@@ -93,22 +255,27 @@ class TextProgress(object):
     def __init__(self, totalnum = None):
         self.total = totalnum
         self.counter = 1
+        self.finished = 0
 
     def start(self, filename, url, *args, **kwargs):
-        self.url = url
-        self.termwidth = terminal_width()
-        if self.total is None:
-            msger.info("Retrieving %s ..." % truncate_url(self.url, self.termwidth - 15))
-        else:
-            msger.info("Retrieving %s [%d/%d] ..." % (truncate_url(self.url, self.termwidth - 25), self.counter, self.total))
+        with self._lock:
+            self.url = url
+            self.termwidth = terminal_width()
+            if self.total is None:
+                msger.info("Retrieving %s ..." % truncate_url(self.url, self.termwidth - 15))
+            else:
+                msger.info("Retrieving %s [%d/%d] ..." % (truncate_url(self.url, self.termwidth - 25), self.counter, self.total))
+                self.counter += 1
 
     def update(self, *args):
         pass
 
     def end(self, *args):
-        if self.counter == self.total:
-            msger.raw("\n")
+        with self._lock:
+            if self.total is None:
+                return
 
-        if self.total is not None:
-            self.counter += 1
+            self.finished += 1
+            if self.finished == self.total:
+                msger.raw("\n")
 
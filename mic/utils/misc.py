@@ -23,10 +23,17 @@ import tempfile
 import re
 import shutil
 import glob
+import bz2
+import zlib
+import json
 import hashlib
 import subprocess
 import platform
 import traceback
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 try:
@@ -43,7 +50,7 @@ xmlparse = cElementTree.parse
 from mic import msger
 from mic.utils.errors import CreatorError, SquashfsError
 from mic.utils.fs_related import find_binary_path, makedirs
-from mic.utils.grabber import myurlgrab
+from mic.utils.grabber import myurlgrab, myurlopen
 from mic.utils.proxy import get_proxy_for
 from mic.utils import runner
 from mic.utils import rpmmisc
@@ -222,6 +229,11 @@ def check_space_pre_cp(src, dst):
         raise CreatorError("space on %s(%s) is not enough for about %s files"
                            % (dst, human_size(freesize), human_size(srcsize)))
 
+# read size of the checksum routines, large reads keep the disk streaming
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+# digests computed by get_file_hashes() by default
+HASH_NAMES = ('md5', 'sha1', 'sha256')
+
 def calc_hashes(file_path, hash_names, start = 0, end = None):
     """ Calculate hashes for a file. The 'file_path' argument is the file
     to calculate hash functions for, 'start' and 'end' are the starting and
@@ -233,7 +245,7 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
     if end == None:
         end = os.path.getsize(file_path)
 
-    chunk_size = 65536
+    chunk_size = HASH_CHUNK_SIZE
     to_read = end - start
     read = 0
 
@@ -248,9 +260,11 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
             if read + chunk_size > to_read:
                 chunk_size = to_read - read
             chunk = f.read(chunk_size)
+            if not chunk:
+                break
             for hash_obj in hashes:
                 hash_obj.update(chunk)
-            read += chunk_size
+            read += len(chunk)
 
     result = []
     for hash_obj in hashes:
@@ -258,14 +272,89 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
 
     return result
 
+# number of files whose digests are kept, the least recently used go first
+HASHES_CACHE_SIZE = 256
+
+# (path, size, mtime) -> {hash name: hex digest}
+_hashes_cache = collections.OrderedDict()
+_hashes_lock = threading.Lock()
+
+def _hashes_key(file_path):
+    st = os.stat(file_path)
+    return (os.path.abspath(file_path), st.st_size, st.st_mtime)
+
+def _cached_hashes(key):
+    with _hashes_lock:
+        # a miss is not inserted, _update_hashes() adds and trims
+        hashes = _hashes_cache.pop(key, None)
+        if hashes is None:
+            return {}
+        _hashes_cache[key] = hashes
+        return dict(hashes)
+
+def _update_hashes(key, hashes):
+    with _hashes_lock:
+        cached = _hashes_cache.pop(key, {})
+        cached.update(hashes)
+        _hashes_cache[key] = cached
+        while len(_hashes_cache) > HASHES_CACHE_SIZE:
+            _hashes_cache.popitem(last=False)
+
+def cache_file_hashes(file_path, hashes):
+    """ Record the digests of a file computed elsewhere, so that later
+    get_file_hashes() calls don't read it again
+    """
+    _update_hashes(_hashes_key(file_path), hashes)
+
+def move_file_hashes(src, dst):
+    """ Carry the cached digests of src over to dst after it was moved """
+    src = os.path.abspath(src)
+    with _hashes_lock:
+        moved = [(key, _hashes_cache.pop(key))
+                 for key in _hashes_cache.keys() if key[0] == src]
+    for key, hashes in moved:
+        if os.path.exists(dst) and _hashes_key(dst)[1] == key[1]:
+            cache_file_hashes(dst, hashes)
+
+def get_file_hashes(file_paths, workers = None, hash_names = HASH_NAMES):
+    """ Return {path: {hash name: hex digest}} for the 'hash_names' digests
+    of every file of 'file_paths'. Each file is read at most once, for all
+    the digests missing from the cache, and different files are hashed in
+    parallel. The results are cached by (path, size, mtime) and shared by
+    all the callers.
+    """
+    def _hash_file(file_path):
+        key = _hashes_key(file_path)
+        hashes = _cached_hashes(key)
+        missing = [name for name in hash_names if name not in hashes]
+        if missing:
+            values = dict(zip(missing, calc_hashes(file_path, missing)))
+            _update_hashes(key, values)
+            hashes.update(values)
+        return dict((name, hashes[name]) for name in hash_names)
+
+    file_paths = list(file_paths)
+    if len(file_paths) < 2:
+        return dict((fpath, _hash_file(fpath)) for fpath in file_paths)
+
+    # hashlib releases the GIL on large buffers, threads are enough
+    pool = ThreadPool(min(workers or multiprocessing.cpu_count(), len(file_paths)))
+    try:
+        results = pool.map(_hash_file, file_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(file_paths, results))
+
 def get_md5sum(fpath):
-    return calc_hashes(fpath, ('md5', ))[0]
+    return get_file_hashes([fpath], hash_names = ('md5',))[fpath]['md5']
 
 def get_sha1sum(fpath):
-    return calc_hashes(fpath, ('sha1', ))[0]
+    return get_file_hashes([fpath], hash_names = ('sha1',))[fpath]['sha1']
 
 def get_sha256sum(fpath):
-    return calc_hashes(fpath, ('sha256', ))[0]
+    return get_file_hashes([fpath], hash_names = ('sha256',))[fpath]['sha256']
 
 def normalize_ksfile(ksconf, release, arch):
     '''
@@ -495,17 +584,105 @@ def get_repostrs_from_ks(ks):
 
     return kickstart_repos
 
-def _get_uncompressed_data_from_url(url, filename, proxies):
-    filename = myurlgrab(url.full, filename, proxies)
-    suffix = None
-    if filename.endswith(".gz"):
-        suffix = ".gz"
-        runner.quiet(['gunzip', "-f", filename])
-    elif filename.endswith(".bz2"):
-        suffix = ".bz2"
-        runner.quiet(['bunzip2', "-f", filename])
-    if suffix:
-        filename = filename.replace(suffix, "")
+# concurrent downloads of repo metadata
+METADATA_WORKERS = 8
+METADATA_CHUNK = 65536
+
+def _new_digest(sumtype):
+    # repomd.xml calls sha1 'sha'
+    return hashlib.new(sumtype == "sha" and "sha1" or sumtype)
+
+def _digest_file(filename):
+    return filename + ".digest"
+
+def _cached_metadata(filename, sumtype, checksum):
+    """ Whether filename is in the cache with the given checksum, as
+        recorded in its digest file when it was downloaded
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+
+    try:
+        with open(_digest_file(filename)) as rf:
+            stored = rf.read().split()
+    except IOError:
+        stored = []
+    if stored == [sumtype, checksum, str(st.st_size), str(int(st.st_mtime))]:
+        return True
+    if stored:
+        return False
+
+    # cached before the digest files existed
+    digest = _new_digest(sumtype)
+    with open(filename, 'rb') as rf:
+        for chunk in iter(lambda: rf.read(METADATA_CHUNK), ''):
+            digest.update(chunk)
+    if digest.hexdigest() != checksum:
+        return False
+    _save_digest(filename, sumtype, checksum)
+    return True
+
+def _save_digest(filename, sumtype, checksum):
+    st = os.stat(filename)
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'w') as wf:
+        wf.write("%s %s %d %d\n" % (sumtype, checksum, st.st_size,
+                                    int(st.st_mtime)))
+    os.rename(tmpfile, _digest_file(filename))
+
+def _stream_metadata(url, filename, proxies, sumtype=None, checksum=None):
+    """ Download url to filename, decompressing .gz and .bz2 data and
+        checking the checksum of the uncompressed data as it comes. The
+        file is renamed into place once complete.
+    """
+    gzipped = url.endswith(".gz")
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif url.endswith(".bz2"):
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        decompressor = None
+    digest = sumtype and _new_digest(sumtype)
+
+    msger.info("Retrieving %s ..." % os.path.basename(url))
+    fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                   suffix=".part",
+                                   dir=os.path.dirname(filename))
+    try:
+        src = myurlopen(url, proxies)
+        try:
+            with os.fdopen(fd, 'wb') as wf:
+                for chunk in iter(lambda: src.read(METADATA_CHUNK), ''):
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                        # concatenated gzip members
+                        while gzipped and decompressor.unused_data:
+                            rest = decompressor.unused_data
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                            chunk += decompressor.decompress(rest)
+                    if digest:
+                        digest.update(chunk)
+                    wf.write(chunk)
+        finally:
+            src.close()
+
+        if digest and checksum and digest.hexdigest() != checksum:
+            raise CreatorError("Checksum of %s doesn't match repomd.xml, "
+                               "expected %s, got %s" % (SafeURL(url), checksum,
+                                                        digest.hexdigest()))
+        os.rename(tmpfile, filename)
+    except (IOError, EOFError, zlib.error), err:
+        # bz2 raises EOFError for data past the end of the stream
+        os.unlink(tmpfile)
+        raise CreatorError("Failed to retrieve %s: %s" % (SafeURL(url), err))
+    except:
+        os.unlink(tmpfile)
+        raise
+
+    if digest and checksum:
+        _save_digest(filename, sumtype, checksum)
     return filename
 
 def _get_metadata_from_repo(baseurl, proxies, cachedir, reponame, filename,
@@ -516,162 +693,257 @@ def _get_metadata_from_repo(baseurl, proxies, cachedir, reponame, filename,
         filename = os.path.splitext(filename_tmp)[0]
     else:
         filename = filename_tmp
-    if sumtype and checksum and os.path.exists(filename):
-        try:
-            sumcmd = find_binary_path("%ssum" % sumtype)
-        except:
-            file_checksum = None
-        else:
-            file_checksum = runner.outs([sumcmd, filename]).split()[0]
+    if sumtype and checksum and _cached_metadata(filename, sumtype, checksum):
+        return filename
 
-        if file_checksum and file_checksum == checksum:
-            return filename
+    return _stream_metadata(url.full, filename, proxies, sumtype, checksum)
 
-    return _get_uncompressed_data_from_url(url,filename_tmp,proxies)
+def _parse_repomd(repomd):
+    """ Return the location, checksum and checksum type of the primary,
+        patterns and comps data listed in repomd, None without primary
+    """
+    try:
+        root = xmlparse(repomd)
+    except SyntaxError:
+        raise CreatorError("repomd.xml syntax error.")
+
+    ns = root.getroot().tag
+    ns = ns[0:ns.rindex("}")+1]
+
+    found = {}
+    for item, types in (("patterns", ("patterns",)),
+                        ("comps", ("group_gz", "group")),
+                        ("primary", ("primary_db", "primary"))):
+        for elm in root.getiterator("%sdata" % ns):
+            if elm.attrib["type"] in types:
+                checksum = elm.find("%sopen-checksum" % ns)
+                found[item] = (elm.find("%slocation" % ns).attrib['href'],
+                               checksum.text, checksum.attrib['type'])
+                break
+
+    if "primary" not in found:
+        return None
+    return found
+
+# repo metadata already fetched by this process, keyed by
+# (cachedir, reponame, baseurl); forked builds inherit it
+_fetched_repo_metadata = {}
 
 def get_metadata_from_repos(repos, cachedir):
-    my_repo_metadata = []
+    todo = []
     for repo in repos:
-        reponame = repo.name
-        baseurl = repo.baseurl
+        key = (cachedir, repo.name, getattr(repo.baseurl, 'full', repo.baseurl))
+        if key in _fetched_repo_metadata or key in [item[1] for item in todo]:
+            continue
 
         if hasattr(repo, 'proxy'):
             proxy = repo.proxy
         else:
-            proxy = get_proxy_for(baseurl)
+            proxy = get_proxy_for(repo.baseurl)
 
         proxies = None
         if proxy:
-            proxies = {str(baseurl.split(":")[0]): str(proxy)}
-
-        makedirs(os.path.join(cachedir, reponame))
-        url = baseurl.join("repodata/repomd.xml")
-        filename = os.path.join(cachedir, reponame, 'repomd.xml')
-        repomd = myurlgrab(url.full, filename, proxies)
+            proxies = {str(repo.baseurl.split(":")[0]): str(proxy)}
+        todo.append((repo, key, proxies))
+
+    def _fetch_repomd(item):
+        repo, key, proxies = item
+        makedirs(os.path.join(cachedir, repo.name))
+        repomd = _stream_metadata(repo.baseurl.join("repodata/repomd.xml").full,
+                                  os.path.join(cachedir, repo.name, 'repomd.xml'),
+                                  proxies)
+        return repomd, _parse_repomd(repomd)
+
+    def _fetch_file(job):
+        idx, location, checksum, sumtype = job
+        repo, key, proxies = todo[idx]
+        if location == "repodata/repomd.xml.key":
+            try:
+                return _get_metadata_from_repo(repo.baseurl, proxies, cachedir,
+                                               repo.name, location)
+            except CreatorError:
+                msger.debug("\ncan't get %s/%s" % (repo.baseurl, location))
+                return None
+        return _get_metadata_from_repo(repo.baseurl, proxies, cachedir,
+                                       repo.name, location, sumtype, checksum)
+
+    if todo:
+        # every repo and every file of them is fetched concurrently
+        pool = ThreadPool(min(METADATA_WORKERS, len(todo) * 4))
         try:
-            root = xmlparse(repomd)
-        except SyntaxError:
-            raise CreatorError("repomd.xml syntax error.")
+            repomds = pool.map(_fetch_repomd, todo)
 
-        ns = root.getroot().tag
-        ns = ns[0:ns.rindex("}")+1]
-
-        filepaths = {}
-        checksums = {}
-        sumtypes = {}
+            jobs = []
+            for idx, (repomd, found) in enumerate(repomds):
+                if not found:
+                    continue
+                for item in ("primary", "patterns", "comps"):
+                    if item in found:
+                        jobs.append((idx,) + found[item])
+                jobs.append((idx, "repodata/repomd.xml.key", None, None))
+            results = dict(zip([job[:2] for job in jobs],
+                               pool.map(_fetch_file, jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        for idx, (repomd, found) in enumerate(repomds):
+            if not found:
+                continue
+            repo, key, proxies = todo[idx]
+            metadata = {"name":repo.name,
+                        "baseurl":repo.baseurl,
+                        "repomd":repomd,
+                        "primary_checksum":found["primary"][1],
+                        "cachedir":cachedir,
+                        "proxies":proxies,
+                        "repokey":results[(idx, "repodata/repomd.xml.key")]}
+            for item in ("primary", "patterns", "comps"):
+                if item in found:
+                    metadata[item] = results[(idx, found[item][0])]
+                else:
+                    metadata[item] = None
+            _fetched_repo_metadata[key] = metadata
 
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] == "patterns":
-                filepaths['patterns'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['patterns'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['patterns'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
+    my_repo_metadata = []
+    for repo in repos:
+        key = (cachedir, repo.name, getattr(repo.baseurl, 'full', repo.baseurl))
+        if key in _fetched_repo_metadata:
+            my_repo_metadata.append(dict(_fetched_repo_metadata[key],
+                                         priority=repo.priority))
+    return my_repo_metadata
 
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("group_gz", "group"):
-                filepaths['comps'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['comps'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['comps'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
+PKGINDEX_FILE = "pkgindex.sqlite"
 
-        primary_type = None
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("primary_db", "primary"):
-                primary_type = elm.attrib["type"]
-                filepaths['primary'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['primary'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['primary'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
+_PKGINDEX_SCHEMA = """
+CREATE TABLE db_info (checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, name TEXT, arch TEXT,
+                       epoch TEXT, version TEXT, release TEXT,
+                       location_href TEXT, rpm_sourcerpm TEXT);
+CREATE INDEX packagename ON packages (name);
+CREATE INDEX packagearch ON packages (arch);
+"""
 
-        if not primary_type:
+def _iter_primary_xml(primary):
+    """ Walk the <package> elements of primary.xml without keeping the
+        whole tree in memory, yielding one row per package
+    """
+    ns = None
+    for event, elm in cElementTree.iterparse(primary, events=("start", "end")):
+        if ns is None:
+            ns = elm.tag[0:elm.tag.rindex("}")+1]
+            continue
+        if event != "end" or elm.tag != "%spackage" % ns:
             continue
 
-        for item in ("primary", "patterns", "comps"):
-            if item not in filepaths:
-                filepaths[item] = None
-                continue
-            if not filepaths[item]:
-                continue
-            filepaths[item] = _get_metadata_from_repo(baseurl,
-                                                      proxies,
-                                                      cachedir,
-                                                      reponame,
-                                                      filepaths[item],
-                                                      sumtypes[item],
-                                                      checksums[item])
-
-        """ Get repo key """
+        version = elm.find("%sversion" % ns)
+        location = elm.find("%slocation" % ns)
+        sourcerpm = None
+        fmt = elm.find("%sformat" % ns)
+        if fmt is not None:
+            for node in fmt.getchildren():
+                if node.tag.endswith("}sourcerpm"):
+                    sourcerpm = node.text
+                    break
+
+        yield (elm.find("%sname" % ns).text,
+               elm.find("%sarch" % ns).text,
+               version.attrib.get('epoch'),
+               version.attrib['ver'],
+               version.attrib['rel'],
+               location.attrib['href'],
+               sourcerpm)
+        elm.clear()
+
+def _build_pkgindex(primary, indexfile, checksum):
+    # a temporary file of its own, builds sharing the cachedir may build
+    # the same index at the same time
+    fd, tmpfile = tempfile.mkstemp(prefix=PKGINDEX_FILE + ".",
+                                   dir=os.path.dirname(indexfile))
+    os.close(fd)
+    try:
+        con = sqlite.connect(tmpfile)
         try:
-            repokey = _get_metadata_from_repo(baseurl,
-                                              proxies,
-                                              cachedir,
-                                              reponame,
-                                              "repodata/repomd.xml.key")
-        except CreatorError:
-            repokey = None
-            msger.debug("\ncan't get %s/%s" % (baseurl, "repodata/repomd.xml.key"))
-
-        my_repo_metadata.append({"name":reponame,
-                                 "baseurl":baseurl,
-                                 "repomd":repomd,
-                                 "primary":filepaths['primary'],
-                                 "cachedir":cachedir,
-                                 "proxies":proxies,
-                                 "patterns":filepaths['patterns'],
-                                 "comps":filepaths['comps'],
-                                 "repokey":repokey,
-                                 "priority":repo.priority})
+            con.executescript(_PKGINDEX_SCHEMA)
+            con.executemany("INSERT INTO packages (name, arch, epoch, "
+                            "version, release, location_href, "
+                            "rpm_sourcerpm) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            _iter_primary_xml(primary))
+            con.execute("INSERT INTO db_info (checksum) VALUES (?)",
+                        (checksum,))
+            con.commit()
+        finally:
+            con.close()
+        os.chmod(tmpfile, 0644)
+        os.rename(tmpfile, indexfile)
+    except:
+        os.unlink(tmpfile)
+        raise
 
-    return my_repo_metadata
+def _connect_pkgindex(dbfile):
+    con = sqlite.connect(dbfile)
+    con.text_factory = str
+    return con
+
+def get_pkgindex(repo):
+    """ Return a sqlite connection to the package index of repo
+
+        A primary_db is already an indexed sqlite database and is used as
+        is. A primary.xml is parsed once into PKGINDEX_FILE next to it in
+        the repo cachedir, and the index is rebuilt only when the primary
+        checksum recorded in repomd.xml changes.
+    """
+    primary = repo["primary"]
+    if primary.endswith(".sqlite"):
+        return _connect_pkgindex(primary)
+
+    checksum = repo.get("primary_checksum")
+    if not checksum:
+        st = os.stat(primary)
+        checksum = "%d-%d" % (st.st_size, int(st.st_mtime))
+
+    indexfile = os.path.join(os.path.dirname(primary), PKGINDEX_FILE)
+    if os.path.exists(indexfile):
+        con = _connect_pkgindex(indexfile)
+        try:
+            row = con.execute("SELECT checksum FROM db_info").fetchone()
+        except sqlite.DatabaseError:
+            row = None
+        if row and row[0] == checksum:
+            return con
+        # replaced by the rename, another build may be reading it
+        con.close()
+
+    msger.debug("building package index for %s" % repo["name"])
+    _build_pkgindex(primary, indexfile, checksum)
+    return _connect_pkgindex(indexfile)
 
 def get_rpmver_in_repo(repometadata):
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-
-            versionlist = []
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == 'rpm':
-                    for node in elm.getchildren():
-                        if node.tag == "%sversion" % ns:
-                            versionlist.append(node.attrib['ver'])
-
-            if versionlist:
-                return reversed(
-                         sorted(
-                           versionlist,
-                           key = lambda ver: map(int, ver.split('.')))).next()
-
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version from packages where "
-                                   "name=\"rpm\" ORDER by version DESC"):
-                con.close()
-                return row[0]
+        con = get_pkgindex(repo)
+        versionlist = [row[0] for row in
+                       con.execute("SELECT version FROM packages "
+                                   "WHERE name = 'rpm'")]
+        con.close()
+
+        if versionlist:
+            return reversed(
+                     sorted(
+                       versionlist,
+                       key = lambda ver: map(int, ver.split('.')))).next()
 
     return None
 
 def get_arch(repometadata):
     archlist = []
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sarch" % ns).text not in ("noarch", "src"):
-                    arch = elm.find("%sarch" % ns).text
-                    if arch not in archlist:
-                        archlist.append(arch)
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select arch from packages where arch not in (\"src\", \"noarch\")"):
-                if row[0] not in archlist:
-                    archlist.append(row[0])
-
-            con.close()
+        con = get_pkgindex(repo)
+        for row in con.execute("SELECT arch FROM packages "
+                               "WHERE arch NOT IN ('src', 'noarch') "
+                               "GROUP BY arch ORDER BY min(pkgKey)"):
+            if row[0] not in archlist:
+                archlist.append(row[0])
+        con.close()
 
     uniq_arch = []
     for i in range(len(archlist)):
@@ -709,55 +981,33 @@ def get_package(pkg, repometadata, arch = None):
         arches.append('noarch')
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg:
-                    if elm.find("%sarch" % ns).text in arches:
-                        if repo["priority"] != None:
-                            tmpprior = int(repo["priority"])
-                            if tmpprior < priority:
-                                priority = tmpprior
-                                location = elm.find("%slocation" % ns)
-                                pkgpath = "%s" % location.attrib['href']
-                                target_repo = repo
-                                break
-                            elif tmpprior > priority:
-                                break
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            location = elm.find("%slocation" % ns)
-                            pkgpath = "%s" % location.attrib['href']
-                            target_repo = repo
-                        break
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            if arch:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s" and arch IN ("%s")' % \
-                      (pkg, '","'.join(arches))
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            else:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s"' % pkg
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            con.close()
+        con = get_pkgindex(repo)
+        sql = "SELECT version, release, location_href FROM packages " \
+              "WHERE name = ?"
+        args = [pkg]
+        if arches:
+            sql += " AND arch IN (%s)" % ",".join("?" * len(arches))
+            args.extend(arches)
+        row = con.execute(sql + " ORDER BY pkgKey LIMIT 1", args).fetchone()
+        con.close()
+        if not row:
+            continue
+
+        if repo["priority"] != None:
+            tmpprior = int(repo["priority"])
+            if tmpprior < priority:
+                priority = tmpprior
+                pkgpath = "%s" % row[2]
+                target_repo = repo
+                continue
+            elif tmpprior > priority:
+                continue
+        tmpver = "%s-%s" % (row[0], row[1])
+        if tmpver > ver:
+            ver = tmpver
+            pkgpath = "%s" % row[2]
+            target_repo = repo
+
     if target_repo:
         makedirs("%s/packages/%s" % (target_repo["cachedir"], target_repo["name"]))
         url = target_repo["baseurl"].join(pkgpath)
@@ -767,9 +1017,9 @@ def get_package(pkg, repometadata, arch = None):
             if ret == 0:
                 return filename
 
+            # replaced by the download, other builds may be reading it
             msger.warning("package %s is damaged: %s" %
                           (os.path.basename(filename), filename))
-            os.unlink(filename)
 
         pkg = myurlgrab(url.full, filename, target_repo["proxies"])
         return pkg
@@ -798,101 +1048,124 @@ def get_source_name(pkg, repometadata):
         return None
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg_name:
-                    if elm.find("%sarch" % ns).text != "src":
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            fmt = elm.find("%sformat" % ns)
-                            if fmt:
-                                fns = fmt.getchildren()[0].tag
-                                fns = fns[0:fns.rindex("}")+1]
-                                pkgpath = fmt.find("%ssourcerpm" % fns).text
-                                target_repo = repo
-                        break
-
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version, release, rpm_sourcerpm from packages where name = \"%s\" and arch != \"src\"" % pkg_name):
-                tmpver = "%s-%s" % (row[0], row[1])
-                if tmpver > ver:
-                    pkgpath = "%s" % row[2]
-                    target_repo = repo
-                break
-            con.close()
+        con = get_pkgindex(repo)
+        row = con.execute("SELECT version, release, rpm_sourcerpm "
+                          "FROM packages WHERE name = ? AND arch != 'src' "
+                          "ORDER BY pkgKey LIMIT 1", (pkg_name,)).fetchone()
+        con.close()
+        if not row or not row[2]:
+            continue
+
+        tmpver = "%s-%s" % (row[0], row[1])
+        if tmpver > ver:
+            ver = tmpver
+            pkgpath = "%s" % row[2]
+            target_repo = repo
+
     if target_repo:
         return get_src_name(pkgpath)
     else:
         return None
 
-def get_pkglist_in_patterns(group, patterns):
-    found = False
+GROUPINDEX_SUFFIX = ".groupindex"
+GROUPINDEX_VERSION = 1
+
+# group indexes loaded by this process, keyed by group file
+_group_indexes = {}
+
+def _add_group(index, names, pkgs):
+    """ Map every name of a group to its packages, in order and once each,
+        the first group with a name wins
+    """
+    seen = set()
     pkglist = []
+    for pkg in pkgs:
+        if pkg not in seen:
+            seen.add(pkg)
+            pkglist.append(pkg)
+    for name in names:
+        if name is not None:
+            index.setdefault(name, pkglist)
+
+def _index_patterns(patterns):
     try:
         root = xmlparse(patterns)
     except SyntaxError:
         raise SyntaxError("%s syntax error." % patterns)
 
+    index = {}
     for elm in list(root.getroot()):
         ns = elm.tag
         ns = ns[0:ns.rindex("}")+1]
-        name = elm.find("%sname" % ns)
-        summary = elm.find("%ssummary" % ns)
-        if name.text == group or summary.text == group:
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    found = False
-    for requires in list(elm):
-        if requires.tag.endswith("requires"):
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    for pkg in list(requires):
-        pkgname = pkg.attrib["name"]
-        if pkgname not in pkglist:
-            pkglist.append(pkgname)
-
-    return pkglist
+        names = [node.text for node in (elm.find("%sname" % ns),
+                                        elm.find("%ssummary" % ns))
+                 if node is not None]
+
+        pkgs = []
+        for requires in list(elm):
+            if requires.tag.endswith("requires"):
+                pkgs = [pkg.attrib["name"] for pkg in list(requires)]
+                break
+        _add_group(index, names, pkgs)
+    return index
 
-def get_pkglist_in_comps(group, comps):
-    found = False
-    pkglist = []
+def _index_comps(comps):
     try:
         root = xmlparse(comps)
     except SyntaxError:
         raise SyntaxError("%s syntax error." % comps)
 
+    index = {}
     for elm in root.getiterator("group"):
-        id = elm.find("id")
-        name = elm.find("name")
-        if id.text == group or name.text == group:
-            packagelist = elm.find("packagelist")
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    for require in elm.getiterator("packagereq"):
-        if require.tag.endswith("packagereq"):
-            pkgname = require.text
-        if pkgname not in pkglist:
-            pkglist.append(pkgname)
-
-    return pkglist
+        names = [node.text for node in (elm.find("id"), elm.find("name"))
+                 if node is not None]
+        _add_group(index, names, [require.text for require in
+                                  elm.getiterator("packagereq")])
+    return index
+
+def get_group_index(groupfile, builder):
+    """ Return the index of groupfile mapping the group ids and names to
+        their package lists
+
+        The index is built by builder once per revision of groupfile and
+        saved next to it in the repo cachedir.
+    """
+    st = os.stat(groupfile)
+    revision = "%d-%d-%d" % (GROUPINDEX_VERSION, st.st_size, int(st.st_mtime))
+    if groupfile in _group_indexes and \
+       _group_indexes[groupfile][0] == revision:
+        return _group_indexes[groupfile][1]
+
+    indexfile = groupfile + GROUPINDEX_SUFFIX
+    index = None
+    try:
+        with open(indexfile) as rf:
+            data = json.load(rf)
+        if data["revision"] == revision:
+            index = dict((str(name), [str(pkg) for pkg in pkgs])
+                         for name, pkgs in data["groups"].items())
+    except (IOError, ValueError, KeyError):
+        pass
+
+    if index is None:
+        msger.debug("building group index for %s" % groupfile)
+        index = builder(groupfile)
+        try:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+            with os.fdopen(fd, 'w') as wf:
+                json.dump({"revision": revision, "groups": index}, wf)
+            os.rename(tmpfile, indexfile)
+        except (IOError, OSError), err:
+            msger.debug("can't save group index %s: %s" % (indexfile, err))
+
+    _group_indexes[groupfile] = (revision, index)
+    return index
+
+def get_pkglist_in_patterns(group, patterns):
+    return list(get_group_index(patterns, _index_patterns).get(group, []))
+
+def get_pkglist_in_comps(group, comps):
+    return list(get_group_index(comps, _index_comps).get(group, []))
 
 def is_statically_linked(binary):
     return ", statically linked, " in runner.outs(['file', binary])
@@ -19,12 +19,16 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
+import uuid
 
 from mic import msger
 from mic.utils import runner
 from mic.utils.errors import MountError, CreatorError
 from mic.utils.fs_related import *
-from mic.utils.gpt_parser import GptParser
+from mic.utils.gpt_parser import write_partition_table, GPT_TYPE_LINUX, \
+                                 GPT_TYPE_SWAP, GPT_TYPE_BASIC_DATA, \
+                                 MBR_TYPE_LINUX, MBR_TYPE_SWAP, \
+                                 MBR_TYPE_FAT16, MBR_TYPE_FAT32
 
 # Overhead of the MBR partitioning scheme (just one sector)
 MBR_OVERHEAD = 1
@@ -50,7 +54,6 @@ class PartitionedMount(Mount):
         self.mapped = False
         self.mount_order = []
         self.unmount_order = []
-        self.parted = find_binary_path("parted")
         self.kpartx = find_binary_path("kpartx")
         self.mkswap = find_binary_path("mkswap")
         self.dmsetup = find_binary_path("dmsetup")
@@ -77,6 +80,7 @@ class PartitionedMount(Mount):
         self.disks[disk_name] = \
                 { 'disk': None,     # Disk object
                   'mapped': False,  # True if kpartx mapping exists
+                  'partscan': False, # True if the kernel maps partitions
                   'numpart': 0,     # Number of allocate partitions
                   'partitions': [], # Indexes to self.partitions
                   'offset': 0,      # Offset of next partition (in sectors)
@@ -91,6 +95,9 @@ class PartitionedMount(Mount):
 
         self.__add_disk(disk_name)
         self.disks[disk_name]['disk'] = disk_obj
+        if hasattr(disk_obj, 'partscan'):
+            # use the partitions of the loop device instead of kpartx
+            disk_obj.partscan = True
 
     def __add_partition(self, part):
         """ This is a helper function for 'add_partition()' which adds a
@@ -271,36 +278,6 @@ class PartitionedMount(Mount):
 
             d['min_size'] *= self.sector_size
 
-    def __run_parted(self, args):
-        """ Run parted with arguments specified in the 'args' list. """
-
-        args.insert(0, self.parted)
-        msger.debug(args)
-
-        rc, out = runner.runtool(args, catch = 3)
-        out = out.strip()
-        msger.debug("'parted': exitcode: %d, output: %s" % (rc, out))
-        # We don't throw exception when return code is not 0, because
-        # parted always fails to reload part table with loop devices. This
-        # prevents us from distinguishing real errors based on return
-        # code.
-        return rc, out
-
-    def __create_partition(self, device, parttype, fstype, start, size):
-        """ Create a partition on an image described by the 'device' object. """
-
-        # Start is included to the size so we need to subtract one from the end.
-        end = start + size - 1
-        msger.debug("Added '%s' partition, sectors %d-%d, size %d sectors" %
-                    (parttype, start, end, size))
-
-        args = ["-s", device, "unit", "s", "mkpart", parttype]
-        if fstype:
-            args.extend([fstype])
-        args.extend(["%d" % start, "%d" % end])
-
-        return self.__run_parted(args)
-
     def __format_disks(self):
         self.layout_partitions()
 
@@ -310,94 +287,66 @@ class PartitionedMount(Mount):
 
         for dev in self.disks.keys():
             d = self.disks[dev]
-            msger.debug("Initializing partition table for %s" % \
-                        (d['disk'].device))
-            self.__run_parted(["-s", d['disk'].device, "mklabel",
-                               d['ptable_format']])
+            entries = []
+            for n in d['partitions']:
+                p = self.partitions[n]
+
+                # Boot ROM of OMAP boards require vfat boot partition to have
+                # an even number of sectors.
+                if p['mountpoint'] == "/boot" and \
+                   p['fstype'] in ["vfat", "msdos"] and p['size'] % 2:
+                    msger.debug("Substracting one sector from '%s' partition " \
+                                "to get even number of sectors for the " \
+                                "partition" % p['mountpoint'])
+                    p['size'] -= 1
 
-        msger.debug("Creating partitions")
+                msger.debug("Added '%s' partition, sectors %d-%d, size %d " \
+                            "sectors" % (p['type'], p['start'],
+                                         p['start'] + p['size'] - 1,
+                                         p['size']))
+
+                entry = { 'start': p['start'],
+                          'size': p['size'],
+                          'boot': p['boot'] }
 
-        for p in self.partitions:
-            d = self.disks[p['disk_name']]
-            if d['ptable_format'] == "msdos" and p['num'] == 5:
-                # The last sector of the 3rd partition was reserved for the EBR
-                # of the first _logical_ partition. This is why the extended
-                # partition should start one sector before the first logical
-                # partition.
-                self.__create_partition(d['disk'].device, "extended",
-                                        None, p['start'] - 1,
-                                        d['offset'] - p['start'])
-
-            if p['fstype'] == "swap":
-                parted_fs_type = "linux-swap"
-            elif p['fstype'] == "vfat":
-                parted_fs_type = "fat32"
-            elif p['fstype'] == "msdos":
-                parted_fs_type = "fat16"
-            else:
-                # Type for ext2/ext3/ext4/btrfs
-                parted_fs_type = "ext2"
-
-            # Boot ROM of OMAP boards require vfat boot partition to have an
-            # even number of sectors.
-            if p['mountpoint'] == "/boot" and p['fstype'] in ["vfat", "msdos"] \
-               and p['size'] % 2:
-                msger.debug("Substracting one sector from '%s' partition to " \
-                            "get even number of sectors for the partition" % \
-                            p['mountpoint'])
-                p['size'] -= 1
-
-            self.__create_partition(d['disk'].device, p['type'],
-                                    parted_fs_type, p['start'], p['size'])
-
-            if p['boot']:
                 if d['ptable_format'] == 'gpt':
-                    flag_name = "legacy_boot"
+                    # PARTUUIDs are chosen here rather than read back
+                    p['partuuid'] = str(uuid.uuid4()).upper()
+                    if p['part_type']:
+                        type_uuid = p['part_type']
+                    elif p['fstype'] == "swap":
+                        type_uuid = GPT_TYPE_SWAP
+                    elif p['fstype'] in ("vfat", "msdos"):
+                        type_uuid = GPT_TYPE_BASIC_DATA
+                    else:
+                        type_uuid = GPT_TYPE_LINUX
+                    entry.update({ 'type_uuid': type_uuid,
+                                   'part_uuid': p['partuuid'],
+                                   # the name parted used to give them
+                                   'name': p['type'] })
+                    msger.debug("PARTUUID for partition %d on disk '%s' " \
+                                "(mount point '%s') is '%s', type '%s'" % \
+                                (p['num'], dev, p['mountpoint'],
+                                 p['partuuid'], type_uuid))
                 else:
-                    flag_name = "boot"
-                msger.debug("Set '%s' flag for partition '%s' on disk '%s'" % \
-                            (flag_name, p['num'], d['disk'].device))
-                cmd = ["-s", d['disk'].device,
-                       "set", "%d" % p['num'],
-                       flag_name, "on"]
-                exitcode, output = self.__run_parted(cmd)
-                if exitcode != 0:
-                    msger.warning(
-                        "partition '%s' is marked with --active, "
-                        "but flag '%s' can't be set: "
-                        "exitcode: %s, output: %s"
-                        % (p['mountpoint'], flag_name, exitcode, output))
-
-        # If the partition table format is "gpt", find out PARTUUIDs for all
-        # the partitions. And if users specified custom parition type UUIDs,
-        # set them.
-        for disk_name, disk in self.disks.items():
-            if disk['ptable_format'] != 'gpt':
-                continue
-
-            pnum = 0
-            gpt_parser = GptParser(disk['disk'].device, SECTOR_SIZE)
-            # Iterate over all GPT partitions on this disk
-            for entry in gpt_parser.get_partitions():
-                pnum += 1
-                # Find the matching partition in the 'self.partitions' list
-                for n in disk['partitions']:
-                    p = self.partitions[n]
-                    if p['num'] == pnum:
-                        # Found, fetch PARTUUID (partition's unique ID)
-                        p['partuuid'] = entry['part_uuid']
-                        msger.debug("PARTUUID for partition %d on disk '%s' " \
-                                    "(mount point '%s') is '%s'" % (pnum, \
-                                    disk_name, p['mountpoint'], p['partuuid']))
-                        if p['part_type']:
-                            entry['type_uuid'] = p['part_type']
-                            msger.debug("Change type of partition %d on disk " \
-                                        "'%s' (mount point '%s') to '%s'" % \
-                                        (pnum, disk_name, p['mountpoint'],
-                                         p['part_type']))
-                            gpt_parser.change_partition(entry)
-
-            del gpt_parser
+                    if p['fstype'] == "swap":
+                        system_id = MBR_TYPE_SWAP
+                    elif p['fstype'] == "vfat":
+                        system_id = MBR_TYPE_FAT32
+                    elif p['fstype'] == "msdos":
+                        system_id = MBR_TYPE_FAT16
+                    else:
+                        # Type for ext2/ext3/ext4/btrfs
+                        system_id = MBR_TYPE_LINUX
+                    entry.update({ 'system_id': system_id,
+                                   'logical': p['type'] == 'logical' })
+
+                entries.append(entry)
+
+            msger.debug("Writing %s partition table to %s" % \
+                        (d['ptable_format'], d['disk'].device))
+            write_partition_table(d['disk'].device, d['ptable_format'],
+                                  entries, self.sector_size)
 
     def __map_partitions(self):
         """Load it if dm_snapshot isn't loaded. """
@@ -408,6 +357,21 @@ class PartitionedMount(Mount):
             if d['mapped']:
                 continue
 
+            if getattr(d['disk'], 'partscan', False):
+                nums = [self.partitions[n]['num'] for n in d['partitions']]
+                parts = rescan_loop_partitions(d['disk'].device, nums)
+                if parts:
+                    for n, part in zip(d['partitions'], parts):
+                        msger.debug("Dev %s: kernel partition" % part)
+                        self.partitions[n]['device'] = part
+                        self.partitions[n]['mapper_device'] = part
+                        self.partitions[n]['mpath_device'] = ''
+                    d['mapped'] = True
+                    d['partscan'] = True
+                    continue
+                msger.debug("No kernel partitions for %s, using kpartx" %
+                            d['disk'].device)
+
             msger.debug("Running kpartx on %s" % d['disk'].device )
             rc, kpartx_output = runner.runtool([self.kpartx, "-l", "-v", d['disk'].device])
             kpartx_output = kpartx_output.splitlines()
@@ -497,6 +461,14 @@ class PartitionedMount(Mount):
             if not d['mapped']:
                 continue
 
+            if d['partscan']:
+                # the partitions go away with the loop device
+                for pnum in d['partitions']:
+                    self.partitions[pnum]['device'] = None
+                d['mapped'] = False
+                d['partscan'] = False
+                continue
+
             msger.debug("Removing compat symlinks")
             for pnum in d['partitions']:
                 if self.partitions[pnum]['device'] != None:
@@ -640,12 +612,13 @@ class PartitionedMount(Mount):
     def __create_subvolumes(self, p, pdisk):
         """ Create all the subvolumes. """
 
-        for subvol in self.subvolumes:
-            argv = [ self.btrfscmd, "subvolume", "create", pdisk.mountdir + "/" + subvol["subvol"]]
+        with runner.Shell() as shell:
+            for subvol in self.subvolumes:
+                argv = [ self.btrfscmd, "subvolume", "create", pdisk.mountdir + "/" + subvol["subvol"]]
 
-            rc = runner.show(argv)
-            if rc != 0:
-                raise MountError("Failed to create subvolume '%s', return code: %d." % (subvol["subvol"], rc))
+                rc = shell.show(argv)
+                if rc != 0:
+                    raise MountError("Failed to create subvolume '%s', return code: %d." % (subvol["subvol"], rc))
 
         # Set default subvolume, subvolume for "/" is default
         subvol = None
@@ -722,16 +695,17 @@ class PartitionedMount(Mount):
 
     def __unmount_subvolumes(self):
         """ It may be called multiple times, so we need to chekc if it is still mounted. """
-        for subvol in self.subvolumes:
-            if subvol["mountpoint"] == "/":
-                continue
-            if not subvol["mounted"]:
-                continue
-            mountpoint = self.mountdir + subvol['mountpoint']
-            rc = runner.show([self.umountcmd, mountpoint])
-            if rc != 0:
-                raise MountError("Failed to unmount subvolume %s from %s" % (subvol["subvol"], mountpoint))
-            subvol["mounted"] = False
+        with runner.Shell() as shell:
+            for subvol in self.subvolumes:
+                if subvol["mountpoint"] == "/":
+                    continue
+                if not subvol["mounted"]:
+                    continue
+                mountpoint = self.mountdir + subvol['mountpoint']
+                rc = shell.show([self.umountcmd, mountpoint])
+                if rc != 0:
+                    raise MountError("Failed to unmount subvolume %s from %s" % (subvol["subvol"], mountpoint))
+                subvol["mounted"] = False
 
     def __create_subvolume_snapshots(self, p, pdisk):
         import time
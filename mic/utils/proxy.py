@@ -16,13 +16,16 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
-import re
+import bisect
+import socket
+import binascii
 import urlparse
+import collections
 from mic import msger
 
 _my_proxies = {}
 _my_noproxy = None
-_my_noproxy_list = []
+_my_noproxy_matcher = None
 
 def set_proxy_environ():
     global _my_noproxy, _my_proxies
@@ -74,119 +77,158 @@ def _set_proxies(proxy = None, no_proxy = None):
             else:
                 _my_noproxy = value
 
-def _ip_to_int(ip):
-    ipint = 0
-    shift = 24
-    for dec in ip.split("."):
-        ipint |= int(dec) << shift
-        shift -= 8
-    return ipint
-
-def _int_to_ip(val):
-    ipaddr = ""
-    shift = 0
-    for i in range(4):
-        dec = val >> shift
-        dec &= 0xff
-        ipaddr = ".%d%s" % (dec, ipaddr)
-        shift += 8
-    return ipaddr[1:]
-
-def _isip(host):
-    if host.replace(".", "").isdigit():
-        return True
-    return False
+# per-host decisions kept by the compiled no_proxy list
+NOPROXY_CACHE_SIZE = 1024
 
-def _set_noproxy_list():
-    global _my_noproxy, _my_noproxy_list
-    _my_noproxy_list = []
-    if not _my_noproxy:
-        return
+# output of the commands found in no_proxy, they are run only once
+_backtick_results = {}
 
-    #solve in /etc/enviroment contains command like `echo 165.xxx.xxx.{1..255} | sed 's/ /,/g'``
-    _my_noproxy_bak = _my_noproxy
-    start = _my_noproxy.find("`")
-    while(start < len(_my_noproxy) and start != -1):
-        start = _my_noproxy.find("`",start)
-        end = _my_noproxy.find("`",start+1)
-        cmd = _my_noproxy[start+1:end]
-        pstr = _my_noproxy[start:end+1]
-        start = end + 1
-
-        _my_noproxy=_my_noproxy.replace(pstr,len(pstr)*" ")
+def _ip_to_int(ip):
+    """Return the family (4 or 6) and the integer value of the address ip,
+    None if ip isn't an address
+    """
+    for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
         try:
-            c_result = os.popen(cmd).readlines()
-            if len(c_result) == 0:
-                continue
-        except Exception,e:
-            msger.warning(str(e))
+            packed = socket.inet_pton(family, ip)
+        except (socket.error, ValueError):
             continue
-        to_list = c_result[0].strip("\n").split(",")
-        _my_noproxy_list.extend(to_list)
+        return version, int(binascii.hexlify(packed), 16)
+    return None
 
-    for item in _my_noproxy.split(","):
-        item = item.strip()
-        if not item:
-            continue
-
-        if item[0] != '.' and item.find("/") == -1:
-            # Need to match it
-            _my_noproxy_list.append({"match":0, "needle":item})
-
-        elif item[0] == '.':
-            # Need to match at tail
-            _my_noproxy_list.append({"match":1, "needle":item})
-
-        elif item.find("/") > 3:
-            # IP/MASK, need to match at head
-            needle = item[0:item.find("/")].strip()
-            ip = _ip_to_int(needle)
-            netmask = 0
-            mask = item[item.find("/")+1:].strip()
-
-            if mask.isdigit():
-                netmask = int(mask)
-                netmask = ~((1<<(32-netmask)) - 1)
-                ip &= netmask
-            else:
-                shift = 24
-                netmask = 0
-                for dec in mask.split("."):
-                    netmask |= int(dec) << shift
-                    shift -= 8
-                ip &= netmask
-
-            _my_noproxy_list.append({"match":2, "needle":ip, "netmask":netmask})
-    _my_noproxy = _my_noproxy_bak
-
-def _isnoproxy(url):
-    host = urlparse.urlparse(url)[1]
-    # urlparse.urlparse(url) returns (scheme, host, path, parm, query, frag)
+def _parse_network(item):
+    """Return the family and the first and last addresses of the network
+    written IP/BITS or IP/NETMASK in item, None if it isn't one
+    """
+    needle, mask = [part.strip() for part in item.split("/", 1)]
+    addr = _ip_to_int(needle)
+    if addr is None:
+        return None
+    version, ip = addr
+    width = version == 4 and 32 or 128
 
-    if '@' in host:
-        user_pass, host = host.split('@', 1)
+    if mask.isdigit():
+        bits = min(int(mask), width)
+        netmask = ((1 << width) - 1) ^ ((1 << (width - bits)) - 1)
+    else:
+        netmask = _ip_to_int(mask)
+        if netmask is None or netmask[0] != version:
+            return None
+        netmask = netmask[1]
 
-    if ':' in host:
-        host, port = host.split(':', 1)
+    first = ip & netmask
+    return version, first, first | (((1 << width) - 1) ^ netmask)
 
-    hostisip = _isip(host)
-    for item in _my_noproxy_list:
-        if hostisip and item["match"] == 1:
-            continue
+def _expand_backticks(value):
+    """Replace the `command` parts of value by the first line of their
+    output, which is a comma separated list
+    """
+    parts = value.split("`")
+    # an odd number of backticks leaves the last one alone
+    for i in range(1, len(parts) - 1 + len(parts) % 2, 2):
+        cmd = parts[i]
+        if cmd not in _backtick_results:
+            try:
+                output = os.popen(cmd).readlines()
+            except Exception, e:
+                msger.warning(str(e))
+                output = []
+            _backtick_results[cmd] = output and output[0].strip("\n") or ""
+        parts[i] = "," + _backtick_results[cmd] + ","
+    return "".join(parts)
+
+class _NoProxyMatcher(object):
+    """The no_proxy list compiled into a set of host names, a trie of the
+    domain suffixes and a sorted table of the address ranges per family
+    """
+    def __init__(self, items):
+        self.hosts = set()
+        self.suffixes = {}
+        self.ranges = {4: [], 6: []}
+        self._cache = collections.OrderedDict()
+
+        for item in items:
+            item = item.strip().lower()
+            if not item:
+                continue
 
-        if item["match"] == 2 and hostisip:
-            if (_ip_to_int(host) & item["netmask"]) == item["needle"]:
+            if item.find("/") > 3:
+                network = _parse_network(item)
+                if network:
+                    self.ranges[network[0]].append(network[1:])
+            elif item[0] == '.':
+                # matched at tail, by one or more labels before it
+                node = self.suffixes
+                for label in reversed(item[1:].split(".")):
+                    node = node.setdefault(label, {})
+                node[None] = True
+            else:
+                addr = _ip_to_int(item)
+                if addr:
+                    self.ranges[addr[0]].append((addr[1], addr[1]))
+                else:
+                    self.hosts.add(item)
+
+        for version, ranges in self.ranges.items():
+            ranges.sort()
+            merged = []
+            for first, last in ranges:
+                if merged and first <= merged[-1][1] + 1:
+                    if last > merged[-1][1]:
+                        merged[-1] = (merged[-1][0], last)
+                else:
+                    merged.append((first, last))
+            self.ranges[version] = (merged, [first for first, _ in merged])
+
+    def _lookup(self, host):
+        addr = _ip_to_int(host)
+        if addr:
+            ranges, firsts = self.ranges[addr[0]]
+            pos = bisect.bisect_right(firsts, addr[1]) - 1
+            return pos >= 0 and addr[1] <= ranges[pos][1]
+
+        if host in self.hosts:
+            return True
+
+        node = self.suffixes
+        labels = host.split(".")
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return False
+            if None in node:
                 return True
+        return False
 
-        if item["match"] == 0:
-            if host == item["needle"]:
-                return True
+    def match(self, host):
+        host = host.lower()
+        try:
+            found = self._cache.pop(host)
+        except KeyError:
+            found = self._lookup(host)
+            if len(self._cache) >= NOPROXY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        self._cache[host] = found
+        return found
 
-        if item["match"] == 1:
-            if re.match(r".*%s$" % item["needle"], host):
-                return True
+def _set_noproxy_list():
+    global _my_noproxy_matcher
+    _my_noproxy_matcher = None
+    if not _my_noproxy:
+        return
 
-    return False
+    #solve in /etc/enviroment contains command like `echo 165.xxx.xxx.{1..255} | sed 's/ /,/g'``
+    _my_noproxy_matcher = _NoProxyMatcher(
+                              _expand_backticks(_my_noproxy).split(","))
+
+def _isnoproxy(url):
+    if _my_noproxy_matcher is None:
+        return False
+
+    # strips the user, the port and the brackets around an IPv6 address
+    host = urlparse.urlparse(url).hostname
+    if not host:
+        return False
+    return _my_noproxy_matcher.match(host)
 
 def set_proxies(proxy = None, no_proxy = None):
     _set_proxies(proxy, no_proxy)
@@ -0,0 +1,144 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" Snapshots of installed root filesystems.
+
+The install root is saved as a tarball right after the packages are
+installed, under a key made of the resolved package set and the rpm
+macros that change what gets installed. A later build resolving to the
+same key extracts the tarball instead of downloading and installing the
+packages, and goes on with the configuration and the %post scripts.
+"""
+
+import os
+import glob
+import hashlib
+import tempfile
+
+from mic import msger
+from mic.utils import runner
+from mic.utils.errors import CreatorError
+from mic.utils.fs_related import find_binary_path, makedirs
+
+# bumped when the key or the tarball layout changes
+SNAPSHOT_VERSION = 2
+# number of snapshots kept, the least recently used are removed
+SNAPSHOT_KEEP = 8
+
+# what mount() and the package manager write into the install root for
+# the current build only: the bind mounted system directories, the device
+# nodes, the fstab holding the UUIDs of this build's partitions and the
+# captured rpm output; a snapshot only holds what the packages installed
+_EXCLUDES = ("./proc/*", "./sys/*", "./dev/*", "./etc/fstab", "./etc/mtab",
+             "./__catched_stderr.buf")
+
+class RootfsCache(object):
+    """ Install root snapshots stored in cachedir """
+    def __init__(self, cachedir, macros=None):
+        self.cachedir = cachedir
+        self.macros = macros or {}
+        self.key = None
+        self.restored = False
+
+    def __compress_option(self):
+        try:
+            return ".tar.zst", ["-I", find_binary_path("zstd")]
+        except CreatorError:
+            return ".tar.gz", ["-z"]
+
+    def __exclude_options(self):
+        return ["--exclude=%s" % pattern for pattern in _EXCLUDES]
+
+    def __find(self, key):
+        found = glob.glob(os.path.join(self.cachedir, key + ".tar.*"))
+        return found and found[0] or None
+
+    def __tar(self, args):
+        cmdln = [find_binary_path("tar"), "--numeric-owner", "--xattrs",
+                 "--xattrs-include=*"] + args
+        rc, out = runner.runtool(cmdln, catch=3)
+        if rc != 0:
+            raise CreatorError("tar failed (%d): %s" % (rc, out.strip()))
+
+    def lookup(self, packages, instroot):
+        """ Compute the key of the resolved packages, a list of
+            'name epoch:version-release.arch' strings, and restore the
+            matching snapshot into instroot if there is one.
+            Return whether it was restored.
+        """
+        sha = hashlib.sha256("mic-rootfs %d\n" % SNAPSHOT_VERSION)
+        for pkg in sorted(packages):
+            sha.update("pkg %s\n" % pkg)
+        for name in sorted(self.macros):
+            sha.update("macro %s=%s\n" % (name, self.macros[name]))
+        self.key = sha.hexdigest()
+
+        snapshot = self.__find(self.key)
+        if not snapshot:
+            msger.debug("no rootfs snapshot %s" % self.key)
+            return False
+
+        msger.info("Restoring installed packages from snapshot %s ..."
+                   % self.key[:12])
+        try:
+            # never overwrite what mount() wrote for this build
+            self.__tar(["-C", instroot, "-xpf", snapshot] +
+                       self.__exclude_options())
+        except CreatorError:
+            # don't offer it to the next builds
+            os.unlink(snapshot)
+            raise
+        # recently used snapshots are pruned last
+        os.utime(snapshot, None)
+        self.restored = True
+        return True
+
+    def save(self, instroot):
+        """ Save instroot as the snapshot of the looked up key """
+        if not self.key or self.restored or self.__find(self.key):
+            return
+
+        makedirs(self.cachedir)
+        suffix, compress = self.__compress_option()
+        fd, tmpfile = tempfile.mkstemp(prefix=self.key + ".",
+                                       suffix=".tmp", dir=self.cachedir)
+        os.close(fd)
+
+        msger.info("Saving rootfs snapshot %s ..." % self.key[:12])
+        try:
+            self.__tar(["-C", instroot] + compress +
+                       self.__exclude_options() + ["-cf", tmpfile, "."])
+            os.rename(tmpfile, os.path.join(self.cachedir,
+                                            self.key + suffix))
+        except (CreatorError, OSError), err:
+            msger.warning("Failed to save rootfs snapshot: %s" % err)
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            return
+
+        self.prune()
+
+    def prune(self, keep=SNAPSHOT_KEEP):
+        """ Remove all but the keep most recently used snapshots """
+        snapshots = glob.glob(os.path.join(self.cachedir, "*.tar.*"))
+        snapshots.sort(key=lambda path: os.stat(path).st_mtime,
+                       reverse=True)
+        for snapshot in snapshots[keep:]:
+            try:
+                os.unlink(snapshot)
+            except OSError:
+                pass
@@ -18,8 +18,19 @@
 import os
 import sys
 import re
+import json
+import fcntl
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import rpm
 
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    import sqlite
+
 from mic import msger
 from mic.utils.errors import CreatorError
 from mic.utils.proxy import get_proxy_for
@@ -210,13 +221,195 @@ class RPMInstallCallback:
 
                 msger.warning('(%s) Post script failed' % pkgname)
 
-def readRpmHeader(ts, filename):
-    """ Read an rpm header. """
+# headers of the rpms in the package cachedir, see setRpmHeaderCache
+HEADER_CACHE = "rpmheaders.sqlite"
+# the tags returned by readRpmHeaderInfo
+HEADER_TAGS = ('name', 'epoch', 'version', 'release', 'arch', 'license')
+
+_HEADER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER,
+                                    mtime REAL, name TEXT, epoch INTEGER,
+                                    version TEXT, release TEXT, arch TEXT,
+                                    license TEXT, blob BLOB);
+"""
+
+# headers and tags read by this build, keyed by (path, size, mtime)
+_rpm_headers = {}
+_rpm_header_tags = {}
+_header_store = None
+
+def _header_key(filename):
+    st = os.stat(filename)
+    return (os.path.realpath(filename), st.st_size, st.st_mtime)
+
+def _header_tags(hdr):
+    return dict((tag, hdr[tag]) for tag in HEADER_TAGS)
+
+class RpmHeaderStore(object):
+    """ Rpm header blobs and tags kept in a sqlite database, so that a
+        cached rpm is read once ever
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.con = sqlite.connect(dbfile, timeout=30)
+        self.con.text_factory = str
+        # a cache, losing the last puts on a crash is fine
+        self.con.execute("PRAGMA synchronous = OFF")
+        self.con.executescript(_HEADER_SCHEMA)
+
+    def _row(self, key, columns):
+        row = self.con.execute("SELECT size, mtime, %s FROM headers "
+                               "WHERE path = ?" % columns,
+                               (key[0],)).fetchone()
+        if row and row[0] == key[1] and row[1] == key[2]:
+            return row[2:]
+        return None
+
+    def get(self, key):
+        row = self._row(key, "blob")
+        if row:
+            try:
+                return rpm.hdr(str(row[0]))
+            except (rpm.error, TypeError):
+                pass
+        return None
+
+    def get_tags(self, key):
+        row = self._row(key, ", ".join(HEADER_TAGS))
+        return row and dict(zip(HEADER_TAGS, row))
+
+    def put(self, key, hdr):
+        tags = _header_tags(hdr)
+        self.con.execute("INSERT OR REPLACE INTO headers VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         key + tuple(tags[tag] for tag in HEADER_TAGS) +
+                         (sqlite.Binary(hdr.unload()),))
+        # no write lock is held between puts, other builds share the file
+        self.con.commit()
+
+    def close(self):
+        # forget the rpms removed from the cache
+        gone = [(path,) for (path,) in
+                self.con.execute("SELECT path FROM headers")
+                if not os.path.exists(path)]
+        self.con.executemany("DELETE FROM headers WHERE path = ?", gone)
+        self.con.commit()
+        self.con.close()
+
+def setRpmHeaderCache(dbfile):
+    """ Keep the headers read from now on in dbfile, None to stop. The
+        headers kept in memory by the previous build are dropped.
+    """
+    global _header_store
+    _rpm_headers.clear()
+    _rpm_header_tags.clear()
+    if _header_store:
+        try:
+            _header_store.close()
+        except sqlite.Error, err:
+            msger.debug("failed to save %s: %s" % (_header_store.dbfile, err))
+        _header_store = None
+
+    if dbfile:
+        try:
+            _header_store = RpmHeaderStore(dbfile)
+        except sqlite.Error, err:
+            msger.debug("can't open %s: %s" % (dbfile, err))
+
+def _store_call(method, *args):
+    """ Call method of the header store, which is given up on error """
+    try:
+        return getattr(_header_store, method)(*args)
+    except sqlite.Error, err:
+        msger.debug("rpm header cache disabled: %s" % err)
+        setRpmHeaderCache(None)
+        return None
 
-    fd = os.open(filename, os.O_RDONLY)
-    h = ts.hdrFromFdno(fd)
-    os.close(fd)
-    return h
+def readRpmHeader(ts, filename):
+    """ Read an rpm header, once per build for the same file. """
+
+    key = _header_key(filename)
+    hdr = _rpm_headers.get(key)
+    if hdr is not None:
+        return hdr
+
+    if _header_store:
+        hdr = _store_call('get', key)
+    if hdr is None:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            hdr = ts.hdrFromFdno(fd)
+        finally:
+            os.close(fd)
+        if _header_store:
+            _store_call('put', key, hdr)
+
+    _rpm_headers[key] = hdr
+    return hdr
+
+def readRpmHeaderInfo(ts, filename):
+    """ Return the HEADER_TAGS of an rpm as a dict, without reading its
+        header again if it was read before
+    """
+    key = _header_key(filename)
+    tags = _rpm_header_tags.get(key)
+    if tags is None and key not in _rpm_headers and _header_store:
+        tags = _store_call('get_tags', key)
+    if tags is None:
+        tags = _header_tags(readRpmHeader(ts, filename))
+    _rpm_header_tags[key] = tags
+    return tags
+
+class PackageContents(object):
+    """ The file lists of the installed packages, written to an anonymous
+        spool file as they are read, in the format of the .files record.
+        Only the offset of every package is kept in memory.
+    """
+    def __init__(self, tmpdir=None):
+        self._spool = tempfile.TemporaryFile(prefix="pkgcontent-",
+                                             dir=tmpdir)
+        self._offsets = {}
+
+    def add(self, pkg, filenames):
+        start = self._spool.tell()
+        self._spool.write(pkg + '\n')
+        if not filenames:
+            self._spool.write('    \n')
+        for filename in filenames:
+            self._spool.write('    %s\n' % filename)
+        self._spool.write('\n')
+        self._offsets[pkg] = (start, self._spool.tell() - start)
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, pkg):
+        return pkg in self._offsets
+
+    def _block(self, pkg):
+        start, size = self._offsets[pkg]
+        self._spool.seek(start)
+        block = self._spool.read(size)
+        self._spool.seek(0, os.SEEK_END)
+        return block
+
+    def __getitem__(self, pkg):
+        lines = self._block(pkg).split('\n')[1:-2]
+        return [line[4:] for line in lines if line[4:]]
+
+    def write(self, f, pkgs):
+        """ Write the records of pkgs to the file object f, in order """
+        for pkg in pkgs:
+            f.write(self._block(pkg))
+
+    def close(self):
+        self._spool.close()
 
 def splitFilename(filename):
     """ Pass in a standard style rpm fullname
@@ -396,6 +589,146 @@ def getBaseArch():
 def checkRpmIntegrity(bin_rpm, package):
     return runner.quiet([bin_rpm, "-K", "--nosignature", package])
 
+# file of verified rpms kept in the package cachedir
+VERIFY_CACHE = "rpmverify.cache"
+
+def _verifyRpm(job):
+    """ Verify one rpm in a pool worker
+
+    job is a (path, sumtype, checksum) tuple: when sumtype is None the
+    rpm is checked by 'rpm -K', otherwise its digest must match checksum.
+    Either way the file is read once.
+    Return (path, ret, size, mtime, sumtype, digest, error), ret is 0 if
+    fine; error carries the message of a CreatorError, so that the rest
+    of the batch is still verified.
+    """
+    path, sumtype, checksum = job
+    digest = None
+    try:
+        st = os.stat(path)
+        if not sumtype:
+            ret = checkRpmIntegrity('rpm', path)
+            return (path, ret, st.st_size, st.st_mtime, None, None, None)
+
+        hasher = hashlib.new({'sha': 'sha1'}.get(sumtype, sumtype))
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        ret = int(bool(checksum) and digest != checksum)
+    except CreatorError, err:
+        return (path, 1, None, None, None, None, str(err))
+    except (OSError, IOError, ValueError):
+        return (path, 1, None, None, None, None, None)
+
+    return (path, ret, st.st_size, st.st_mtime, sumtype, digest, None)
+
+def _loadVerifyCache(cachefile):
+    try:
+        with open(cachefile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _saveVerifyCache(cachefile, updates):
+    """ Merge updates into cachefile, None values remove their path
+
+    The merge is done under a lock on the file, as concurrent builds
+    sharing the cachedir record their rpms in the same file.
+    """
+    try:
+        lockfd = os.open(cachefile + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+    except OSError, err:
+        msger.debug("failed to lock %s: %s" % (cachefile, err))
+        return
+
+    try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX)
+        cache = _loadVerifyCache(cachefile)
+        for path, entry in updates.items():
+            if entry is None:
+                cache.pop(path, None)
+            else:
+                cache[path] = entry
+        for path in cache.keys():
+            if not os.path.exists(path):
+                del cache[path]
+
+        tmpfile = "%s.%d" % (cachefile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError), err:
+        msger.debug("failed to save %s: %s" % (cachefile, err))
+    finally:
+        os.close(lockfd)
+
+def checkRpmsIntegrity(jobs, cachefile = None, workers = None):
+    """ Verify a batch of rpms concurrently
+
+    @jobs: list of (path, sumtype, checksum), see _verifyRpm
+    @cachefile: file recording the rpms already verified, the rpms whose
+                size and mtime are unchanged since are not checked again
+    @workers: number of threads, default to the number of cpus
+
+    Return a dict mapping each path to 0 if the rpm is fine, else 1.
+    """
+    cache = {}
+    if cachefile and os.path.exists(cachefile):
+        cache = _loadVerifyCache(cachefile)
+
+    results = {}
+    updates = {}
+    todo = []
+    for path, sumtype, checksum in jobs:
+        entry = cache.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            results[path] = 1
+            if entry:
+                updates[path] = None
+            continue
+
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime and \
+           (not sumtype or (entry[2] == sumtype and entry[3] == checksum)):
+            results[path] = 0
+        else:
+            todo.append((path, sumtype, checksum))
+
+    if todo:
+        # threads, not processes: 'rpm -K' runs in a child process anyway
+        # and hashlib releases the GIL, while forking could copy a lock
+        # held by another thread such as the log writer
+        workers = min(workers or multiprocessing.cpu_count(), len(todo))
+        pool = ThreadPool(workers)
+        try:
+            # get() with a timeout lets KeyboardInterrupt through
+            verified = pool.map_async(_verifyRpm, todo, 1).get(sys.maxint)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        for path, ret, size, mtime, sumtype, digest, error in verified:
+            if error:
+                raise CreatorError(error)
+            results[path] = ret
+            if ret == 0:
+                updates[path] = [size, mtime, sumtype, digest]
+            else:
+                updates[path] = None
+
+    if cachefile and updates:
+        _saveVerifyCache(cachefile, updates)
+
+    return results
+
 def checkSig(ts, package):
     """ Takes a transaction set and a package, check it's sigs,
         return 0 if they are all fine
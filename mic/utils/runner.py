@@ -16,11 +16,49 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
+import time
+import json
+import pipes
+import errno
+import select
+import signal
+import binascii
+import collections
 import subprocess
 
 from mic import msger
 from mic.utils import errors
 
+# the commands run by this build, see save_timeline(), only the last
+# TIMELINE_SIZE are kept
+TIMELINE_SIZE = 16384
+_timeline = collections.deque(maxlen=TIMELINE_SIZE)
+
+def _record(cmdln_or_args, started, rc, outsize, mode="fork"):
+    _timeline.append({"argv": cmdln_or_args,
+                      "mode": mode,
+                      "start": started,
+                      "duration": time.time() - started,
+                      "exit_code": rc,
+                      "outsize": outsize})
+
+def get_timeline():
+    """ Return the commands run so far, oldest first """
+    return list(_timeline)
+
+def reset_timeline():
+    """ Forget the commands run so far, a new build starts """
+    _timeline.clear()
+
+def save_timeline(path):
+    """ Save the argv, start time, duration, exit code and output size of
+        the commands run so far as JSON to path
+    """
+    commands = get_timeline()
+    with open(path, 'w') as wf:
+        json.dump({"total": sum(cmd["duration"] for cmd in commands),
+                   "commands": commands}, wf, indent=2)
+
 def runtool(cmdln_or_args, catch=1):
     """ wrapper for most of the subprocess calls
     input:
@@ -62,6 +100,7 @@ def runtool(cmdln_or_args, catch=1):
         sout = subprocess.PIPE
         serr = subprocess.STDOUT
 
+    started = time.time()
     try:
         p = subprocess.Popen(cmdln_or_args, stdout=sout,
                              stderr=serr, shell=shell)
@@ -78,29 +117,68 @@ def runtool(cmdln_or_args, catch=1):
         if catch != 3:
             os.close(dev_null)
 
+    _record(cmdln_or_args, started, p.returncode, len(out))
     return (p.returncode, out)
 
-def show(cmdln_or_args):
-    # show all the message using msger.verbose
+class _ShowLog(object):
+    """ Log the output lines of a command in verbose mode, a bounded number
+        of lines at a time, with the blank lines around it left out
+    """
+    BATCH = 256
 
-    rc, out = runtool(cmdln_or_args, catch=3)
+    def __init__(self, cmdln_or_args):
+        if isinstance(cmdln_or_args, list):
+            self.cmd = ' '.join(cmdln_or_args)
+        else:
+            self.cmd = cmdln_or_args
+        self.enabled = msger.LOGGER.isEnabledFor(msger.VERBOSE)
+        self.started = False
+        self.lines = []
+        self.blanks = 0
 
-    if isinstance(cmdln_or_args, list):
-        cmd = ' '.join(cmdln_or_args)
-    else:
-        cmd = cmdln_or_args
+    def line(self, line):
+        if not self.enabled:
+            return
+        if not line.strip():
+            self.blanks += self.started
+            return
+        if not self.started:
+            self.started = True
+            self.lines.append('running command: "%s", with output::'
+                              % self.cmd)
+            self.lines.append('  +----------------')
+        self.lines.extend(['  | '] * self.blanks)
+        self.blanks = 0
+        self.lines.append('  | %s' % line.rstrip())
+        if len(self.lines) >= self.BATCH:
+            msger.verbose('\n'.join(self.lines))
+            self.lines = []
 
-    msg =  'running command: "%s"' % cmd
-    if out: out = out.strip()
-    if out:
-        msg += ', with output::'
-        msg += '\n  +----------------'
-        for line in out.splitlines():
-            msg += '\n  | %s' % line
-        msg += '\n  +----------------'
+    def close(self):
+        if not self.enabled:
+            return
+        if self.started:
+            self.lines.append('  +----------------')
+        else:
+            self.lines.append('running command: "%s"' % self.cmd)
+        msger.verbose('\n'.join(self.lines))
+        self.lines = []
+
+def show(cmdln_or_args):
+    # show all the message using msger.verbose, as the output comes
 
-    msger.verbose(msg)
-    return rc
+    log = _ShowLog(cmdln_or_args)
+    try:
+        proc = Streamed(cmdln_or_args, merged=True, session=False,
+                        shell=not isinstance(cmdln_or_args, list))
+    except OSError, e:
+        if e.errno == 2:
+            raise errors.CreatorError('Cannot run command: %s, lost '
+                                      'dependency?' % log.cmd.split()[0])
+        raise
+    stream([proc], handler=lambda proc, line: log.line(line))
+    log.close()
+    return proc.returncode
 
 def outs(cmdln_or_args, catch=1):
     # get the outputs of tools
@@ -108,3 +186,238 @@ def outs(cmdln_or_args, catch=1):
 
 def quiet(cmdln_or_args):
     return runtool(cmdln_or_args, catch=0)[0]
+
+# bytes read from a pipe at once
+STREAM_CHUNK = 65536
+# a partial line longer than this is logged without waiting for its end
+STREAM_MAX_LINE = 16384
+# seconds between two checks of the running processes
+STREAM_INTERVAL = 0.5
+# seconds left to a timed out process group between SIGTERM and SIGKILL
+STREAM_KILL_GRACE = 5
+
+class Streamed(object):
+    """ A command started in its own process group, with its stdout and
+        stderr read by stream() as they come. With session=False it stays
+        in the group of mic, with merged=True stderr goes to stdout.
+    """
+    def __init__(self, args, label=None, preexec_fn=None, session=True,
+                 merged=False, **kwargs):
+        def preexec():
+            if session:
+                os.setsid()
+            if preexec_fn:
+                preexec_fn()
+
+        self.args = args
+        self.label = label
+        self.started = time.time()
+        self.duration = None
+        self.outsize = 0
+        self.timedout = False
+        self.killed_at = None
+        self.session = session
+        self._partial = {}
+        self.popen = subprocess.Popen(args, preexec_fn=preexec,
+                                      stdout=subprocess.PIPE,
+                                      stderr=merged and subprocess.STDOUT
+                                             or subprocess.PIPE,
+                                      **kwargs)
+
+    @property
+    def pipes(self):
+        return filter(None, [self.popen.stdout, self.popen.stderr])
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def feed(self, fd, data, handler):
+        """ Pass the complete lines of data read from fd to handler """
+        self.outsize += len(data)
+        lines = (self._partial.pop(fd, "") + data).split("\n")
+        partial = lines.pop()
+        if len(partial) > STREAM_MAX_LINE:
+            lines.append(partial)
+            partial = ""
+        if partial:
+            self._partial[fd] = partial
+        for line in lines:
+            handler(self, line.rstrip("\r"))
+
+    def flush(self, handler):
+        """ Pass the unterminated lines left to handler """
+        for fd in sorted(self._partial):
+            handler(self, self._partial[fd].rstrip("\r"))
+        self._partial.clear()
+
+    def kill(self, sig=signal.SIGTERM):
+        try:
+            if self.session:
+                os.killpg(self.popen.pid, sig)
+            else:
+                os.kill(self.popen.pid, sig)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    def abort(self):
+        """ Kill the process group unless the process is already done """
+        if self.popen.poll() is None:
+            self.kill(signal.SIGKILL)
+            self.popen.wait()
+
+def _read_ready(poller, fdmap, timeout, handler):
+    """ Read what the ready pipes of fdmap have, return whether any did """
+    try:
+        events = poller.poll(timeout * 1000)
+    except select.error, err:
+        if err.args[0] == errno.EINTR:
+            return True
+        raise
+
+    for fd, _ in events:
+        proc = fdmap[fd]
+        data = os.read(fd, STREAM_CHUNK)
+        if data:
+            proc.feed(fd, data, handler)
+        else:
+            poller.unregister(fd)
+            del fdmap[fd]
+    return bool(events)
+
+def stream(procs, timeout=None, handler=None):
+    """ Wait for the Streamed procs, passing every line they output to
+        handler(proc, line). The process group of a proc still running
+        timeout seconds after it was started is killed, and proc.timedout
+        is set. A proc is done when it exits, even if a process it left
+        in the background still holds its pipes.
+    """
+    if handler is None:
+        handler = lambda proc, line: msger.info(line)
+
+    poller = select.poll()
+    fdmap = {}
+    for proc in procs:
+        for pipe in proc.pipes:
+            fdmap[pipe.fileno()] = proc
+            poller.register(pipe, select.POLLIN)
+
+    running = list(procs)
+    try:
+        while running:
+            # a proc which closed its pipes is about to exit
+            closed = [proc for proc in running if proc not in fdmap.values()]
+            _read_ready(poller, fdmap, closed and 0.001 or STREAM_INTERVAL,
+                        handler)
+
+            now = time.time()
+            for proc in list(running):
+                if proc.popen.poll() is not None:
+                    # what it wrote just before exiting is still in the pipe
+                    drain_until = now + STREAM_INTERVAL
+                    while [fd for fd in fdmap if fdmap[fd] is proc] and \
+                          time.time() < drain_until and \
+                          _read_ready(poller, fdmap, 0, handler):
+                        pass
+                    for fd in [fd for fd in fdmap if fdmap[fd] is proc]:
+                        poller.unregister(fd)
+                        del fdmap[fd]
+                    proc.flush(handler)
+                    for pipe in proc.pipes:
+                        pipe.close()
+                    proc.duration = time.time() - proc.started
+                    _record(proc.args, proc.started, proc.returncode,
+                            proc.outsize, "stream")
+                    running.remove(proc)
+                elif proc.killed_at is not None:
+                    if now - proc.killed_at > STREAM_KILL_GRACE:
+                        proc.kill(signal.SIGKILL)
+                elif timeout is not None and now - proc.started > timeout:
+                    proc.timedout = True
+                    proc.killed_at = now
+                    proc.kill()
+    finally:
+        # interrupted, don't leave anything behind
+        for proc in running:
+            proc.abort()
+
+    return procs
+
+class Shell(object):
+    """ One helper shell running the commands given to it in order, so that
+        a sequence of commands costs one fork of mic instead of one per
+        command. The commands share the state of the shell, like its
+        working directory, and their stderr goes to their output.
+
+            with runner.Shell() as shell:
+                for subvol in subvols:
+                    shell.show(["btrfs", "subvolume", "create", subvol])
+    """
+    def __init__(self):
+        self._token = "MIC-EXIT-%s" % binascii.hexlify(os.urandom(8))
+        self._buf = ""
+        self._proc = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+    def runtool(self, cmdln_or_args):
+        """ Run one command, return its exit code and output """
+        if isinstance(cmdln_or_args, list):
+            cmdln = ' '.join(pipes.quote(arg) for arg in cmdln_or_args)
+        else:
+            cmdln = cmdln_or_args
+
+        started = time.time()
+        try:
+            self._proc.stdin.write("{ %s\n} </dev/null\n"
+                                   "printf '\\n%s %%d\\n' $?\n"
+                                   % (cmdln, self._token))
+            self._proc.stdin.flush()
+        except IOError:
+            raise errors.CreatorError("The helper shell exited before "
+                                      "running: %s" % cmdln)
+
+        marker = "\n%s " % self._token
+        fd = self._proc.stdout.fileno()
+        while True:
+            pos = self._buf.find(marker)
+            if pos >= 0 and self._buf.find("\n", pos + 1) >= 0:
+                break
+            data = os.read(fd, STREAM_CHUNK)
+            if not data:
+                raise errors.CreatorError("The helper shell exited while "
+                                          "running: %s" % cmdln)
+            self._buf += data
+
+        end = self._buf.index("\n", pos + 1)
+        out = self._buf[:pos]
+        rc = int(self._buf[pos + len(marker):end])
+        self._buf = self._buf[end + 1:]
+
+        _record(cmdln_or_args, started, rc, len(out), "shell")
+        return (rc, out)
+
+    def show(self, cmdln_or_args):
+        """ Run one command and log its output like show() """
+        rc, out = self.runtool(cmdln_or_args)
+        log = _ShowLog(cmdln_or_args)
+        for line in out.splitlines():
+            log.line(line)
+        log.close()
+        return rc
+
+    def quiet(self, cmdln_or_args):
+        return self.runtool(cmdln_or_args)[0]
@@ -27,7 +27,7 @@ import yum
 from mic import msger
 from mic.kickstart import ksparser
 from mic.utils import misc, rpmmisc
-from mic.utils.grabber import TextProgress
+from mic.utils.grabber import TextProgress, urlgrab_many
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError
 from mic.utils.safeurl import SafeURL
@@ -330,6 +330,67 @@ class Yum(BackendPlugin, yum.YumBase):
 
         return False
 
+    def downloadPkgs(self, pkglist, callback=None, callback_total=None):
+        """ Fetch the packages through the concurrent download engine of
+            mic instead of the serial one of yum
+        """
+        jobs = []
+        pos = []
+        cached_pkgs = filter(lambda po: os.path.exists(po.localPkg()), pkglist)
+        verified = set(po.localPkg() for po, ok in
+                       zip(cached_pkgs, self.checkPkgs(cached_pkgs)) if ok)
+        for po in pkglist:
+            local = po.localPkg()
+            if local in verified:
+                continue
+
+            url, proxies = self.get_url_proxies(po)
+            jobs.append((url.full, local, proxies, int(po.packagesize)))
+            pos.append(po)
+
+        if not jobs:
+            return {}
+
+        filenames = urlgrab_many(jobs, TextProgress(len(jobs)))
+        for po, filename in zip(pos, filenames):
+            # packages from local repos are used in place
+            po.localpath = filename
+
+        for po, ok in zip(pos, self.checkPkgs(pos)):
+            if not ok:
+                filename = po.localPkg()
+                raise CreatorError("Package %s is damaged: %s" \
+                                   % (os.path.basename(filename), filename))
+
+        return {}
+
+    def checkPkgs(self, pos):
+        """ Verify cached packages concurrently against the checksums of
+            the repo metadata, return a list of True/False for pos
+        """
+        jobs = []
+        for po in pos:
+            sumtype, checksum = po.returnIdSum()
+            jobs.append((po.localPkg(), sumtype, checksum))
+
+        cachefile = os.path.join(self.cachedir, rpmmisc.VERIFY_CACHE)
+        results = rpmmisc.checkRpmsIntegrity(jobs, cachefile)
+        return [results[job[0]] == 0 for job in jobs]
+
+    def get_url_proxies(self, po):
+        repo = po.repo
+        url = SafeURL(repo.baseurl[0]).join(po.remote_path)
+
+        proxy = repo.proxy
+        if not proxy:
+            proxy = get_proxy_for(url)
+        if proxy:
+            proxies = {str(url.split(':')[0]): str(proxy)}
+        else:
+            proxies = None
+
+        return (url, proxies)
+
     def runInstall(self, checksize = 0):
         os.environ["HOME"] = "/"
         os.environ["LD_PRELOAD"] = ""
@@ -374,6 +435,7 @@ class Yum(BackendPlugin, yum.YumBase):
         download_total_size = sum(map(lambda x: int(x.packagesize), dlpkgs))
 
         msger.info("\nChecking packages cached ...")
+        cached_pkgs = []
         for po in dlpkgs:
             local = po.localPkg()
             repo = filter(lambda r: r.id == po.repoid, self.repos.listEnabled())[0]
@@ -381,7 +443,11 @@ class Yum(BackendPlugin, yum.YumBase):
                 os.unlink(local)
             if not os.path.exists(local):
                 continue
-            if not self.verifyPkg(local, po, False):
+            cached_pkgs.append(po)
+
+        for po, ok in zip(cached_pkgs, self.checkPkgs(cached_pkgs)):
+            local = po.localPkg()
+            if not ok:
                 msger.warning("Package %s is damaged: %s" \
                               % (os.path.basename(local), local))
             else:
@@ -409,10 +475,6 @@ class Yum(BackendPlugin, yum.YumBase):
                    % (total_count, cached_count, total_count - cached_count))
 
         try:
-            repos = self.repos.listEnabled()
-            for repo in repos:
-                repo.setCallback(TextProgress(total_count - cached_count))
-
             self.downloadPkgs(dlpkgs)
             # FIXME: sigcheck?
 
@@ -473,7 +535,7 @@ class Yum(BackendPlugin, yum.YumBase):
 
         return self.__pkgs_vcsinfo
 
-    def getAllContent(self):
+    def getAllContent(self, files = True):
         return self.__pkgs_content
 
     def getPkgsLicense(self):
@@ -491,19 +553,6 @@ class Yum(BackendPlugin, yum.YumBase):
     def package_url(self, pkgname):
         pkgs = self.pkgSack.searchNevra(name=pkgname)
         if pkgs:
-            pkg = pkgs[0]
-
-            repo = pkg.repo
-            url = SafeURL(repo.baseurl[0]).join(pkg.remote_path)
-
-            proxy = repo.proxy
-            if not proxy:
-                proxy = get_proxy_for(url)
-            if proxy:
-                proxies = {str(url.split(':')[0]): str(proxy)}
-            else:
-                proxies = None
-
-            return (url, proxies)
+            return self.get_url_proxies(pkgs[0])
 
         return (None, None)
@@ -16,7 +16,11 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
+import time
+import errno
 import shutil
+import hashlib
+import tempfile
 import urlparse
 import rpm
 
@@ -30,7 +34,7 @@ if not hasattr(zypp, 'PoolQuery') or \
 from mic import msger
 from mic.kickstart import ksparser
 from mic.utils import misc, rpmmisc, runner, fs_related
-from mic.utils.grabber import myurlgrab, TextProgress
+from mic.utils.grabber import urlgrab_many, TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError, RepoError, RpmError
 from mic.imager.baseimager import BaseImageCreator
@@ -50,6 +54,107 @@ class RepositoryStub:
         self.keeppackages = True
         self.priority = None
 
+def _cmp_candidates(c1, c2):
+    # compare criterion: arch compatibility first, then repo
+    # priority, and version last
+    if c1.archname != c2.archname:
+        if c1.arch.compatible_with(c2.arch):
+            return -1
+        else:
+            return 1
+    # Priority of a repository is an integer value between 0 (the
+    # highest priority) and 99 (the lowest priority)
+    if c1.priority > c2.priority:
+        return -1
+    elif c1.priority < c2.priority:
+        return 1
+    return rpm.labelCompare(c1.evr, c2.evr)
+
+class _Candidate(object):
+    """ A package of the pool with what it is sorted by """
+    __slots__ = ('pitem', 'item', 'name', 'arch', 'archname', 'priority',
+                 'evr')
+
+    def __init__(self, pitem):
+        self.pitem = pitem
+        self.item = item = zypp.asKindPackage(pitem)
+        self.name = item.name()
+        self.arch = item.arch()
+        self.archname = str(self.arch)
+        self.priority = int(item.repoInfo().priority())
+        edition = item.edition()
+        self.evr = tuple(map(str, [edition.epoch(), edition.version(),
+                                   edition.release()]))
+
+def _capability_name(cap):
+    return cap.asString().split(" ", 1)[0]
+
+class _PoolIndex(object):
+    """ The packages of the zypp pool indexed by name and by what they
+        provide, each list sorted best candidate first, and the names
+        obsoleted by any of them
+    """
+    def __init__(self, pool):
+        self.names = {}
+        self.provides = {}
+        self.obsoleted = set()
+
+        for pitem in pool:
+            if not zypp.isKindPackage(pitem):
+                continue
+            cand = _Candidate(pitem)
+            self.names.setdefault(cand.name, []).append(cand)
+            for cap in cand.item.provides():
+                self.provides.setdefault(_capability_name(cap),
+                                         []).append(cand)
+            for cap in cand.item.obsoletes():
+                self.obsoleted.add(_capability_name(cap))
+
+        for table in (self.names, self.provides):
+            for cands in table.values():
+                cands.sort(cmp=_cmp_candidates, reverse=True)
+
+    def match(self, test):
+        """ The candidates of all the names passing test, best first """
+        cands = []
+        for name in self.names:
+            if test(name):
+                cands.extend(self.names[name])
+        cands.sort(cmp=_cmp_candidates, reverse=True)
+        return cands
+
+class _DeselectPatterns(object):
+    """ The packages not to install, names, name.arch, *suffix or prefix*
+    """
+    def __init__(self, patterns, split):
+        self.names = set()
+        self.name_archs = set()
+        prefixes = []
+        suffixes = []
+        for pkg in patterns:
+            if pkg.startswith("*"):
+                suffixes.append(pkg[1:])
+            if pkg.endswith("*"):
+                prefixes.append(pkg[:-1])
+            if pkg.startswith("*") or pkg.endswith("*"):
+                continue
+            name, arch = split(pkg)
+            if arch:
+                self.name_archs.add((name, arch))
+            else:
+                self.names.add(name)
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+
+    def match(self, name, arch):
+        return name in self.names or \
+               (name, arch) in self.name_archs or \
+               (self.prefixes and name.startswith(self.prefixes)) or \
+               (self.suffixes and name.endswith(self.suffixes))
+
+# number of metadata revisions whose caches are kept per repo
+REPO_CACHE_KEEP = 2
+
 from mic.pluginbase import BackendPlugin
 class Zypp(BackendPlugin):
     name = 'zypp'
@@ -65,9 +170,14 @@ class Zypp(BackendPlugin):
         self.__pkgs_vcsinfo = {}
         self.repos = []
         self.to_deselect = []
+        self._deselect = None
+        self._pool_index = None
         self.localpkgs = {}
         self.repo_manager = None
         self.repo_manager_options = None
+        self.repos_dir = None
+        self.cache_view = None
+        self.rootfs_cache = None
         self.Z = None
         self.ts = None
         self.ts_pre = None
@@ -101,6 +211,13 @@ class Zypp(BackendPlugin):
             self.ts = None
 
         self.closeRpmDB()
+        rpmmisc.setRpmHeaderCache(None)
+
+        for tmpdir in (self.repos_dir, self.cache_view):
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors = True)
+        self.repos_dir = None
+        self.cache_view = None
 
     def __del__(self):
         self.close()
@@ -119,13 +236,23 @@ class Zypp(BackendPlugin):
             pass
 
     def setup(self):
+        rpmmisc.setRpmHeaderCache(os.path.join(self.cachedir,
+                                               rpmmisc.HEADER_CACHE))
         self._cleanupRpmdbLocks(self.instroot)
         # '/var/tmp' is used by zypp to build cache, so make sure
         # if it exists
         if not os.path.exists(self.tmp_file_path ):
             os.makedirs(self.tmp_file_path)
 
+    def _poolIndex(self):
+        if self._pool_index is None:
+            self._pool_index = _PoolIndex(self.Z.pool())
+        return self._pool_index
+
     def whatObsolete(self, pkg):
+        # most packages are obsoleted by none, only query the others
+        if pkg.name() not in self._poolIndex().obsoleted:
+            return None
         query = zypp.PoolQuery()
         query.addKind(zypp.ResKind.package)
         query.addDependency(zypp.SolvAttr.obsoletes, pkg.name(), pkg.edition())
@@ -135,12 +262,9 @@ class Zypp(BackendPlugin):
         return None
 
     def _zyppQueryPackage(self, pkg):
-        query = zypp.PoolQuery()
-        query.addKind(zypp.ResKind.package)
-        query.addAttribute(zypp.SolvAttr.name, pkg)
-        query.setMatchExact()
-        for pi in query.queryResults(self.Z.pool()):
-            return pi
+        cands = self._poolIndex().names.get(pkg)
+        if cands:
+            return cands[0].pitem
         return None
 
     def _splitPkgString(self, pkg):
@@ -169,63 +293,29 @@ class Zypp(BackendPlugin):
             else:
                 obs.status().setToBeInstalled (zypp.ResStatus.USER)
 
-        def cmpEVR(p1, p2):
-            # compare criterion: arch compatibility first, then repo
-            # priority, and version last
-            a1 = p1.arch()
-            a2 = p2.arch()
-            if str(a1) != str(a2):
-                if a1.compatible_with(a2):
-                    return -1
-                else:
-                    return 1
-            # Priority of a repository is an integer value between 0 (the
-            # highest priority) and 99 (the lowest priority)
-            pr1 = int(p1.repoInfo().priority())
-            pr2 = int(p2.repoInfo().priority())
-            if pr1 > pr2:
-                return -1
-            elif pr1 < pr2:
-                return 1
-
-            ed1 = p1.edition()
-            ed2 = p2.edition()
-            (e1, v1, r1) = map(str, [ed1.epoch(), ed1.version(), ed1.release()])
-            (e2, v2, r2) = map(str, [ed2.epoch(), ed2.version(), ed2.release()])
-            return rpm.labelCompare((e1, v1, r1), (e2, v2, r2))
-
         found = False
         startx = pkg.startswith("*")
         endx = pkg.endswith("*")
         ispattern = startx or endx
         name, arch = self._splitPkgString(pkg)
-
-        q = zypp.PoolQuery()
-        q.addKind(zypp.ResKind.package)
+        index = self._poolIndex()
 
         if ispattern:
             if startx and not endx:
-                pattern = '%s$' % (pkg[1:])
+                cands = index.match(lambda n: n.endswith(pkg[1:]))
             if endx and not startx:
-                pattern = '^%s' % (pkg[0:-1])
+                cands = index.match(lambda n: n.startswith(pkg[0:-1]))
             if endx and startx:
-                pattern = '%s' % (pkg[1:-1])
-            q.setMatchRegex()
-            q.addAttribute(zypp.SolvAttr.name, pattern)
+                cands = index.match(lambda n: pkg[1:-1] in n)
 
         elif arch:
-            q.setMatchExact()
-            q.addAttribute(zypp.SolvAttr.name, name)
+            cands = index.names.get(name, [])
 
         else:
-            q.setMatchExact()
-            q.addAttribute(zypp.SolvAttr.name, pkg)
-
-        for pitem in sorted(
-                        q.queryResults(self.Z.pool()),
-                        cmp=lambda x,y: cmpEVR(zypp.asKindPackage(x), zypp.asKindPackage(y)),
-                        reverse=True):
-            item = zypp.asKindPackage(pitem)
+            cands = index.names.get(pkg, [])
+
+        for cand in cands:
+            pitem, item = cand.pitem, cand.item
             if item.name() in self.excpkgs.keys() and \
                self.excpkgs[item.name()] == item.repoInfo().name():
                 continue
@@ -236,7 +326,7 @@ class Zypp(BackendPlugin):
             found = True
             obspkg = self.whatObsolete(item)
             if arch:
-                if arch == str(item.arch()):
+                if arch == cand.archname:
                     pitem.status().setToBeInstalled (zypp.ResStatus.USER)
             else:
                 markPoolItem(obspkg, pitem)
@@ -246,14 +336,8 @@ class Zypp(BackendPlugin):
         # Can't match using package name, then search from packge
         # provides infomation
         if found == False and not ispattern:
-            q.addAttribute(zypp.SolvAttr.provides, pkg)
-            q.addAttribute(zypp.SolvAttr.name,'')
-
-            for pitem in sorted(
-                            q.queryResults(self.Z.pool()),
-                            cmp=lambda x,y: cmpEVR(zypp.asKindPackage(x), zypp.asKindPackage(y)),
-                            reverse=True):
-                item = zypp.asKindPackage(pitem)
+            for cand in index.provides.get(pkg, []):
+                pitem, item = cand.pitem, cand.item
                 if item.name() in self.excpkgs.keys() and \
                    self.excpkgs[item.name()] == item.repoInfo().name():
                     continue
@@ -274,31 +358,16 @@ class Zypp(BackendPlugin):
     def inDeselectPackages(self, pitem):
         """check if specified pacakges are in the list of inDeselectPackages
         """
+        if self._deselect is None:
+            self._deselect = _DeselectPatterns(self.to_deselect,
+                                               self._splitPkgString)
         item = zypp.asKindPackage(pitem)
-        name = item.name()
-        for pkg in self.to_deselect:
-            startx = pkg.startswith("*")
-            endx = pkg.endswith("*")
-            ispattern = startx or endx
-            pkgname, pkgarch = self._splitPkgString(pkg)
-            if not ispattern:
-                if pkgarch:
-                    if name == pkgname and str(item.arch()) == pkgarch:
-                        return True
-                else:
-                    if name == pkgname:
-                        return True
-            else:
-                if startx and name.endswith(pkg[1:]):
-                    return True
-                if endx and name.startswith(pkg[:-1]):
-                    return True
-
-        return False
+        return bool(self._deselect.match(item.name(), str(item.arch())))
 
     def deselectPackage(self, pkg):
         """collect packages should not be installed"""
         self.to_deselect.append(pkg)
+        self._deselect = None
 
     def selectGroup(self, grp, include = ksparser.GROUP_DEFAULT):
         def compareGroup(pitem):
@@ -446,7 +515,7 @@ class Zypp(BackendPlugin):
             else:
                 del os.environ['HOME']
 
-            self.__build_repo_cache(name)
+            self.__build_repo_cache(name, repo.baseurl[0].full)
 
         except RuntimeError, e:
             raise CreatorError(str(e))
@@ -497,10 +566,12 @@ class Zypp(BackendPlugin):
 
         # record all pkg and the content
         localpkgs = self.localpkgs.keys()
+        resolved = []
         for pkg in dlpkgs:
             license = ''
             if pkg.name() in localpkgs:
-                hdr = rpmmisc.readRpmHeader(self.ts, self.localpkgs[pkg.name()])
+                localpkg = self.localpkgs[pkg.name()]
+                hdr = rpmmisc.readRpmHeaderInfo(self.ts, localpkg)
                 pkg_long_name = misc.RPM_FMT % {
                                     'name': hdr['name'],
                                     'arch': hdr['arch'],
@@ -508,6 +579,11 @@ class Zypp(BackendPlugin):
                                     'release': hdr['release']
                                 }
                 license = hdr['license']
+                # a local rpm can be rebuilt without changing its NEVRA
+                pkgstat = os.stat(localpkg)
+                resolved.append("%s %s local:%d:%d"
+                                % (pkg_long_name, hdr['epoch'] or 0,
+                                   pkgstat.st_size, pkgstat.st_mtime))
 
             else:
                 pkg_long_name = misc.RPM_FMT % {
@@ -518,18 +594,30 @@ class Zypp(BackendPlugin):
                                 }
 
                 license = pkg.license()
+                resolved.append("%s %s %s" % (pkg_long_name,
+                                              pkg.edition().epoch(),
+                                              pkg.checksum()))
 
             if license in self.__pkgs_license.keys():
                 self.__pkgs_license[license].append(pkg_long_name)
             else:
                 self.__pkgs_license[license] = [pkg_long_name]
 
+        if self.rootfs_cache and \
+           self.rootfs_cache.lookup(resolved, self.instroot):
+            return
+
         total_count = len(dlpkgs)
         cached_count = 0
         download_total_size = sum(map(lambda x: int(x.downloadSize()), dlpkgs))
         localpkgs = self.localpkgs.keys()
 
         msger.info("Checking packages cached ...")
+        # the cached rpms are shared with the other builds on the cachedir,
+        # they are never removed here: the damaged and the nocache ones are
+        # replaced by the download, which renames the new rpm into place
+        cached_pkgs = []
+        missing_pkgs = []
         for po in dlpkgs:
             # Check if it is cached locally
             if po.name() in localpkgs:
@@ -543,12 +631,18 @@ class Zypp(BackendPlugin):
                     repo = None
                 nocache = repo.nocache if repo else False
 
-                if os.path.exists(local):
-                    if nocache or self.checkPkg(local) !=0:
-                        os.unlink(local)
-                    else:
-                        download_total_size -= int(po.downloadSize())
-                        cached_count += 1
+                if os.path.exists(local) and not nocache:
+                    cached_pkgs.append((po, local))
+                else:
+                    missing_pkgs.append(po)
+
+        results = self.checkPkgs([local for po, local in cached_pkgs])
+        for po, local in cached_pkgs:
+            if results[local] != 0:
+                missing_pkgs.append(po)
+            else:
+                download_total_size -= int(po.downloadSize())
+                cached_count += 1
         cache_avail_size = misc.get_filesystem_avail(self.cachedir)
         if cache_avail_size < download_total_size:
             raise CreatorError("No enough space used for downloading.")
@@ -570,7 +664,7 @@ class Zypp(BackendPlugin):
         try:
             if download_count > 0:
                 msger.info("Downloading packages ...")
-            self.downloadPkgs(dlpkgs, download_count)
+            self.downloadPkgs(missing_pkgs, download_count)
         except CreatorError, e:
             raise CreatorError("Package download failed: %s" %(e,))
 
@@ -604,13 +698,18 @@ class Zypp(BackendPlugin):
 
         return self.__pkgs_vcsinfo
 
-    def getAllContent(self):
+    def getAllContent(self, files = True):
+        """ Return the installed packages, with their file lists spooled to
+            a PackageContents as the rpmdb is walked if files is set
+        """
         if self.__pkgs_content:
             return self.__pkgs_content
 
         if not self.ts:
             self.__initialize_transaction()
 
+        if files:
+            self.__pkgs_content = rpmmisc.PackageContents(self.cachedir)
         mi = self.ts.dbMatch()
         for hdr in mi:
             lname = misc.RPM_FMT % {
@@ -619,7 +718,10 @@ class Zypp(BackendPlugin):
                         'version': hdr['version'],
                         'release': hdr['release']
                     }
-            self.__pkgs_content[lname] = hdr['FILENAMES']
+            if files:
+                self.__pkgs_content.add(lname, hdr['FILENAMES'])
+            else:
+                self.__pkgs_content[lname] = None
 
         return self.__pkgs_content
 
@@ -641,10 +743,16 @@ class Zypp(BackendPlugin):
         if self.repo_manager:
             return
 
-        # Clean up repo metadata
-        shutil.rmtree(self.cachedir + "/etc", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/solv", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/raw", ignore_errors = True)
+        # The raw and solv caches are kept per repo and metadata revision
+        # by __build_repo_cache, zypp sees them through links in a private
+        # view, so that builds can share the cachedir
+        fs_related.makedirs(self.cachedir + "/etc")
+        self.repos_dir = tempfile.mkdtemp(prefix = "repos.d-",
+                                          dir = self.cachedir + "/etc")
+        self.cache_view = tempfile.mkdtemp(prefix = "cache-",
+                                           dir = self.cachedir + "/etc")
+        for subdir in ("raw", "solv"):
+            os.mkdir(os.path.join(self.cache_view, subdir))
 
         zypp.KeyRing.setDefaultAccept( zypp.KeyRing.ACCEPT_UNSIGNED_FILE
                                      | zypp.KeyRing.ACCEPT_VERIFICATION_FAILED
@@ -656,29 +764,107 @@ class Zypp(BackendPlugin):
                 zypp.RepoManagerOptions(zypp.Pathname(self.instroot))
 
         self.repo_manager_options.knownReposPath = \
-                zypp.Pathname(self.cachedir + "/etc/zypp/repos.d")
+                zypp.Pathname(self.repos_dir)
 
         self.repo_manager_options.repoCachePath = \
                 zypp.Pathname(self.cachedir)
 
         self.repo_manager_options.repoRawCachePath = \
-                zypp.Pathname(self.cachedir + "/raw")
+                zypp.Pathname(self.cache_view + "/raw")
 
         self.repo_manager_options.repoSolvCachePath = \
-                zypp.Pathname(self.cachedir + "/solv")
+                zypp.Pathname(self.cache_view + "/solv")
 
         self.repo_manager_options.repoPackagesCachePath = \
                 zypp.Pathname(self.cachedir + "/packages")
 
         self.repo_manager = zypp.RepoManager(self.repo_manager_options)
 
-    def __build_repo_cache(self, name):
+    def __repo_cache_key(self, name, url):
+        """ Identify the metadata of the repo by its url and the checksum of
+            the repomd.xml fetched by misc.get_metadata_from_repos, which
+            replaces it by a rename, so that it is hashed as a whole
+        """
+        repomd = os.path.join(self.cachedir, name, "repomd.xml")
+        if not os.path.exists(repomd):
+            return None
+        stamp = "%s %s" % (misc.calc_hashes(repomd, ('sha256',))[0], url)
+        return hashlib.sha256(stamp).hexdigest()[:16]
+
+    def __link_repo_cache(self, name, cachedir):
+        for subdir in ("raw", "solv"):
+            link = os.path.join(self.cache_view, subdir, name)
+            if os.path.islink(link):
+                os.unlink(link)
+            else:
+                shutil.rmtree(link, ignore_errors = True)
+            os.symlink(os.path.join(cachedir, subdir), link)
+
+    def __prune_repo_caches(self, repodir, keep = REPO_CACHE_KEEP):
+        """ Remove all but the keep most recently used caches of a repo,
+            and the builds left behind by an interrupted mic
+        """
+        caches = []
+        for entry in os.listdir(repodir):
+            path = os.path.join(repodir, entry)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if entry.startswith(".build-"):
+                if mtime < time.time() - 24 * 3600:
+                    shutil.rmtree(path, ignore_errors = True)
+            else:
+                caches.append((mtime, path))
+        caches.sort(reverse = True)
+        for mtime, path in caches[keep:]:
+            shutil.rmtree(path, ignore_errors = True)
+
+    def __build_repo_cache(self, name, url):
+        """ Point zypp to the raw and solv caches of the current metadata
+            of the repo, and build them first if no build did it yet.
+
+            A cache is built in a private directory and renamed to its key
+            once complete, a published cache is never modified, so builds
+            sharing the cachedir need no lock to use it.
+        """
         repo = self.repo_manager.getRepositoryInfo(name)
-        if self.repo_manager.isCached(repo) or not repo.enabled():
+        if not repo.enabled():
+            return
+
+        key = self.__repo_cache_key(name, url)
+        repodir = os.path.join(self.cachedir, "zypp-cache", name)
+        fs_related.makedirs(repodir)
+        if key and os.path.isdir(os.path.join(repodir, key)):
+            msger.verbose('Using cached repository: %s' % name)
+            cachedir = os.path.join(repodir, key)
+            # recently used caches are pruned last
+            os.utime(cachedir, None)
+            self.__link_repo_cache(name, cachedir)
             return
 
         msger.info('Refreshing repository: %s ...' % name)
         self.repo_manager.buildCache(repo, zypp.RepoManager.BuildIfNeeded)
+        if not key:
+            return
+
+        builddir = tempfile.mkdtemp(prefix = ".build-", dir = repodir)
+        for subdir in ("raw", "solv"):
+            built = os.path.join(self.cache_view, subdir, name)
+            if os.path.isdir(built):
+                os.rename(built, os.path.join(builddir, subdir))
+            else:
+                os.mkdir(os.path.join(builddir, subdir))
+        cachedir = os.path.join(repodir, key)
+        try:
+            os.rename(builddir, cachedir)
+        except OSError, err:
+            # published by another build in the meantime, use that one
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(builddir, ignore_errors = True)
+        self.__link_repo_cache(name, cachedir)
+        self.__prune_repo_caches(repodir)
 
     def __initialize_zypp(self):
         if self.Z:
@@ -739,6 +925,7 @@ class Zypp(BackendPlugin):
 
             warnmsg = self.repo_manager.loadSolvFile(solvfile,
                                                      os.path.basename(pkg))
+            self._pool_index = None
             if warnmsg:
                 msger.warning(warnmsg)
 
@@ -762,17 +949,29 @@ class Zypp(BackendPlugin):
                           % (pkg, hdr['arch']))
 
     def downloadPkgs(self, package_objects, count):
+        """ Download package_objects into the package cachedir """
         localpkgs = self.localpkgs.keys()
         progress_obj = TextProgress(count)
 
+        jobs = []
+        # the rpms found missing or damaged by runInstall, a build sharing
+        # the cachedir may have fetched them in the meantime
+        seen = {}
         for po in package_objects:
             if po.name() in localpkgs:
                 continue
 
             filename = self.getLocalPkgPath(po)
-            if os.path.exists(filename):
-                if self.checkPkg(filename) == 0:
-                    continue
+            name = str(po.repoInfo().name())
+            try:
+                repo = filter(lambda r: r.name == name, self.repos)[0]
+            except IndexError:
+                repo = None
+            if not (repo and repo.nocache):
+                try:
+                    seen[filename] = os.stat(filename)
+                except OSError:
+                    seen[filename] = None
 
             dirn = os.path.dirname(filename)
             if not os.path.exists(dirn):
@@ -780,12 +979,23 @@ class Zypp(BackendPlugin):
 
             url = self.get_url(po)
             proxies = self.get_proxies(po)
+            jobs.append((url.full, filename, proxies, int(po.downloadSize())))
+
+        def _fetched(filename):
+            """ Whether another build fetched filename as a good rpm """
+            if filename not in seen:
+                return False
+            st = os.stat(filename)
+            old = seen[filename]
+            if old and (st.st_ino, st.st_mtime) == (old.st_ino, old.st_mtime):
+                return False
+            return self.checkPkg(filename) == 0
 
-            try:
-                filename = myurlgrab(url.full, filename, proxies, progress_obj)
-            except CreatorError:
-                self.close()
-                raise
+        try:
+            urlgrab_many(jobs, progress_obj, check = _fetched)
+        except CreatorError:
+            self.close()
+            raise
 
     def preinstallPkgs(self):
         if not self.ts_pre:
@@ -923,12 +1133,21 @@ class Zypp(BackendPlugin):
         ret = 1
         if not os.path.exists(pkg):
             return ret
-        ret = rpmmisc.checkRpmIntegrity('rpm', pkg)
-        if ret != 0:
-            msger.warning("package %s is damaged: %s" \
-                          % (os.path.basename(pkg), pkg))
+        return self.checkPkgs([pkg])[pkg]
 
-        return ret
+    def checkPkgs(self, pkgs):
+        """ Verify cached rpms concurrently, skipping the ones already
+            verified by a previous build, return a dict of path: ret
+        """
+        cachefile = os.path.join(self.cachedir, rpmmisc.VERIFY_CACHE)
+        results = rpmmisc.checkRpmsIntegrity([(pkg, None, None) for pkg in pkgs],
+                                             cachefile)
+        for pkg in pkgs:
+            if results[pkg] != 0:
+                msger.warning("package %s is damaged: %s" \
+                              % (os.path.basename(pkg), pkg))
+
+        return results
 
     def _add_prob_flags(self, *flags):
         for flag in flags:
@@ -974,26 +1193,17 @@ class Zypp(BackendPlugin):
 
     def package_url(self, pkgname):
 
-        def cmpEVR(p1, p2):
-            ed1 = p1.edition()
-            ed2 = p2.edition()
-            (e1, v1, r1) = map(str, [ed1.epoch(), ed1.version(), ed1.release()])
-            (e2, v2, r2) = map(str, [ed2.epoch(), ed2.version(), ed2.release()])
-            return rpm.labelCompare((e1, v1, r1), (e2, v2, r2))
+        def cmpEVR(c1, c2):
+            return rpm.labelCompare(c1.evr, c2.evr)
 
         if not self.Z:
             self.__initialize_zypp()
 
-        q = zypp.PoolQuery()
-        q.addKind(zypp.ResKind.package)
-        q.setMatchExact()
-        q.addAttribute(zypp.SolvAttr.name, pkgname)
-        items = sorted(q.queryResults(self.Z.pool()),
-                       cmp=lambda x,y: cmpEVR(zypp.asKindPackage(x), zypp.asKindPackage(y)),
-                       reverse=True)
+        items = sorted(self._poolIndex().names.get(pkgname, []),
+                       cmp=cmpEVR, reverse=True)
 
         if items:
-            item = zypp.asKindPackage(items[0])
+            item = items[0].item
             url = self.get_url(item)
             proxies = self.get_proxies(item)
             return (url, proxies)
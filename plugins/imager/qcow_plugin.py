@@ -16,7 +16,6 @@
 
 import os
 import subprocess
-import shutil
 
 from mic import msger, rt_util
 from mic.conf import configmgr
@@ -58,8 +57,8 @@ class QcowImageCreator(LoopImageCreator):
             os.rename(qemuimage, imgfile)
 
         for item in os.listdir(self._imgdir):
-            shutil.move(os.path.join(self._imgdir, item),
-                        os.path.join(self._outdir, item))
+            fs_related.sparse_move(os.path.join(self._imgdir, item),
+                                   os.path.join(self._outdir, item))
 
 class QcowPlugin(ImagerPlugin):
     name = 'qcow'
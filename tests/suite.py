@@ -4,10 +4,20 @@ import unittest
 import test_configmgr
 import test_pluginmgr
 import test_baseimager
-#import test_msger
+import test_msger
 import test_runner
 import test_chroot
 import test_proxy
+import test_grabber
+import test_bmap
+import test_fs_related
+import test_serve
+import test_gpt_parser
+import test_rootfs_cache
+import test_misc
+import test_batch
+import test_rpmmisc
+import test_zypppkgmgr
 
 if os.getuid() != 0:
     raise SystemExit("Root permission is needed")
@@ -16,9 +26,19 @@ suite = unittest.TestSuite()
 suite.addTests(test_pluginmgr.suite())
 suite.addTests(test_configmgr.suite())
 suite.addTests(test_baseimager.suite())
-#suite.addTests(test_msger.suite())
+suite.addTests(test_msger.suite())
 suite.addTests(test_runner.suite())
 suite.addTests(test_chroot.suite())
 suite.addTests(test_proxy.suite())
+suite.addTests(test_grabber.suite())
+suite.addTests(test_bmap.suite())
+suite.addTests(test_fs_related.suite())
+suite.addTests(test_serve.suite())
+suite.addTests(test_gpt_parser.suite())
+suite.addTests(test_rootfs_cache.suite())
+suite.addTests(test_misc.suite())
+suite.addTests(test_batch.suite())
+suite.addTests(test_rpmmisc.suite())
+suite.addTests(test_zypppkgmgr.suite())
 result = unittest.TextTestRunner(verbosity=2).run(suite)
 sys.exit(not result.wasSuccessful())
@@ -57,7 +57,7 @@ class ArchiveTest(unittest.TestCase):
         """Test get compress format """
         compress_list = archive.get_compress_formats()
         compress_list.sort()
-        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo'])
+        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo', 'xz', 'zst'])
 
     def test_compress_negtive_file_path_is_required(self):
         """Test if the first parameter: file path is empty"""
@@ -225,6 +225,40 @@ class ArchiveTest(unittest.TestCase):
             archive.decompress(output_name, 'bz2')
             self.assertTrue(os.path.exists(file_item))
 
+    def test_decompress_xz(self):
+        """Test decompress
+            Format: xz"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'xz')
+            self.assertEqual('%s.xz' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name, 'xz')
+            self.assertTrue(os.path.exists(file_item))
+
+    def test_decompress_zst(self):
+        """Test decompress
+            Format: zst"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'zst')
+            self.assertEqual('%s.zst' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name)
+            self.assertTrue(os.path.exists(file_item))
+
+    def test_decompress_multiple_blocks(self):
+        """Test the content survives compression in several blocks"""
+        data = os.urandom(1024) * (archive.BLOCK_SIZE / 1024 * 2 + 3)
+        for compress_format in ('gz', 'bz2'):
+            with open(self.relative_file, 'wb') as wfile:
+                wfile.write(data)
+            output_name = archive.compress(self.relative_file,
+                                           compress_format)
+            archive.decompress(output_name)
+            with open(self.relative_file, 'rb') as rfile:
+                self.assertEqual(rfile.read(), data)
+
     def test_decompress_bz2_no_compress_format(self):
         """Test decompress
             Format: bz2
@@ -267,7 +301,8 @@ class ArchiveTest(unittest.TestCase):
         archive_formats = archive.get_archive_formats()
         archive_formats.sort()
         self.assertEqual(archive_formats,
-                        ["bztar", "gztar", "lzotar", "tar", 'zip'])
+                        ["bztar", "gztar", "lzotar", "tar", "xztar",
+                         "zip", "zsttar"])
 
     def test_get_archive_suffixes(self):
         """Test get archive suffixes"""
@@ -276,7 +311,8 @@ class ArchiveTest(unittest.TestCase):
 
         self.assertEqual(archive_suffixes,
                          ['.tar', '.tar.bz', '.tar.bz2', '.tar.gz', '.tar.lzo',
-                         '.taz', '.tbz', '.tbz2', '.tgz', '.tzo', '.zip'])
+                         '.tar.xz', '.tar.zst', '.taz', '.tbz', '.tbz2', '.tgz',
+                         '.txz', '.tzo', '.tzst', '.zip'])
 
     def test_make_archive_negtive_archive_name_is_required(self):
         """Test if first parameter: file path is empty"""
@@ -688,5 +724,21 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(out_dir, item)))
             shutil.rmtree(out_dir)
 
+    def test_make_archive_tar_xz(self):
+        """ Test make_archive format: tar.xz"""
+        for item in self.files + self.dirs:
+            out_file = '%s.tar.xz' % item
+            self.assertTrue(archive.make_archive(out_file, item))
+            self.assertTrue(os.path.exists(out_file))
+            os.remove(out_file)
+
+    def test_make_archive_tar_zst(self):
+        """ Test make_archive format: tar.zst"""
+        for item in self.files + self.dirs:
+            out_file = '%s.tar.zst' % item
+            self.assertTrue(archive.make_archive(out_file, item))
+            self.assertTrue(os.path.exists(out_file))
+            os.remove(out_file)
+
 if __name__ == "__main__":
     unittest.main()
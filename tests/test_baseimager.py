@@ -4,14 +4,16 @@ import os
 import sys
 import rpm
 import glob
+import fcntl
 import shutil
+import tempfile
 import StringIO
 import subprocess
 import unittest
 from mic import plugin as pluginmgr
 from mic import conf as configmgr
-from mic import msger
-from mic.imager import fs
+from mic import msger, kickstart
+from mic.imager import fs, baseimager
 
 CWD = os.path.dirname(__file__) or '.'
 TEST_BASEIMGR_LOC = os.path.join(CWD, 'baseimgr_fixtures')
@@ -22,7 +24,9 @@ CACHEDIR = os.path.join(CWD, 'baseimgr_fixtures', 'cache')
 RPMLOCK_PATH = None
 
 def suite():
-    return unittest.makeSuite(BaseImgrTest)
+    return unittest.TestSuite([unittest.makeSuite(BaseImgrTest),
+                               unittest.makeSuite(LayerTest),
+                               unittest.makeSuite(PostScriptTest)])
 
 class BaseImgrTest(unittest.TestCase):
 
@@ -137,6 +141,121 @@ if os.getuid == 0:
     def testBaseImagerYum(self):
         self.BaseImager('yum')
 
+LAYER_KS = """
+%%packages
+%s
+%%end
+"""
+
+class LayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors = True)
+
+    def layerKey(self, packages, checksum = 'aaaa', arch = 'armv7l'):
+        ksfile = os.path.join(self.workdir, 'base.ks')
+        with open(ksfile, 'w') as wf:
+            wf.write(LAYER_KS % '\n'.join(packages))
+        repomd = [{'name': 'base', 'baseurl': 'http://repo/base',
+                   'primary_checksum': checksum}]
+        creator = baseimager.BaseImageCreator({'repomd': repomd,
+                                               'arch': arch})
+        return creator._BaseImageCreator__layer_key(
+                                        kickstart.read_kickstart(ksfile))
+
+    def testLayerKey(self):
+        key = self.layerKey(['bash', 'glibc'])
+        self.assertEqual(key, self.layerKey(['glibc', 'bash']))
+        self.assertNotEqual(key, self.layerKey(['bash']))
+        self.assertNotEqual(key, self.layerKey(['bash', 'glibc', '-vim']))
+        self.assertNotEqual(key, self.layerKey(['bash', 'glibc'], 'bbbb'))
+        self.assertNotEqual(key, self.layerKey(['bash', 'glibc'],
+                                               arch = 'aarch64'))
+
+    def testPruneLayers(self):
+        for i, key in enumerate(('old', 'used', 'new', 'newest')):
+            layerdir = os.path.join(self.workdir, key)
+            os.mkdir(layerdir)
+            open(layerdir + '.json', 'w').close()
+            os.utime(layerdir, (1000 + i, 1000 + i))
+        # a layer being installed, not published yet
+        os.mkdir(os.path.join(self.workdir, 'newestXYZ'))
+
+        # a build copying the layer holds its lock
+        lockfd = os.open(os.path.join(self.workdir, 'used.lock'),
+                         os.O_RDWR | os.O_CREAT)
+        fcntl.flock(lockfd, fcntl.LOCK_SH)
+        try:
+            baseimager.prune_layers(self.workdir, keep = 2)
+        finally:
+            os.close(lockfd)
+
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         ['new', 'new.json', 'newest', 'newest.json',
+                          'newestXYZ', 'old.lock', 'used', 'used.json',
+                          'used.lock'])
+
+POST_KS = """
+%packages
+bash
+%end
+
+%post
+echo 0
+%end
+
+%post --nochroot --parallel
+echo 1
+%end
+
+%post --nochroot --parallel
+echo 2
+%end
+
+%post --nochroot
+echo 3
+%end
+
+%post --nochroot --parallel
+echo 4
+%end
+
+%post --parallel
+echo 5
+%end
+
+%post --nochroot --parallel
+echo 6
+%end
+"""
+
+class PostScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors = True)
+
+    def testParallelBatches(self):
+        ksfile = os.path.join(self.workdir, 'post.ks')
+        with open(ksfile, 'w') as wf:
+            wf.write(POST_KS)
+        scripts = kickstart.get_post_scripts(kickstart.read_kickstart(ksfile))
+        self.assertEqual([s.parallel for s in scripts],
+                         [False, True, True, False, True, True, True])
+        self.assertEqual([s.inChroot for s in scripts],
+                         [True, False, False, False, False, True, False])
+
+        batches = baseimager.post_script_batches(scripts)
+        # a chroot script is never run with the others, even --parallel
+        self.assertEqual([[num for num, s in batch] for batch in batches],
+                         [[0], [1, 2], [3], [4], [5], [6]])
+        self.assertEqual(batches[1][1][1].script.strip(), 'echo 2')
+
 if __name__ == "__main__":
     if os.getuid() != 0:
         raise SystemExit("Root permission is needed")
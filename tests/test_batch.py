@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from mic import cmd_batch
+
+def suite():
+    return unittest.makeSuite(BatchTest)
+
+MB = 1024 * 1024
+
+def _build(name, loops=1, disk=0):
+    build = cmd_batch.Build('/ks/%s.ks' % name, name)
+    build.loops = loops
+    build.disk = disk
+    return build
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.saved = (cmd_batch._start, cmd_batch._wait,
+                      cmd_batch._free_loop_devices,
+                      cmd_batch.misc.get_filesystem_avail)
+
+    def tearDown(self):
+        (cmd_batch._start, cmd_batch._wait, cmd_batch._free_loop_devices,
+         cmd_batch.misc.get_filesystem_avail) = self.saved
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def testFitsJobSlots(self):
+        build = _build('a')
+        self.assertTrue(cmd_batch._fits(build, [], 1, None, 0))
+        self.assertFalse(cmd_batch._fits(build, [_build('b')], 1, None,
+                                         100 * MB))
+        self.assertTrue(cmd_batch._fits(build, [_build('b')], 2, None,
+                                         100 * MB))
+
+    def testFitsLoopDevices(self):
+        running = [_build('b', loops=2), _build('c', loops=1)]
+        self.assertTrue(cmd_batch._fits(_build('a', loops=1), running, 4,
+                                        4, 0))
+        self.assertFalse(cmd_batch._fits(_build('a', loops=2), running, 4,
+                                         4, 0))
+        # loop devices created on demand
+        self.assertTrue(cmd_batch._fits(_build('a', loops=8), running, 4,
+                                        None, 0))
+        # the first build always starts, even if it needs too much
+        self.assertTrue(cmd_batch._fits(_build('a', loops=8), [], 4, 4, 0))
+
+    def testFitsDisk(self):
+        running = [_build('b', disk=60 * MB)]
+        self.assertTrue(cmd_batch._fits(_build('a', disk=40 * MB), running,
+                                        2, None, 100 * MB))
+        self.assertFalse(cmd_batch._fits(_build('a', disk=41 * MB), running,
+                                         2, None, 100 * MB))
+        self.assertTrue(cmd_batch._fits(_build('a', disk=200 * MB), [],
+                                        2, None, 100 * MB))
+
+    def testRunBatch(self):
+        builds = [_build('a', loops=3), _build('b', loops=2),
+                  _build('c', loops=1), _build('d', loops=1)]
+        started = []
+        running = []
+        concurrent = []
+
+        def _start(parser, build, argv):
+            started.append((build.name, argv))
+            running.append(build)
+            concurrent.append(sum(b.loops for b in running))
+            return len(started)
+
+        def _wait():
+            # the builds finish in the order they started
+            build = running.pop(0)
+            return build.pid, build.name == 'c' and 2 or 0
+
+        cmd_batch._start = _start
+        cmd_batch._wait = _wait
+        cmd_batch._free_loop_devices = lambda: 4
+        cmd_batch.misc.get_filesystem_avail = lambda path: 100 * MB
+        cmd_batch.run_batch(None, builds, ['create', 'fs'], 2, '/batch')
+
+        self.assertEqual([name for name, argv in started],
+                         ['a', 'c', 'b', 'd'])
+        self.assertEqual(started[0][1], ['create', 'fs', '--tmpdir',
+                                         '/batch/a', '/ks/a.ks'])
+        self.assertTrue(max(concurrent) <= 4)
+        self.assertEqual([build.code for build in builds], [0, 0, 2, 0])
+        for build in builds:
+            self.assertTrue(build.finished >= build.started)
+
+    def testWriteSummary(self):
+        start = time.time() - 30
+        done = _build('done')
+        done.logfile = '/logs/done.log'
+        done.started = start + 5
+        done.finished = start + 25
+        done.code = 0
+        failed = _build('failed')
+        failed.started = start + 10
+        failed.finished = start + 12
+        failed.code = 3
+        skipped = _build('skipped')
+
+        path = os.path.join(self.workdir, 'summary.json')
+        cmd_batch.write_summary([done, failed, skipped], start, path)
+        with open(path) as rf:
+            summary = json.load(rf)
+
+        self.assertTrue(summary['elapsed'] >= 30)
+        self.assertEqual(summary['builds'],
+                         [{'name': 'done', 'ksfile': '/ks/done.ks',
+                           'log': '/logs/done.log', 'exit_code': 0,
+                           'queued': 5.0, 'duration': 20.0},
+                          {'name': 'failed', 'ksfile': '/ks/failed.ks',
+                           'log': None, 'exit_code': 3,
+                           'queued': 10.0, 'duration': 2.0},
+                          {'name': 'skipped', 'ksfile': '/ks/skipped.ks',
+                           'log': None, 'exit_code': None,
+                           'queued': 0, 'duration': 0}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+from mic.utils import bmap
+
+def suite():
+    return unittest.makeSuite(BmapTest)
+
+class BmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.workdir, 'sparse.img')
+        self.bmap_file = os.path.join(self.workdir, 'sparse.bmap')
+        with open(self.image, 'wb') as wf:
+            wf.write('a' * 4096)
+            wf.seek(512 * 1024)
+            wf.write('b' * 8192)
+            wf.truncate(1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _ranges(self, root, attr):
+        ranges = []
+        for elem in root.find('BlockMap'):
+            first, _, last = elem.text.strip().partition('-')
+            ranges.append((int(first), int(last or first), elem.get(attr)))
+        return ranges
+
+    def testCreateBmap(self):
+        hashes = bmap.create_bmap(self.image, self.bmap_file,
+                                  hash_names=('md5', 'sha256'))
+        with open(self.image, 'rb') as rf:
+            data = rf.read()
+        self.assertEqual(hashes['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(hashes['md5'], hashlib.md5(data).hexdigest())
+
+        with open(self.bmap_file) as rf:
+            xml = rf.read()
+        root = ElementTree.fromstring(xml)
+        self.assertEqual(root.get('version'), '2.0')
+        self.assertEqual(int(root.find('ImageSize').text), 1024 * 1024)
+        self.assertEqual(int(root.find('BlocksCount').text), 256)
+
+        ranges = self._ranges(root, 'chksum')
+        mapped = set()
+        for first, last, chksum in ranges:
+            chunk = data[first * 4096:(last + 1) * 4096]
+            self.assertEqual(chksum, hashlib.sha256(chunk).hexdigest())
+            mapped.update(range(first, last + 1))
+        self.assertTrue(set([0, 128, 129]) <= mapped)
+        self.assertEqual(int(root.find('MappedBlocksCount').text),
+                         len(mapped))
+
+        file_chksum = root.find('BmapFileChecksum').text.strip()
+        zeroed = xml.replace(file_chksum, '0' * len(file_chksum), 1)
+        self.assertEqual(file_chksum, hashlib.sha256(zeroed).hexdigest())
+
+    def testCreateBmapV14(self):
+        bmap.create_bmap(self.image, self.bmap_file, version="1.4")
+        root = ElementTree.parse(self.bmap_file).getroot()
+        self.assertEqual(root.get('version'), '1.4')
+        with open(self.image, 'rb') as rf:
+            data = rf.read()
+        for first, last, chksum in self._ranges(root, 'sha1'):
+            chunk = data[first * 4096:(last + 1) * 4096]
+            self.assertEqual(chksum, hashlib.sha1(chunk).hexdigest())
+
+if __name__ == "__main__":
+    unittest.main()
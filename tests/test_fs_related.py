@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import os
+import errno
+import struct
+import shutil
+import tempfile
+import unittest
+
+from mic.utils import fs_related
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(SparseCopyTest),
+                               unittest.makeSuite(LoopDeviceTest)])
+
+class SparseCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, 'sparse.img')
+        with open(self.src, 'wb') as wf:
+            wf.write('a' * 4096)
+            wf.seek(4 * 1024 * 1024)
+            wf.write('b' * 4096)
+            wf.truncate(16 * 1024 * 1024)
+        os.utime(self.src, (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _read(self, path):
+        with open(path, 'rb') as rf:
+            return rf.read()
+
+    def _check_copy(self, dst, data):
+        st = os.stat(dst)
+        self.assertEqual(st.st_size, 16 * 1024 * 1024)
+        self.assertEqual(st.st_mtime, 1000000000)
+        self.assertEqual(self._read(dst), data)
+        # the holes are kept
+        self.assertTrue(st.st_blocks * 512 < 1024 * 1024)
+
+    def testSparseCopy(self):
+        data = self._read(self.src)
+        dst = fs_related.sparse_copy(self.src, self.workdir + '/copy.img')
+        self._check_copy(dst, data)
+
+    def testSparseCopyFallback(self):
+        data = self._read(self.src)
+        copy_file_range = fs_related._copy_file_range
+        fs_related._copy_file_range = lambda *args: False
+        try:
+            destdir = os.path.join(self.workdir, 'dest')
+            os.mkdir(destdir)
+            dst = fs_related.sparse_copy(self.src, destdir)
+        finally:
+            fs_related._copy_file_range = copy_file_range
+        self.assertEqual(dst, os.path.join(destdir, 'sparse.img'))
+        self._check_copy(dst, data)
+
+    def testSparseMoveAcrossDevices(self):
+        data = self._read(self.src)
+        dst = os.path.join(self.workdir, 'moved.img')
+
+        def _rename(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        rename = os.rename
+        os.rename = _rename
+        try:
+            self.assertEqual(fs_related.sparse_move(self.src, dst), dst)
+        finally:
+            os.rename = rename
+        self.assertFalse(os.path.exists(self.src))
+        self._check_copy(dst, data)
+
+class LoopDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.workdir, 'loop.img')
+        with open(self.image, 'wb') as wf:
+            wf.write('mic' * 4096)
+            wf.truncate(1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def testStructSizes(self):
+        # the sizes of struct loop_info64 and struct loop_config
+        self.assertEqual(fs_related._LOOP_INFO64_SIZE, 232)
+        self.assertEqual(struct.calcsize(fs_related._LOOP_CONFIG_FORMAT), 304)
+        info = fs_related._loop_info64('/x' * 64, fs_related.LO_FLAGS_PARTSCAN)
+        self.assertEqual(len(info[9]), 63)
+        self.assertEqual(info[8], fs_related.LO_FLAGS_PARTSCAN)
+
+    def testAttachFallback(self):
+        calls = []
+        def _ioctl(fd, request, arg=0, mutate=True):
+            calls.append(request)
+            if request == fs_related.LOOP_CONFIGURE:
+                raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+        ioctl = fs_related.fcntl.ioctl
+        fs_related.fcntl.ioctl = _ioctl
+        try:
+            fs_related._attach_loop(3, 4, self.image, True)
+        finally:
+            fs_related.fcntl.ioctl = ioctl
+        self.assertEqual(calls, [fs_related.LOOP_CONFIGURE,
+                                 fs_related.LOOP_SET_FD,
+                                 fs_related.LOOP_SET_STATUS64])
+
+    def testLoopIsBoundMissing(self):
+        self.assertFalse(fs_related.loop_is_bound(self.workdir + '/loop99'))
+
+    @unittest.skipUnless(os.geteuid() == 0 and
+                         os.path.exists(fs_related.LOOP_CONTROL),
+                         "needs root and %s" % fs_related.LOOP_CONTROL)
+    def testAllocAndDetach(self):
+        loopdev = fs_related._alloc_loop_device(self.image, False)
+        self.assertTrue(loopdev)
+        try:
+            self.assertTrue(fs_related.loop_is_bound(loopdev))
+            with open(loopdev, 'rb') as rf:
+                self.assertEqual(rf.read(12), 'micmicmicmic')
+        finally:
+            fs_related.detach_loop(loopdev)
+        self.assertFalse(fs_related.loop_is_bound(loopdev))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+import os
+import uuid
+import struct
+import shutil
+import tempfile
+import unittest
+
+from mic.utils import gpt_parser
+
+def suite():
+    return unittest.makeSuite(GptParserTest)
+
+DISK_SECTORS = 64 * 1024 * 2
+BOOTCODE = 'B' * 440
+
+class GptParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.disk = os.path.join(self.workdir, 'disk.img')
+        with open(self.disk, 'wb') as wf:
+            wf.write(BOOTCODE)
+            wf.truncate(DISK_SECTORS * 512)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _read_sector(self, lba):
+        with open(self.disk, 'rb') as rf:
+            rf.seek(lba * 512)
+            return rf.read(512)
+
+    def _mbr_entries(self, lba):
+        sector = self._read_sector(lba)
+        self.assertEqual(sector[510:], '\x55\xaa')
+        entries = []
+        for i in range(4):
+            offset = 446 + i * 16
+            entry = struct.unpack("<B3sB3sII", sector[offset:offset + 16])
+            if entry[2]:
+                entries.append((entry[0], entry[2], entry[4], entry[5]))
+        return entries
+
+    def testGptRoundTrip(self):
+        disk_uuid = str(uuid.uuid4()).upper()
+        partitions = [{'start': 2048, 'size': 4096, 'boot': True,
+                       'type_uuid': gpt_parser.GPT_TYPE_LINUX,
+                       'part_uuid': str(uuid.uuid4()).upper(),
+                       'name': 'boot'},
+                      {'start': 6144, 'size': 8192, 'boot': False,
+                       'type_uuid': gpt_parser.GPT_TYPE_SWAP,
+                       'part_uuid': str(uuid.uuid4()).upper(),
+                       'name': 'swap'}]
+        gpt_parser.write_partition_table(self.disk, 'gpt', partitions,
+                                         disk_uuid=disk_uuid)
+
+        self.assertEqual(self._read_sector(0)[:440], BOOTCODE)
+        self.assertEqual(self._mbr_entries(0),
+                         [(0, 0xEE, 1, DISK_SECTORS - 1)])
+
+        parser = gpt_parser.GptParser(self.disk)
+        for primary in (True, False):
+            header = parser.read_header(primary)
+            self.assertEqual(header['disk_uuid'], disk_uuid)
+            self.assertEqual(header['backup_lba'],
+                             primary and DISK_SECTORS - 1 or 1)
+
+            found = list(parser.get_partitions(primary))
+            self.assertEqual(len(found), 2)
+            for part, entry in zip(partitions, found):
+                self.assertEqual(entry['first_lba'], part['start'])
+                self.assertEqual(entry['last_lba'],
+                                 part['start'] + part['size'] - 1)
+                self.assertEqual(entry['type_uuid'], part['type_uuid'])
+                self.assertEqual(entry['part_uuid'], part['part_uuid'])
+                self.assertEqual(entry['name'], part['name'])
+            self.assertEqual(found[0]['flags'], gpt_parser.GPT_LEGACY_BOOT)
+            self.assertEqual(found[1]['flags'], 0)
+
+    def testGptLargeDisk(self):
+        # more sectors than an MBR entry can address
+        sectors = 0x100000000 + 2048
+        with open(self.disk, 'r+b') as wf:
+            wf.truncate(sectors * 512)
+        partitions = [{'start': 2048, 'size': sectors - 4096, 'boot': False,
+                       'type_uuid': gpt_parser.GPT_TYPE_LINUX,
+                       'part_uuid': str(uuid.uuid4()).upper(),
+                       'name': 'data'}]
+        gpt_parser.write_partition_table(self.disk, 'gpt', partitions)
+
+        self.assertEqual(self._mbr_entries(0), [(0, 0xEE, 1, 0xFFFFFFFF)])
+        parser = gpt_parser.GptParser(self.disk)
+        self.assertEqual(parser.read_header(False)['hdr_lba'],
+                         sectors - 1)
+        found = list(parser.get_partitions())
+        self.assertEqual(found[0]['last_lba'], sectors - 2049)
+
+    def testMsdosRoundTrip(self):
+        partitions = [{'start': 2048, 'size': 4096, 'boot': True,
+                       'system_id': gpt_parser.MBR_TYPE_LINUX},
+                      {'start': 8193, 'size': 4096, 'boot': False,
+                       'logical': True,
+                       'system_id': gpt_parser.MBR_TYPE_LINUX},
+                      {'start': 12290, 'size': 2048, 'boot': False,
+                       'logical': True,
+                       'system_id': gpt_parser.MBR_TYPE_SWAP}]
+        gpt_parser.write_partition_table(self.disk, 'msdos', partitions)
+
+        self.assertEqual(self._read_sector(0)[:440], BOOTCODE)
+        self.assertEqual(self._mbr_entries(0),
+                         [(0x80, 0x83, 2048, 4096),
+                          (0, 0x0F, 8192, 12290 + 2048 - 8192)])
+        # the EBRs are chained relative to the extended partition
+        self.assertEqual(self._mbr_entries(8192),
+                         [(0, 0x83, 1, 4096), (0, 0x05, 4097, 2049)])
+        self.assertEqual(self._mbr_entries(12289), [(0, 0x82, 1, 2048)])
+
+if __name__ == "__main__":
+    unittest.main()
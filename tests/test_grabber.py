@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import os
+import fcntl
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+from mic.utils import grabber, proxy
+from mic.utils.errors import CreatorError
+
+def suite():
+    return unittest.makeSuite(GrabberTest)
+
+class _QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class GrabberTest(unittest.TestCase):
+
+    def setUp(self):
+        # the proxies set by other tests must not be used for the local server
+        proxy.unset_proxy_environ()
+        proxy.set_proxies()
+        self.srcdir = tempfile.mkdtemp()
+        self.destdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.srcdir)
+        self.server = _Server(('127.0.0.1', 0), _QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.srcdir, ignore_errors=True)
+        shutil.rmtree(self.destdir, ignore_errors=True)
+
+    def testUrlgrabMany(self):
+        baseurl = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        contents = {}
+        jobs = []
+        for i in range(16):
+            name = 'pkg-%d.rpm' % i
+            contents[name] = os.urandom(64 * 1024 * (i + 1))
+            with open(os.path.join(self.srcdir, name), 'wb') as wf:
+                wf.write(contents[name])
+            jobs.append((baseurl + name, os.path.join(self.destdir, name),
+                         None, len(contents[name])))
+
+        results = grabber.urlgrab_many(jobs, grabber.TextProgress(len(jobs)),
+                                       workers=8, host_limit=8)
+        for (url, filename, _, _), result in zip(jobs, results):
+            self.assertEqual(result, filename)
+            with open(filename, 'rb') as rf:
+                self.assertEqual(rf.read(),
+                                 contents[os.path.basename(filename)])
+        # nothing but the downloaded files is left
+        self.assertEqual(sorted(os.listdir(self.destdir)),
+                         sorted(contents.keys()))
+
+    def testFailedGrabKeepsFile(self):
+        baseurl = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        filename = os.path.join(self.destdir, 'pkg.rpm')
+        with open(filename, 'wb') as wf:
+            wf.write('cached')
+        self.assertRaises(CreatorError, grabber.myurlgrab,
+                          baseurl + 'missing.rpm', filename, None)
+        with open(filename, 'rb') as rf:
+            self.assertEqual(rf.read(), 'cached')
+        self.assertEqual(os.listdir(self.destdir), ['pkg.rpm'])
+
+    def testUrlgrabManyCheck(self):
+        baseurl = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        jobs = []
+        for name in ('fetched.rpm', 'damaged.rpm'):
+            with open(os.path.join(self.srcdir, name), 'wb') as wf:
+                wf.write('new')
+            with open(os.path.join(self.destdir, name), 'wb') as wf:
+                wf.write('old')
+            jobs.append((baseurl + name, os.path.join(self.destdir, name),
+                         None, 3))
+
+        checked = []
+        def _check(filename):
+            checked.append(os.path.basename(filename))
+            # the lock on the file is held while checking it
+            lockfd = os.open(filename + '.lock', os.O_RDWR)
+            try:
+                self.assertRaises(IOError, fcntl.flock, lockfd,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(lockfd)
+            return filename.endswith('fetched.rpm')
+        grabber.urlgrab_many(jobs, grabber.TextProgress(len(jobs)),
+                             check=_check)
+        self.assertEqual(sorted(checked), ['damaged.rpm', 'fetched.rpm'])
+        for name, data in (('fetched.rpm', 'old'), ('damaged.rpm', 'new')):
+            with open(os.path.join(self.destdir, name), 'rb') as rf:
+                self.assertEqual(rf.read(), data)
+
+if __name__ == "__main__":
+    unittest.main()
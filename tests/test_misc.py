@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+import os
+import bz2
+import json
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from mic.utils import misc
+from mic.utils.errors import CreatorError
+from mic.utils.safeurl import SafeURL
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(MetadataTest),
+                               unittest.makeSuite(GroupIndexTest),
+                               unittest.makeSuite(PkgIndexTest),
+                               unittest.makeSuite(FileHashesTest)])
+
+DATA = '<metadata packages="2">\n' + 'x' * 200000 + '</metadata>\n'
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.workdir, 'repo')
+        self.cachedir = os.path.join(self.workdir, 'cache')
+        os.makedirs(os.path.join(self.srcdir, 'repodata'))
+        os.makedirs(os.path.join(self.cachedir, 'oss'))
+        self.checksum = hashlib.sha256(DATA).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _url(self, name):
+        return 'file://' + os.path.join(self.srcdir, name)
+
+    def _read(self, path):
+        with open(path, 'rb') as rf:
+            return rf.read()
+
+    def testStreamGzip(self):
+        # two gzip members, as written by some repo tools
+        src = gzip.open(os.path.join(self.srcdir, 'primary.xml.gz'), 'wb')
+        src.write(DATA[:1000])
+        src.close()
+        src = gzip.open(os.path.join(self.srcdir, 'rest.gz'), 'wb')
+        src.write(DATA[1000:])
+        src.close()
+        with open(os.path.join(self.srcdir, 'primary.xml.gz'), 'ab') as wf:
+            wf.write(self._read(os.path.join(self.srcdir, 'rest.gz')))
+
+        filename = os.path.join(self.cachedir, 'oss', 'primary.xml')
+        self.assertEqual(misc._stream_metadata(self._url('primary.xml.gz'),
+                                               filename, None, 'sha256',
+                                               self.checksum), filename)
+        self.assertEqual(self._read(filename), DATA)
+        self.assertTrue(misc._cached_metadata(filename, 'sha256',
+                                              self.checksum))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(filename))),
+                         ['primary.xml', 'primary.xml.digest'])
+
+    def testStreamChecksumMismatch(self):
+        with open(os.path.join(self.srcdir, 'primary.xml.bz2'), 'wb') as wf:
+            wf.write(bz2.compress(DATA))
+        filename = os.path.join(self.cachedir, 'oss', 'primary.xml')
+        self.assertRaises(CreatorError, misc._stream_metadata,
+                          self._url('primary.xml.bz2'), filename, None,
+                          'sha256', '0' * 64)
+        # nothing is left behind
+        self.assertEqual(os.listdir(os.path.dirname(filename)), [])
+
+    def testStreamBz2TrailingData(self):
+        with open(os.path.join(self.srcdir, 'primary.xml.bz2'), 'wb') as wf:
+            # past the first chunk read, so bz2 sees it after the stream end
+            wf.write(bz2.compress(DATA) + os.urandom(2 * misc.METADATA_CHUNK))
+        filename = os.path.join(self.cachedir, 'oss', 'primary.xml')
+        self.assertRaises(CreatorError, misc._stream_metadata,
+                          self._url('primary.xml.bz2'), filename, None)
+        self.assertEqual(os.listdir(os.path.dirname(filename)), [])
+
+    def testDigestCacheHit(self):
+        with open(os.path.join(self.srcdir, 'repodata/primary.xml'), 'wb') as wf:
+            wf.write(DATA)
+        baseurl = SafeURL('file://' + self.srcdir)
+        filename = misc._get_metadata_from_repo(baseurl, None, self.cachedir,
+                                                'oss', 'repodata/primary.xml',
+                                                'sha256', self.checksum)
+        self.assertEqual(self._read(filename), DATA)
+
+        # served from the cache through its digest file, without reading
+        # the source or hashing the cached copy
+        os.unlink(os.path.join(self.srcdir, 'repodata/primary.xml'))
+        new_digest = misc._new_digest
+        misc._new_digest = None
+        try:
+            self.assertEqual(misc._get_metadata_from_repo(baseurl, None,
+                                 self.cachedir, 'oss', 'repodata/primary.xml',
+                                 'sha256', self.checksum), filename)
+        finally:
+            misc._new_digest = new_digest
+
+        # another checksum is not a cache hit
+        self.assertFalse(misc._cached_metadata(filename, 'sha256', '0' * 64))
+
+COMPS = """<?xml version="1.0" encoding="UTF-8"?>
+<comps>
+  <group>
+    <id>base</id>
+    <name>Base System</name>
+    <packagelist>
+      <packagereq>bash</packagereq>
+      <packagereq>glibc</packagereq>
+      <packagereq>bash</packagereq>
+    </packagelist>
+  </group>
+  <group>
+    <id>%s</id>
+    <packagelist>
+      <packagereq>vim</packagereq>
+    </packagelist>
+  </group>
+</comps>
+"""
+
+class GroupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.comps = os.path.join(self.workdir, 'comps.xml')
+        self._write_comps('editors', 1000000000)
+        self.built = []
+        misc._group_indexes.clear()
+
+    def tearDown(self):
+        misc._group_indexes.clear()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _write_comps(self, group, mtime):
+        with open(self.comps, 'w') as wf:
+            wf.write(COMPS % group)
+        os.utime(self.comps, (mtime, mtime))
+
+    def _builder(self, groupfile):
+        self.built.append(groupfile)
+        return misc._index_comps(groupfile)
+
+    def testSaveAndReload(self):
+        index = misc.get_group_index(self.comps, self._builder)
+        self.assertEqual(index['base'], ['bash', 'glibc'])
+        self.assertEqual(index['Base System'], ['bash', 'glibc'])
+        self.assertEqual(index['editors'], ['vim'])
+        self.assertEqual(self.built, [self.comps])
+        self.assertTrue(os.path.exists(self.comps + misc.GROUPINDEX_SUFFIX))
+
+        # kept by this process
+        self.assertTrue(misc.get_group_index(self.comps, self._builder)
+                        is index)
+        # loaded from the saved index by another one
+        misc._group_indexes.clear()
+        self.assertEqual(misc.get_group_index(self.comps, self._builder),
+                         index)
+        self.assertEqual(self.built, [self.comps])
+        self.assertEqual(misc.get_pkglist_in_comps('base', self.comps),
+                         ['bash', 'glibc'])
+
+    def testRevision(self):
+        misc.get_group_index(self.comps, self._builder)
+
+        # a new revision of the group file
+        self._write_comps('editor', 1000000001)
+        index = misc.get_group_index(self.comps, self._builder)
+        self.assertEqual(index['editor'], ['vim'])
+        self.assertFalse('editors' in index)
+        self.assertEqual(len(self.built), 2)
+
+        # an index saved by another version of mic is rebuilt
+        misc._group_indexes.clear()
+        indexfile = self.comps + misc.GROUPINDEX_SUFFIX
+        with open(indexfile) as rf:
+            data = json.load(rf)
+        data['revision'] = '0' + data['revision'][1:]
+        with open(indexfile, 'w') as wf:
+            json.dump(data, wf)
+        misc.get_group_index(self.comps, self._builder)
+        self.assertEqual(len(self.built), 3)
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common"
+          xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="1">
+<package type="rpm">
+  <name>rpm</name>
+  <arch>armv7l</arch>
+  <version epoch="0" ver="%s" rel="1"/>
+  <location href="armv7l/rpm-%s-1.armv7l.rpm"/>
+  <format>
+    <rpm:sourcerpm>rpm-%s-1.src.rpm</rpm:sourcerpm>
+  </format>
+</package>
+</metadata>
+"""
+
+class PkgIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.primary = os.path.join(self.workdir, 'primary.xml')
+        self.built = []
+        self.build_pkgindex = misc._build_pkgindex
+        def _build(*args):
+            self.built.append(args[2])
+            return self.build_pkgindex(*args)
+        misc._build_pkgindex = _build
+
+    def tearDown(self):
+        misc._build_pkgindex = self.build_pkgindex
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _repo(self, version):
+        with open(self.primary, 'w') as wf:
+            wf.write(PRIMARY % (version, version, version))
+        return {'name': 'oss', 'primary': self.primary,
+                'primary_checksum': 'sum-' + version}
+
+    def testRebuildOnChecksum(self):
+        # left by another build writing the index at the same time
+        other = os.path.join(self.workdir, misc.PKGINDEX_FILE + '.tmp')
+        with open(other, 'w') as wf:
+            wf.write('')
+
+        repos = [self._repo('4.11.0')]
+        self.assertEqual(misc.get_rpmver_in_repo(repos), '4.11.0')
+        self.assertEqual(misc.get_rpmver_in_repo(repos), '4.11.0')
+        self.assertEqual(self.built, ['sum-4.11.0'])
+
+        repos = [self._repo('4.14.1')]
+        self.assertEqual(misc.get_rpmver_in_repo(repos), '4.14.1')
+        self.assertEqual(self.built, ['sum-4.11.0', 'sum-4.14.1'])
+        con = misc.get_pkgindex(repos[0])
+        self.assertEqual(con.execute("SELECT location_href, rpm_sourcerpm "
+                                     "FROM packages").fetchall(),
+                         [('armv7l/rpm-4.14.1-1.armv7l.rpm',
+                           'rpm-4.14.1-1.src.rpm')])
+        con.close()
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         [misc.PKGINDEX_FILE, os.path.basename(other),
+                          'primary.xml'])
+
+class FileHashesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(4):
+            path = os.path.join(self.workdir, 'image-%d.raw' % i)
+            with open(path, 'wb') as wf:
+                wf.write('image %d' % i * 1000)
+            self.files.append(path)
+        misc._hashes_cache.clear()
+        # the files read, and the digests asked each time
+        self.read = []
+        self.calc_hashes = misc.calc_hashes
+        def _calc_hashes(file_path, hash_names, *args):
+            self.read.append((os.path.basename(file_path), tuple(hash_names)))
+            return self.calc_hashes(file_path, hash_names, *args)
+        misc.calc_hashes = _calc_hashes
+
+    def tearDown(self):
+        misc.calc_hashes = self.calc_hashes
+        misc._hashes_cache.clear()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _expected(self, path, names):
+        with open(path, 'rb') as rf:
+            data = rf.read()
+        return dict((name, hashlib.new(name, data).hexdigest())
+                    for name in names)
+
+    def testReadOnce(self):
+        names = ('md5', 'sha1', 'sha256')
+        hashes = misc.get_file_hashes(self.files, hash_names=names)
+        for path in self.files:
+            self.assertEqual(hashes[path], self._expected(path, names))
+        self.assertEqual(sorted(self.read),
+                         [(os.path.basename(path), names)
+                          for path in self.files])
+
+        # all cached, then only the missing digest is computed
+        del self.read[:]
+        self.assertEqual(misc.get_md5sum(self.files[0]),
+                         hashes[self.files[0]]['md5'])
+        misc.get_file_hashes(self.files[:1], hash_names=('sha512',))
+        self.assertEqual(self.read, [('image-0.raw', ('sha512',))])
+
+        # a modified file is read again
+        del self.read[:]
+        with open(self.files[0], 'ab') as wf:
+            wf.write('more')
+        self.assertEqual(misc.get_sha256sum(self.files[0]),
+                         self._expected(self.files[0], ['sha256'])['sha256'])
+        self.assertEqual(self.read, [('image-0.raw', ('sha256',))])
+
+    def testEviction(self):
+        size = misc.HASHES_CACHE_SIZE
+        misc.HASHES_CACHE_SIZE = 2
+        try:
+            misc.get_md5sum(self.files[0])
+            misc.get_md5sum(self.files[1])
+            # used last, kept
+            misc.get_md5sum(self.files[0])
+            misc.get_md5sum(self.files[2])
+            self.assertEqual(len(misc._hashes_cache), 2)
+
+            del self.read[:]
+            misc.get_md5sum(self.files[0])
+            misc.get_md5sum(self.files[1])
+            self.assertEqual(self.read, [('image-1.raw', ('md5',))])
+            self.assertEqual(len(misc._hashes_cache), 2)
+
+            # a lookup alone doesn't add the file
+            self.assertEqual(misc._cached_hashes(misc._hashes_key(
+                                 self.files[3])), {})
+            self.assertEqual(len(misc._hashes_cache), 2)
+        finally:
+            misc.HASHES_CACHE_SIZE = size
+
+if __name__ == "__main__":
+    unittest.main()
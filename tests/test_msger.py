@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from mic import msger
+
+def suite():
+    return unittest.makeSuite(MsgerTest)
+
+def _record(msg):
+    return logging.makeLogRecord({'msg': msg})
+
+class MsgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.workdir, 'mic.log')
+        self.handler = msger.MicFileHandler()
+        # msger.flush() waits for the handler of the MIC logger
+        self.saved = msger.LOGGER._allhandlers['logfile']
+        msger.LOGGER._allhandlers['logfile'] = self.handler
+
+    def tearDown(self):
+        msger.LOGGER._allhandlers['logfile'] = self.saved
+        self.handler.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _messages(self):
+        with open(self.logfile) as rf:
+            return [line.rstrip('\n').split('] ', 1)[1] for line in rf]
+
+    def testBufferedBeforeLogfile(self):
+        for i in range(msger.LOG_BUFFER_SIZE + 5):
+            self.handler.emit(_record('early %d' % i))
+        self.handler.set_logfile(self.logfile)
+        self.handler.emit(_record('late'))
+        msger.flush()
+
+        messages = self._messages()
+        # only the last LOG_BUFFER_SIZE records are kept, first
+        self.assertEqual(len(messages), msger.LOG_BUFFER_SIZE + 1)
+        self.assertEqual(messages[0], 'early 5')
+        self.assertEqual(messages[-2], 'early %d' % (msger.LOG_BUFFER_SIZE + 4))
+        self.assertEqual(messages[-1], 'late')
+
+    def testOrderAroundLogfile(self):
+        self.handler.emit(_record('one'))
+        self.handler.emit(_record('two'))
+        self.handler.set_logfile(self.logfile)
+        self.handler.emit(_record('three'))
+        msger.flush()
+        self.handler.emit(_record('four'))
+        msger.flush()
+        self.assertEqual(self._messages(), ['one', 'two', 'three', 'four'])
+
+    def testFlushWaitsForDisk(self):
+        self.handler.set_logfile(self.logfile)
+        for i in range(10):
+            self.handler.emit(_record('line %d' % i))
+        # well within LOG_BATCH_INTERVAL, the writer would still wait
+        msger.flush()
+        self.assertEqual(self._messages(), ['line %d' % i for i in range(10)])
+
+    def testForkedChild(self):
+        self.handler.set_logfile(self.logfile)
+        self.handler.emit(_record('parent'))
+        msger.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.handler.emit(_record('child'))
+                msger.flush()
+                code = int(self.handler.writer_pid != os.getpid())
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        self.handler.emit(_record('parent again'))
+        msger.flush()
+        self.assertEqual(self._messages(), ['parent', 'child',
+                                            'parent again'])
+
+if __name__ == "__main__":
+    unittest.main()
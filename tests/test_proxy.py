@@ -28,6 +28,15 @@ class ProxyTest(unittest.TestCase):
         self.assertEqual(proxy.get_proxy_for('http://linux.hello.com'), None)
         self.assertEqual(proxy.get_proxy_for('http://linux.hello.com.org'), 'http://proxy.some.com:11')
 
+    def test_noproxy_compiled(self):
+        proxy.set_proxies('http://proxy.some.com:11',
+                          'fd00::/8, 10.0.0.0/255.0.0.0, `echo 5.6.7.8,a.org`')
+        self.assertEqual(proxy.get_proxy_for('http://[fd12::1]:8080/'), None)
+        self.assertEqual(proxy.get_proxy_for('http://[fe80::1]/'), 'http://proxy.some.com:11')
+        self.assertEqual(proxy.get_proxy_for('http://10.1.2.3'), None)
+        self.assertEqual(proxy.get_proxy_for('http://5.6.7.8'), None)
+        self.assertEqual(proxy.get_proxy_for('http://user@A.org:80'), None)
+        self.assertEqual(proxy.get_proxy_for('http://b.a.org'), 'http://proxy.some.com:11')
 
 
 if __name__ == "__main__":
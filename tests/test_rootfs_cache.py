@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+from mic.utils import rootfs_cache
+
+def suite():
+    return unittest.makeSuite(RootfsCacheTest)
+
+PACKAGES = ['bash 0:4.3-1.armv7l', 'glibc 0:2.20-1.armv7l']
+
+class RootfsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.workdir, 'rootfs')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _instroot(self, name, uuid):
+        """An install root as mount() leaves it for a build"""
+        instroot = os.path.join(self.workdir, name)
+        for subdir in ('etc', 'dev', 'proc', 'usr/bin'):
+            os.makedirs(os.path.join(instroot, subdir))
+        with open(os.path.join(instroot, 'etc/fstab'), 'w') as wf:
+            wf.write('UUID=%s / ext4 defaults 0 0\n' % uuid)
+        os.symlink('../proc/mounts', os.path.join(instroot, 'etc/mtab'))
+        return instroot
+
+    def _read(self, path):
+        with open(path) as rf:
+            return rf.read()
+
+    def testSaveAndRestore(self):
+        first = self._instroot('first', 'aaaa')
+        cache = rootfs_cache.RootfsCache(self.cachedir, {'arch': 'armv7l'})
+        self.assertFalse(cache.lookup(PACKAGES, first))
+        # what the package install adds
+        with open(os.path.join(first, 'usr/bin/bash'), 'w') as wf:
+            wf.write('bash')
+        with open(os.path.join(first, 'dev/loop0'), 'w') as wf:
+            wf.write('')
+        with open(os.path.join(first, '__catched_stderr.buf'), 'w') as wf:
+            wf.write('rpm output')
+        cache.save(first)
+
+        # other macros, other key
+        cache = rootfs_cache.RootfsCache(self.cachedir, {'arch': 'aarch64'})
+        self.assertFalse(cache.lookup(PACKAGES, self._instroot('other', 'c')))
+
+        second = self._instroot('second', 'bbbb')
+        cache = rootfs_cache.RootfsCache(self.cachedir, {'arch': 'armv7l'})
+        self.assertTrue(cache.lookup(list(reversed(PACKAGES)), second))
+        self.assertEqual(self._read(os.path.join(second, 'usr/bin/bash')),
+                         'bash')
+        # the build specific files are the ones of the current build
+        self.assertEqual(self._read(os.path.join(second, 'etc/fstab')),
+                         'UUID=bbbb / ext4 defaults 0 0\n')
+        self.assertEqual(os.readlink(os.path.join(second, 'etc/mtab')),
+                         '../proc/mounts')
+        self.assertFalse(os.path.exists(os.path.join(second, 'dev/loop0')))
+        self.assertFalse(os.path.exists(os.path.join(second,
+                                                     '__catched_stderr.buf')))
+
+    def testPrune(self):
+        instroot = self._instroot('root', 'aaaa')
+        for i in range(3):
+            cache = rootfs_cache.RootfsCache(self.cachedir, {'n': i})
+            cache.lookup(PACKAGES, instroot)
+            cache.save(instroot)
+            for snapshot in glob.glob(os.path.join(self.cachedir,
+                                                   cache.key + '.*')):
+                os.utime(snapshot, (1000 + i, 1000 + i))
+        cache.prune(keep=2)
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+        # the most recently used snapshot is kept
+        self.assertTrue(rootfs_cache.RootfsCache(self.cachedir, {'n': 2})
+                        .lookup(PACKAGES, instroot))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+import os
+import json
+import shutil
+import hashlib
+import StringIO
+import tempfile
+import unittest
+
+from mic.utils import rpmmisc
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(HeaderStoreTest),
+                               unittest.makeSuite(PackageContentsTest),
+                               unittest.makeSuite(VerifyCacheTest)])
+
+class _Header(dict):
+    """ A header as far as the header cache is concerned """
+    def unload(self):
+        return json.dumps(self)
+
+class _Rpm(object):
+    """ The parts of the rpm module used by the header store """
+    class error(Exception):
+        pass
+
+    def __init__(self):
+        self.loaded = 0
+
+    def hdr(self, blob):
+        self.loaded += 1
+        return _Header(json.loads(blob))
+
+class _Ts(object):
+    def __init__(self):
+        self.read = []
+
+    def hdrFromFdno(self, fd):
+        self.read.append(fd)
+        return _Header(name='bash', epoch=None, version='4.3', release='1',
+                       arch='armv7l', license='GPLv3+')
+
+class HeaderStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.workdir, rpmmisc.HEADER_CACHE)
+        self.rpmfile = os.path.join(self.workdir, 'bash.rpm')
+        with open(self.rpmfile, 'w') as wf:
+            wf.write('rpm')
+        os.utime(self.rpmfile, (1000000000, 1000000000))
+        self.rpm = rpmmisc.rpm
+        rpmmisc.rpm = _Rpm()
+        self.ts = _Ts()
+
+    def tearDown(self):
+        rpmmisc.setRpmHeaderCache(None)
+        rpmmisc.rpm = self.rpm
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _reopen(self):
+        """ The store as the next build finds it """
+        rpmmisc.setRpmHeaderCache(self.dbfile)
+
+    def testHit(self):
+        self._reopen()
+        hdr = rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+        self.assertEqual(hdr['name'], 'bash')
+        self.assertEqual(len(self.ts.read), 1)
+        # kept in memory by this build
+        self.assertTrue(rpmmisc.readRpmHeader(self.ts, self.rpmfile) is hdr)
+
+        self._reopen()
+        self.assertEqual(rpmmisc.readRpmHeader(self.ts, self.rpmfile), hdr)
+        self.assertEqual(len(self.ts.read), 1)
+        self.assertEqual(rpmmisc.rpm.loaded, 1)
+
+    def testMissOnMtime(self):
+        self._reopen()
+        rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+        os.utime(self.rpmfile, (1000000001, 1000000001))
+
+        self._reopen()
+        rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+        self.assertEqual(len(self.ts.read), 2)
+        self.assertEqual(rpmmisc.rpm.loaded, 0)
+
+    def testTagsWithoutBlob(self):
+        self._reopen()
+        rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+
+        self._reopen()
+        tags = rpmmisc.readRpmHeaderInfo(self.ts, self.rpmfile)
+        self.assertEqual(tags, {'name': 'bash', 'epoch': None,
+                                'version': '4.3', 'release': '1',
+                                'arch': 'armv7l', 'license': 'GPLv3+'})
+        self.assertEqual(len(self.ts.read), 1)
+        self.assertEqual(rpmmisc.rpm.loaded, 0)
+
+    def testPruneOnClose(self):
+        self._reopen()
+        rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+        other = os.path.join(self.workdir, 'vim.rpm')
+        with open(other, 'w') as wf:
+            wf.write('rpm')
+        rpmmisc.readRpmHeader(self.ts, other)
+        os.unlink(other)
+        rpmmisc.setRpmHeaderCache(None)
+
+        store = rpmmisc.RpmHeaderStore(self.dbfile)
+        try:
+            paths = [row[0] for row in
+                     store.con.execute("SELECT path FROM headers")]
+        finally:
+            store.con.close()
+        self.assertEqual(paths, [os.path.realpath(self.rpmfile)])
+
+    def testDroppedOnError(self):
+        self._reopen()
+        # a database the store can no longer use
+        rpmmisc._header_store.con.close()
+        hdr = rpmmisc.readRpmHeader(self.ts, self.rpmfile)
+        self.assertEqual(hdr['name'], 'bash')
+        self.assertTrue(rpmmisc._header_store is None)
+        self.assertEqual(rpmmisc.readRpmHeaderInfo(self.ts, self.rpmfile)
+                         ['version'], '4.3')
+
+CONTENTS = [('bash-4.3-1.armv7l', ['/bin/bash', '/etc/skel/.bashrc']),
+            ('filesystem-3.1-1.armv7l', []),
+            ('vim-7.4-1.armv7l', ['/usr/bin/vim'])]
+
+def _old_record(contents, pkgs):
+    """ The .files record as it was written from the file lists in memory """
+    record = ''
+    for pkg in pkgs:
+        content = pkg + '\n'
+        content += '    '
+        content += '\n    '.join(contents[pkg])
+        content += '\n'
+        content += '\n'
+        record += content
+    return record
+
+class PackageContentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.contents = rpmmisc.PackageContents(self.workdir)
+        for pkg, filenames in CONTENTS:
+            self.contents.add(pkg, filenames)
+
+    def tearDown(self):
+        self.contents.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def testRecord(self):
+        pkgs = sorted(self.contents.keys(), reverse=True)
+        out = StringIO.StringIO()
+        self.contents.write(out, pkgs)
+        self.assertEqual(out.getvalue(), _old_record(dict(CONTENTS), pkgs))
+        # the spool is anonymous
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def testMapping(self):
+        self.assertEqual(sorted(self.contents.keys()),
+                         [pkg for pkg, filenames in CONTENTS])
+        self.assertEqual(sorted(self.contents), sorted(self.contents.keys()))
+        self.assertEqual(len(self.contents), 3)
+        self.assertTrue('vim-7.4-1.armv7l' in self.contents)
+        self.assertFalse('vim' in self.contents)
+        for pkg, filenames in CONTENTS:
+            self.assertEqual(self.contents[pkg], filenames)
+        # reading does not disturb what is added next
+        self.contents.add('zsh-5.1-1.armv7l', ['/bin/zsh'])
+        self.assertEqual(self.contents['zsh-5.1-1.armv7l'], ['/bin/zsh'])
+        self.assertEqual(self.contents['bash-4.3-1.armv7l'],
+                         ['/bin/bash', '/etc/skel/.bashrc'])
+
+class VerifyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.workdir, rpmmisc.VERIFY_CACHE)
+        self.rpms = []
+        for name in ('bash', 'vim'):
+            path = os.path.join(self.workdir, name + '.rpm')
+            with open(path, 'w') as wf:
+                wf.write(name)
+            os.utime(path, (1000000000, 1000000000))
+            self.rpms.append(path)
+        # 'rpm -K' on the rpms, the damaged ones contain 'bad'
+        self.checked = []
+        self.checkRpmIntegrity = rpmmisc.checkRpmIntegrity
+        def _check(bin_rpm, path):
+            self.checked.append(os.path.basename(path))
+            with open(path) as rf:
+                return int('bad' in rf.read())
+        rpmmisc.checkRpmIntegrity = _check
+
+    def tearDown(self):
+        rpmmisc.checkRpmIntegrity = self.checkRpmIntegrity
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _check(self, sumtype=None, checksum=None):
+        del self.checked[:]
+        return rpmmisc.checkRpmsIntegrity(
+                   [(path, sumtype, checksum) for path in self.rpms],
+                   self.cachefile, workers=2)
+
+    def _cached(self):
+        with open(self.cachefile) as rf:
+            return sorted(os.path.basename(path) for path in json.load(rf))
+
+    def testSkippedWhenUnchanged(self):
+        self.assertEqual(self._check(), dict((path, 0) for path in self.rpms))
+        self.assertEqual(sorted(self.checked), ['bash.rpm', 'vim.rpm'])
+        self.assertEqual(self._cached(), ['bash.rpm', 'vim.rpm'])
+
+        self.assertEqual(self._check(), dict((path, 0) for path in self.rpms))
+        self.assertEqual(self.checked, [])
+
+    def testRecheckedWhenChanged(self):
+        self._check()
+        # same size, other mtime
+        with open(self.rpms[1], 'w') as wf:
+            wf.write('bad')
+        self.assertEqual(self._check(), {self.rpms[0]: 0, self.rpms[1]: 1})
+        self.assertEqual(self.checked, ['vim.rpm'])
+        # the failed rpm is removed from the cache, and checked again
+        self.assertEqual(self._cached(), ['bash.rpm'])
+        self.assertEqual(self._check(), {self.rpms[0]: 0, self.rpms[1]: 1})
+        self.assertEqual(self.checked, ['vim.rpm'])
+
+    def testChecksum(self):
+        checksum = hashlib.sha256('bash').hexdigest()
+        self.rpms = self.rpms[:1]
+        self.assertEqual(self._check('sha256', checksum), {self.rpms[0]: 0})
+        self.assertEqual(self._check('sha256', checksum), {self.rpms[0]: 0})
+        # a cached digest of another checksum doesn't count
+        self.assertEqual(self._check('sha256', '0' * 64), {self.rpms[0]: 1})
+        self.assertEqual(self._cached(), [])
+        self.assertEqual(self.checked, [])
+
+    def testRemovedRpms(self):
+        self._check()
+        os.unlink(self.rpms[0])
+        self.assertEqual(self._check(), {self.rpms[0]: 1, self.rpms[1]: 0})
+        self.assertEqual(self._cached(), ['vim.rpm'])
+
+if __name__ == "__main__":
+    unittest.main()
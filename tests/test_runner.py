@@ -47,6 +47,46 @@ class RunnerTest(unittest.TestCase):
         self.assertEqual(0, rc)
         self.assertEqual("hello\n", out)
 
+    def testStreamPartialLines(self):
+        lines = []
+        proc = runner.Streamed(["sh", "-c", "printf 'a\\nb'; echo c >&2"])
+        runner.stream([proc], handler=lambda p, line: lines.append(line))
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual(5, proc.outsize)
+        self.assertEqual(["a", "b", "c"], sorted(lines))
+
+    def testStreamTimeout(self):
+        proc = runner.Streamed(["sh", "-c", "sleep 30 & sleep 30"])
+        runner.stream([proc], timeout=0.1, handler=lambda p, line: None)
+        self.assertTrue(proc.timedout)
+        self.assertTrue(proc.duration < 10)
+
+    def testShell(self):
+        with runner.Shell() as shell:
+            self.assertEqual((0, "a b\n"), shell.runtool(["echo", "a b"]))
+            self.assertEqual((1, "x"), shell.runtool("printf x; false"))
+            shell.quiet("cd /")
+            self.assertEqual((0, "/\n"), shell.runtool("pwd"))
+
+    def testTimeline(self):
+        runner.reset_timeline()
+        runner.runtool(["echo", "hello"])
+        runner.show("exit 2")
+        timeline = runner.get_timeline()
+        self.assertEqual([["echo", "hello"], "exit 2"],
+                         [cmd["argv"] for cmd in timeline])
+        self.assertEqual([0, 2], [cmd["exit_code"] for cmd in timeline])
+        self.assertEqual(6, timeline[0]["outsize"])
+
+    def testTimelineSize(self):
+        runner.reset_timeline()
+        for i in range(runner.TIMELINE_SIZE + 2):
+            runner._record(["true", str(i)], 0, 0, 0)
+        timeline = runner.get_timeline()
+        self.assertEqual(runner.TIMELINE_SIZE, len(timeline))
+        self.assertEqual(["true", "2"], timeline[0]["argv"])
+        runner.reset_timeline()
+
 if __name__ == "__main__":
     unittest.main()
 
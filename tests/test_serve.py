@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import types
+import shutil
+import signal
+import argparse
+import tempfile
+import unittest
+import StringIO
+
+from mic import cmd_serve, cmd_submit
+from mic.utils import errors
+
+def suite():
+    return unittest.makeSuite(ServeTest)
+
+def _job_main(parser, args, argv):
+    sys.stdout.write("job %s\n" % args.result)
+    if args.result == 'none':
+        return None
+    if args.result == 'exit':
+        sys.exit()
+    if args.result == 'message':
+        sys.exit("boom")
+    sys.exit(int(args.result))
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        job = types.ModuleType('mic.cmd_testjob')
+        job.main = _job_main
+        sys.modules['mic.cmd_testjob'] = job
+
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument('-v', '--verbose', action='store_true')
+        self.parser.add_argument('-d', '--debug', action='store_true')
+        subparsers = self.parser.add_subparsers()
+        testjob = subparsers.add_parser('testjob')
+        testjob.set_defaults(module='cmd_testjob', alias='tj')
+        testjob.add_argument('result')
+
+        self.workdir = tempfile.mkdtemp()
+        self.sockpath = os.path.join(self.workdir, 'mic.sock')
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                # the plugins are not needed by the test job
+                cmd_serve.PLUGIN_TYPES = ()
+                cmd_serve.serve(self.parser, self.sockpath)
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        del sys.modules['mic.cmd_testjob']
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _submit(self, argv):
+        out = StringIO.StringIO()
+        for _ in range(100):
+            try:
+                return cmd_submit.submit(self.sockpath, argv, out), \
+                       out.getvalue()
+            except errors.CreatorError:
+                time.sleep(0.05)
+        self.fail("mic server did not start")
+
+    def testExitCodes(self):
+        self.assertEqual(self._submit(['testjob', 'none']), (0, "job none\n"))
+        self.assertEqual(self._submit(['tj', 'exit']), (0, "job exit\n"))
+        self.assertEqual(self._submit(['testjob', '3']), (3, "job 3\n"))
+        code, output = self._submit(['testjob', 'message'])
+        self.assertEqual(code, 1)
+        self.assertEqual(output, "job message\nboom\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+import os
+import sys
+import types
+import unittest
+
+from mic.utils import errors
+
+CWD = os.path.dirname(__file__) or '.'
+sys.path.insert(0, os.path.join(CWD, '..', 'plugins', 'backend'))
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(PoolIndexTest),
+                               unittest.makeSuite(DeselectTest)])
+
+# from the least to the most specific
+ARCHS = ['noarch', 'armv7l', 'armv7hl']
+
+class _Arch(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def compatible_with(self, other):
+        return self.name in ARCHS and \
+               ARCHS.index(self.name) <= ARCHS.index(str(other))
+
+class _Cap(object):
+    def __init__(self, cap):
+        self.cap = cap
+
+    def asString(self):
+        return self.cap
+
+class _Edition(object):
+    def __init__(self, version):
+        self.ver = version
+
+    def epoch(self):
+        return 0
+
+    def version(self):
+        return self.ver
+
+    def release(self):
+        return '1'
+
+class _Status(object):
+    def __init__(self):
+        self.install = None
+
+    def setToBeInstalled(self, causer):
+        self.install = causer
+
+class _Item(object):
+    """ A pool item and the package it is, at once """
+    def __init__(self, name, arch, version, priority=99, repo='oss',
+                 provides=(), obsoletes=()):
+        self.pkgname = name
+        self.pkgarch = _Arch(arch)
+        self.pkgedition = _Edition(version)
+        self.pkgrepo = types.ModuleType('repo')
+        self.pkgrepo.priority = lambda: priority
+        self.pkgrepo.name = lambda: repo
+        self.caps = [_Cap(cap) for cap in provides]
+        self.obsolete_caps = [_Cap(cap) for cap in obsoletes]
+        self.pkgstatus = _Status()
+
+    def __repr__(self):
+        return "%s-%s.%s" % (self.pkgname, self.pkgedition.ver, self.pkgarch)
+
+    def name(self):
+        return self.pkgname
+
+    def arch(self):
+        return self.pkgarch
+
+    def edition(self):
+        return self.pkgedition
+
+    def repoInfo(self):
+        return self.pkgrepo
+
+    def provides(self):
+        return self.caps
+
+    def obsoletes(self):
+        return self.obsolete_caps
+
+    def status(self):
+        return self.pkgstatus
+
+def _fake_zypp():
+    zypp = types.ModuleType('zypp')
+    zypp.Arch = _Arch
+    zypp.PoolQuery = object
+    zypp.RepoManager = types.ModuleType('RepoManager')
+    zypp.RepoManager.loadSolvFile = None
+    zypp.ResStatus = types.ModuleType('ResStatus')
+    zypp.ResStatus.USER = 'user'
+    zypp.isKindPackage = lambda pitem: isinstance(pitem, _Item)
+    zypp.isKindPattern = lambda pitem: False
+    zypp.asKindPackage = lambda pitem: pitem
+    return zypp
+
+try:
+    import zypppkgmgr
+except ImportError:
+    # python-zypp is not needed by the indexes, only its interfaces
+    sys.modules['zypp'] = _fake_zypp()
+    try:
+        import zypppkgmgr
+    finally:
+        del sys.modules['zypp']
+
+class PoolIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zypp = zypppkgmgr.zypp
+        zypppkgmgr.zypp = _fake_zypp()
+        self.pool = [
+            _Item('bash', 'noarch', '5.0', priority=1),
+            _Item('bash', 'armv7l', '4.2'),
+            _Item('bash', 'armv7l', '4.3'),
+            _Item('bash', 'armv7l', '4.1', priority=10),
+            _Item('bash-devel', 'armv7l', '4.3'),
+            _Item('dash', 'armv7l', '0.5', provides=['sh = 0.5']),
+            _Item('busybox', 'armv7l', '1.2', provides=['sh', 'ash']),
+            _Item('zsh', 'armv7l', '5.1', obsoletes=['ksh < 5']),
+        ]
+        self.index = zypppkgmgr._PoolIndex(self.pool)
+
+        self.zy = zypppkgmgr.Zypp('armv7l', '/nonexistent', '/nonexistent')
+        self.zy.Z = object()
+        self.zy._pool_index = self.index
+
+    def tearDown(self):
+        zypppkgmgr.zypp = self.zypp
+
+    def _selected(self):
+        return [item for item in self.pool if item.status().install]
+
+    def testBestCandidate(self):
+        # arch first, then repo priority, then version
+        self.assertEqual([c.item for c in self.index.names['bash']],
+                         [self.pool[3], self.pool[2], self.pool[1],
+                          self.pool[0]])
+        self.assertTrue(self.zy._zyppQueryPackage('bash') is self.pool[3])
+        self.assertEqual(self.zy._zyppQueryPackage('csh'), None)
+        self.assertEqual(self.index.obsoleted, set(['ksh']))
+
+    def testSelectByName(self):
+        self.zy.selectPackage('bash')
+        self.assertEqual(self._selected(), [self.pool[3]])
+
+    def testSelectByNameArch(self):
+        self.zy.selectPackage('bash.armv7l')
+        self.assertEqual(self._selected(), [self.pool[3]])
+
+    def testSelectProvides(self):
+        # the best of the packages providing it
+        self.zy.selectPackage('sh')
+        self.assertEqual(self._selected(), [self.pool[6]])
+        self.assertRaises(errors.CreatorError, self.zy.selectPackage, 'csh')
+
+    def testSelectPatterns(self):
+        self.zy.selectPackage('*-devel')
+        self.assertEqual(self._selected(), [self.pool[4]])
+        self.zy.selectPackage('bas*')
+        # every candidate of a pattern is marked
+        self.assertEqual(self._selected(), self.pool[:5])
+        self.zy.selectPackage('*us*')
+        self.assertEqual(self._selected(), self.pool[:5] + [self.pool[6]])
+        # patterns don't look at the provides
+        self.assertRaises(errors.CreatorError, self.zy.selectPackage, 'sh*')
+
+class DeselectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zypp = zypppkgmgr.zypp
+        zypppkgmgr.zypp = _fake_zypp()
+        zy = zypppkgmgr.Zypp('armv7l', '/nonexistent', '/nonexistent')
+        for pkg in ('vim', 'bash.noarch', 'python-*', '*-doc', '*test*'):
+            zy.deselectPackage(pkg)
+        self.zy = zy
+
+    def tearDown(self):
+        zypppkgmgr.zypp = self.zypp
+
+    def _deselected(self, name, arch='armv7l'):
+        return self.zy.inDeselectPackages(_Item(name, arch, '1.0'))
+
+    def testNames(self):
+        self.assertTrue(self._deselected('vim'))
+        self.assertTrue(self._deselected('vim', 'noarch'))
+        self.assertFalse(self._deselected('vim-minimal'))
+
+    def testNameArch(self):
+        self.assertTrue(self._deselected('bash', 'noarch'))
+        self.assertFalse(self._deselected('bash'))
+
+    def testPrefixSuffix(self):
+        self.assertTrue(self._deselected('python-lxml'))
+        self.assertFalse(self._deselected('python'))
+        self.assertTrue(self._deselected('bash-doc'))
+        self.assertFalse(self._deselected('doc-bash'))
+
+    def testBothEnds(self):
+        # '*test*' was never a substring match for the deselection,
+        # unlike for the selection
+        self.assertFalse(self._deselected('mytests'))
+        self.assertFalse(self._deselected('test'))
+
+    def testReset(self):
+        self.assertFalse(self._deselected('nano'))
+        self.zy.deselectPackage('nano')
+        self.assertTrue(self._deselected('nano'))
+
+if __name__ == "__main__":
+    unittest.main()